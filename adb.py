@@ -2,34 +2,90 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import collections
+import errno
+import itertools
 import os
 import posixpath
 import re
+import select
+import StringIO
 import subprocess
 import tempfile
+import threading
 import time
 import traceback
+import uuid
 
 
 class ADBProcess(object):
     """ADBProcess encapsulates the data related to executing the adb process.
 
+    stdout and stderr of the adb process are read over pipes into
+    buffers which are held in memory unless they grow larger than
+    MAX_BUFFER_SIZE bytes, in which case they are spilled to temporary
+    files on disk.
+
     """
+    #: maximum size in bytes of stdout or stderr held in memory.
+    MAX_BUFFER_SIZE = 1024 * 1024
+    #: number of bytes retained from the end of stdout.
+    TAIL_SIZE = 256
+
     def __init__(self, args):
         #: command argument argument list.
         self.args = args
-        #: Temporary file handle to be used for stdout.
-        self.stdout_file = tempfile.TemporaryFile()
-        #: Temporary file handle to be used for stderr.
-        self.stderr_file = tempfile.TemporaryFile()
+        #: Buffer to be used for stdout.
+        self.stdout_file = tempfile.SpooledTemporaryFile(
+            max_size=self.MAX_BUFFER_SIZE)
+        #: Buffer to be used for stderr.
+        self.stderr_file = tempfile.SpooledTemporaryFile(
+            max_size=self.MAX_BUFFER_SIZE)
+        #: The last TAIL_SIZE bytes written to stdout.
+        self.stdout_tail = ''
         #: boolean indicating if the command timed out.
         self.timedout = None
         #: exitcode of the process.
         self.exitcode = None
         #: subprocess Process object used to execute the command.
         self.proc = subprocess.Popen(args,
-                                     stdout=self.stdout_file,
-                                     stderr=self.stderr_file)
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.PIPE)
+
+    def read_output(self, fd):
+        """Reads the available output of the process from the pipe fd
+        into the corresponding buffer. Returns False at end of file.
+
+        """
+        data = os.read(fd, 65536)
+        if not data:
+            return False
+        if fd == self.proc.stdout.fileno():
+            self.stdout_file.write(data)
+            self.stdout_tail = (self.stdout_tail + data)[-self.TAIL_SIZE:]
+        else:
+            self.stderr_file.write(data)
+        return True
+
+    def strip_exitcode(self):
+        """Removes the line containing the rc=N exitcode echoed by shell
+        commands from the end of stdout and returns the exitcode, or
+        None if it is not present. Only the retained tail of stdout is
+        examined.
+
+        """
+        # The command's output may not have ended with a newline.
+        match = re.search(r'\n?rc=([0-9]+)[\r\n]*$', self.stdout_tail)
+        if not match:
+            return None
+        self.stdout_file.seek(0, os.SEEK_END)
+        size = self.stdout_file.tell() - (len(self.stdout_tail) -
+                                          match.start())
+        # SpooledTemporaryFile.truncate() does not accept a size.
+        self.stdout_file.seek(size, os.SEEK_SET)
+        self.stdout_file.truncate()
+        self.stdout_tail = self.stdout_tail[:match.start()]
+        return int(match.group(1))
 
     @property
     def stdout(self):
@@ -99,6 +155,231 @@ class ADBTimeoutError(Exception):
     pass
 
 
+class ADBShellSessionProcess(ADBProcess):
+    """ADBShellSessionProcess holds the results of a command executed
+    over an ADBShellSession. It provides the same attributes as
+    ADBProcess but does not spawn a process; stdout_file contains the
+    combined stdout/stderr of the command and stderr_file is empty.
+
+    """
+    def __init__(self, args, output, exitcode, timedout=None):
+        self.args = args
+        self.stdout_file = StringIO.StringIO(output)
+        self.stderr_file = StringIO.StringIO()
+        self.timedout = timedout
+        self.exitcode = exitcode
+        self.proc = None
+
+
+class ADBShellSession(object):
+    """ADBShellSession maintains a long lived interactive adb shell on a
+    device and executes commands over it, avoiding the cost of
+    starting a new adb process and device connection for each command.
+
+    Each command is executed in a subshell with stdin redirected from
+    /dev/null and stderr redirected to stdout. Its output is delimited
+    by unique start and end markers with the exit code of the command
+    appended to the end marker. The markers are quoted in the command
+    line so that any echo of the input by the device's terminal can not
+    be mistaken for them.
+
+    ADBError is raised if the command could not be sent because the
+    session is no longer usable, in which case the caller should close
+    the session and fall back to executing the command via a separate
+    adb process. If the session terminates while a command is running,
+    the command is reported as failed rather than retried.
+
+    """
+    def __init__(self, args):
+        self.args = args
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        token = uuid.uuid4().hex
+        self._start_marker = 'ADBSESSION_%s_START' % token
+        self._end_marker = 'ADBSESSION_%s_END' % token
+        self._quoted_start_marker = 'ADBSESSION_"%s"_START' % token
+        self._quoted_end_marker = 'ADBSESSION_"%s"_END' % token
+        self._re_output = re.compile(r'%s\r*\n(.*?)%s:([0-9]+)\r*\n' %
+                                     (self._start_marker, self._end_marker),
+                                     re.DOTALL)
+        self.proc = subprocess.Popen(args,
+                                     stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.STDOUT)
+
+    def is_alive(self):
+        return self.pid == os.getpid() and self.proc.poll() is None
+
+    def close(self):
+        """Terminates the adb shell process if it belongs to the current
+        process. Sessions inherited from a parent process are simply
+        abandoned since the parent remains responsible for them.
+
+        """
+        if self.pid != os.getpid():
+            return
+        try:
+            self.proc.stdin.close()
+        except (IOError, OSError):
+            pass
+        if self.proc.poll() is None:
+            try:
+                self.proc.kill()
+            except OSError:
+                pass
+        self.proc.wait()
+        self.proc.stdout.close()
+
+    def execute(self, cmd, timeout):
+        """Executes cmd in the session returning an
+        ADBShellSessionProcess. If the command does not complete within
+        timeout seconds, the session is closed and the returned
+        object's timedout attribute is set.
+
+        :param cmd: string containing the command to be executed.
+        :param timeout: maximum time in seconds to wait for the command
+            to complete.
+        :raises: ADBError
+
+        """
+        with self.lock:
+            if not self.is_alive():
+                raise ADBError('adb shell session is not running')
+            line = 'echo %s; ( %s ) </dev/null 2>&1; echo %s:$?\n' % (
+                self._quoted_start_marker, cmd, self._quoted_end_marker)
+            try:
+                self.proc.stdin.write(line)
+                self.proc.stdin.flush()
+            except (IOError, OSError), e:
+                raise ADBError('adb shell session write failed: %s' % e)
+
+            fd = self.proc.stdout.fileno()
+            buf = ''
+            end_time = time.time() + timeout
+            while True:
+                match = self._re_output.search(buf)
+                if match:
+                    return ADBShellSessionProcess(self.args + [cmd],
+                                                  match.group(1),
+                                                  int(match.group(2)))
+                remaining = end_time - time.time()
+                if remaining <= 0:
+                    self.close()
+                    return ADBShellSessionProcess(self.args + [cmd], buf,
+                                                  None, timedout=True)
+                try:
+                    ready, _, _ = select.select([fd], [], [], remaining)
+                except select.error, e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+                if ready:
+                    data = os.read(fd, 65536)
+                    if not data:
+                        # The command may have been partially executed
+                        # so it is not safe to retry it. Report it as
+                        # failed in the same manner as adb does when it
+                        # loses the connection to the device.
+                        self.proc.wait()
+                        return ADBShellSessionProcess(
+                            self.args + [cmd], buf,
+                            self.proc.returncode or 255)
+                    buf += data
+
+
+class ADBLogcatStream(object):
+    """ADBLogcatStream runs a long lived adb logcat process for a device
+    and collects its output in a background thread into a ring buffer
+    holding at most max_lines lines.
+
+    Every line read is assigned a sequence number. A cursor is the
+    sequence number of the next line to be read, so consumers can
+    retrieve just the lines which arrived since their last call to
+    get_since(). Lines which have been dropped from the ring buffer
+    are silently skipped.
+
+    """
+    def __init__(self, args, max_lines):
+        self.args = args
+        self.pid = os.getpid()
+        self._lines = collections.deque(maxlen=max_lines)
+        self._count = 0
+        self._condition = threading.Condition()
+        self._devnull = open(os.devnull, 'wb')
+        self.proc = subprocess.Popen(args,
+                                     stdout=subprocess.PIPE,
+                                     stderr=self._devnull)
+        self._thread = threading.Thread(target=self._reader,
+                                        name='ADBLogcatStream')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _reader(self):
+        try:
+            for line in iter(self.proc.stdout.readline, ''):
+                line = line.strip()
+                if not line:
+                    continue
+                with self._condition:
+                    self._lines.append(line)
+                    self._count += 1
+                    self._condition.notify_all()
+        finally:
+            with self._condition:
+                self._condition.notify_all()
+
+    @property
+    def cursor(self):
+        """The cursor positioned after the last line read."""
+        with self._condition:
+            return self._count
+
+    def is_alive(self):
+        return self.pid == os.getpid() and self._thread.is_alive()
+
+    def get_since(self, cursor):
+        """Returns a tuple containing the list of lines read since cursor
+        and the cursor positioned after them.
+
+        """
+        with self._condition:
+            first = self._count - len(self._lines)
+            start = max(cursor, first) - first
+            lines = list(itertools.islice(self._lines, start, None))
+            return lines, self._count
+
+    def wait(self, cursor, timeout):
+        """Waits up to timeout seconds for lines to be read after cursor.
+        Returns True if new lines are available.
+
+        """
+        end_time = time.time() + timeout
+        with self._condition:
+            while self._count <= cursor and self._thread.is_alive():
+                remaining = end_time - time.time()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            return self._count > cursor
+
+    def stop(self):
+        """Terminates the adb logcat process if it belongs to the current
+        process.
+
+        """
+        if self.pid != os.getpid():
+            return
+        if self.proc.poll() is None:
+            try:
+                self.proc.kill()
+            except OSError:
+                pass
+        self.proc.wait()
+        self._thread.join()
+        self.proc.stdout.close()
+        self._devnull.close()
+
+
 class ADBCommand(object):
     """ADBCommand provides a basic interface to adb commands
     which is used to provide the 'command' methods for the
@@ -147,7 +428,6 @@ class ADBCommand(object):
         self._adb_host = adb_host
         self._adb_port = adb_port
         self._timeout = timeout
-        self._polling_interval = 0.1
 
         self._logger.debug("%s: %s" % (self.__class__.__name__,
                                        self.__dict__))
@@ -173,6 +453,82 @@ class ADBCommand(object):
             logger = logging.getLogger(logger_name)
         return logger
 
+    def _wait_for_process(self, adb_process, timeout):
+        """Waits for the adb process to exit while reading its output,
+        killing it if it does not complete within timeout seconds.
+
+        :param adb_process: :class:`mozdevice.ADBProcess` to wait on.
+        :param timeout: maximum time in seconds to wait.
+        :returns: exit code of the adb process.
+
+        Rather than polling the process, a helper thread blocks in
+        wait() and closes the write end of a pipe once the process has
+        been reaped. The calling thread blocks in select() on the read
+        end of that pipe and on the stdout and stderr pipes of the
+        process so that it reads the output as it arrives and resumes
+        as soon as adb exits. Any output remaining in the pipes once adb
+        has exited is then read without waiting for end of file, since
+        a daemon started by adb may have inherited them. If the timeout
+        expires first, the process is killed and adb_process.timedout
+        is set.
+
+        """
+        read_fd, write_fd = os.pipe()
+
+        def waiter():
+            try:
+                adb_process.proc.wait()
+            finally:
+                os.close(write_fd)
+
+        waiter_thread = threading.Thread(target=waiter,
+                                         name='ADBProcessWaiter')
+        waiter_thread.daemon = True
+        waiter_thread.start()
+
+        output_fds = [adb_process.proc.stdout.fileno(),
+                      adb_process.proc.stderr.fileno()]
+        try:
+            end_time = time.time() + timeout
+            exited = False
+            while not exited or output_fds:
+                if exited:
+                    fds = output_fds
+                    remaining = 0
+                elif adb_process.timedout:
+                    fds = [read_fd] + output_fds
+                    remaining = None
+                else:
+                    fds = [read_fd] + output_fds
+                    remaining = max(0, end_time - time.time())
+                try:
+                    ready, _, _ = select.select(fds, [], [], remaining)
+                except select.error, e:
+                    if e.args[0] != errno.EINTR:
+                        raise
+                    continue
+                if exited and not ready:
+                    break
+                for fd in ready:
+                    if fd == read_fd:
+                        exited = True
+                    elif not adb_process.read_output(fd):
+                        output_fds.remove(fd)
+                if not ready:
+                    adb_process.timedout = True
+                    try:
+                        adb_process.proc.kill()
+                    except OSError:
+                        # The process exited after the timeout expired.
+                        pass
+            waiter_thread.join()
+        finally:
+            os.close(read_fd)
+            adb_process.proc.stdout.close()
+            adb_process.proc.stderr.close()
+
+        return adb_process.proc.returncode
+
     # Host Command methods
 
     def command(self, cmds, device_serial=None, timeout=None):
@@ -202,11 +558,11 @@ class ADBCommand(object):
         timeout period in seconds.
 
         A subprocess is spawned to execute adb with stdout and stderr
-        directed to temporary files. If the process takes longer than
+        read into in-memory buffers. If the process takes longer than
         the specified timeout, the process is terminated.
 
         It is the caller's responsibilty to clean up by closing
-        the stdout and stderr temporary files.
+        the stdout and stderr buffers.
 
         """
         args = [self._adb_path]
@@ -223,16 +579,7 @@ class ADBCommand(object):
         if timeout is None:
             timeout = self._timeout
 
-        start_time = time.time()
-        adb_process.exitcode = adb_process.proc.poll()
-        while ((time.time() - start_time) <= timeout and
-               adb_process.exitcode == None):
-            time.sleep(self._polling_interval)
-            adb_process.exitcode = adb_process.proc.poll()
-        if adb_process.exitcode == None:
-            adb_process.proc.kill()
-            adb_process.timedout = True
-            adb_process.exitcode = adb_process.proc.poll()
+        adb_process.exitcode = self._wait_for_process(adb_process, timeout)
 
         adb_process.stdout_file.seek(0, os.SEEK_SET)
         adb_process.stderr_file.seek(0, os.SEEK_SET)
@@ -285,7 +632,7 @@ class ADBCommand(object):
 
             return output
         finally:
-            if adb_process and isinstance(adb_process.stdout_file, file):
+            if adb_process:
                 adb_process.stdout_file.close()
                 adb_process.stderr_file.close()
 
@@ -348,11 +695,11 @@ class ADBHost(ADBCommand):
         timeout period in seconds.
 
         A subprocess is spawned to execute adb with stdout and stderr
-        directed to temporary files. If the process takes longer than
+        read into in-memory buffers. If the process takes longer than
         the specified timeout, the process is terminated.
 
         It is the caller's responsibilty to clean up by closing
-        the stdout and stderr temporary files.
+        the stdout and stderr buffers.
 
         """
         return ADBCommand.command(self, cmds, timeout=timeout)
@@ -490,6 +837,11 @@ class ADBDevice(ADBCommand):
 
     """
 
+    # Maximum length of the command line passed to adb shell by
+    # shell_batch. Older versions of adb limit the length of the
+    # command to 4096 bytes.
+    SHELL_BATCH_MAX_LENGTH = 3072
+
     def __init__(self,
                  device=None,
                  adb='adb',
@@ -500,7 +852,8 @@ class ADBDevice(ADBCommand):
                  timeout=300,
                  verbose=False,
                  device_ready_retry_wait=20,
-                 device_ready_retry_attempts=3):
+                 device_ready_retry_attempts=3,
+                 use_shell_session=False):
         """Initializes the ADBDevice object.
 
         :param device: can be either a dictionary, a string or None.
@@ -528,6 +881,9 @@ class ADBDevice(ADBCommand):
             reboot.
         :param device_ready_retry_attempts: number of attempts when
             checking if a device is ready.
+        :param use_shell_session: boolean indicating if shell commands
+            should be executed over a persistent adb shell session
+            rather than a new adb process per command. Defaults to False.
 
         :raises: * ADBError
                  * ADBTimeoutError
@@ -546,6 +902,9 @@ class ADBDevice(ADBCommand):
         self._have_root_shell = False
         self._have_su = False
         self._have_android_su = False
+        self._use_shell_session = use_shell_session
+        self._shell_session = None
+        self._props = None
 
         uid = 'uid=0'
         cmd_id = 'LD_LIBRARY_PATH=/vendor/lib:/system/lib id'
@@ -648,39 +1007,6 @@ class ADBDevice(ADBCommand):
 
         return " ".join(quoted_cmd)
 
-    @staticmethod
-    def _get_exitcode(file_obj):
-        """Get the exitcode from the last line of the file_obj for shell
-        commands.
-
-        """
-        file_obj.seek(0, os.SEEK_END)
-
-        line = ''
-        length = file_obj.tell()
-        offset = 1
-        while length - offset >= 0:
-            file_obj.seek(-offset, os.SEEK_END)
-            char = file_obj.read(1)
-            if not char:
-                break
-            if char != '\r' and char != '\n':
-                line = char + line
-            elif line:
-                # we have collected everything up to the beginning of the line
-                break
-            offset += 1
-
-        match = re.match(r'rc=([0-9]+)', line)
-        if match:
-            exitcode = int(match.group(1))
-            file_obj.seek(-1, os.SEEK_CUR)
-            file_obj.truncate()
-        else:
-            exitcode = None
-
-        return exitcode
-
     @property
     def test_root(self):
         """
@@ -757,6 +1083,55 @@ class ADBDevice(ADBCommand):
 
         return True
 
+    def _get_shell_session(self):
+        """Returns the persistent adb shell session for the current
+        process, starting a new one if necessary. ADBDevice objects may
+        be created in one process and used in forked child processes, so
+        a session is never shared across processes.
+
+        """
+        if self._shell_session and not self._shell_session.is_alive():
+            self._shell_session.close()
+            self._shell_session = None
+        if not self._shell_session:
+            args = [self._adb_path]
+            if self._adb_host:
+                args.extend(['-H', self._adb_host])
+            if self._adb_port:
+                args.extend(['-P', str(self._adb_port)])
+            if self._device_serial:
+                args.extend(['-s', self._device_serial])
+            args.extend(["wait-for-device", "shell"])
+            self._shell_session = ADBShellSession(args)
+        return self._shell_session
+
+    def close_shell_session(self):
+        """Closes the persistent adb shell session if one is open. A new
+        session is started by the next shell command if
+        use_shell_session is enabled.
+
+        """
+        if self._shell_session:
+            self._shell_session.close()
+            self._shell_session = None
+
+    def _shell_session_command(self, cmd, timeout):
+        """Executes cmd over the persistent adb shell session returning
+        an ADBShellSessionProcess, or None if the session failed and the
+        command should be executed via a separate adb process.
+
+        """
+        try:
+            adb_process = self._get_shell_session().execute(cmd, timeout)
+        except (ADBError, OSError), e:
+            self._logger.warning('shell session failed for %s: %s' %
+                                 (cmd, e))
+            self.close_shell_session()
+            return None
+        if adb_process.timedout or not self._shell_session.is_alive():
+            self.close_shell_session()
+        return adb_process
+
     # Host Command methods
 
     def command(self, cmds, timeout=None):
@@ -784,12 +1159,12 @@ class ADBDevice(ADBCommand):
         commands, as well as a timeout period in seconds.
 
         A subprocess is spawned to execute adb for the device with
-        stdout and stderr directed to temporary files. If the process
+        stdout and stderr read into in-memory buffers. If the process
         takes longer than the specified timeout, the process is
         terminated.
 
         It is the caller's responsibilty to clean up by closing
-        the stdout and stderr temporary files.
+        the stdout and stderr buffers.
 
         """
 
@@ -909,6 +1284,34 @@ class ADBDevice(ADBCommand):
 
     # Device Shell methods
 
+    def _build_shell_command(self, cmd, env=None, cwd=None, root=False):
+        """Returns the command line which executes cmd with the requested
+        environment, working directory and privileges.
+
+        :raises: ADBRootError
+
+        """
+        if root:
+            ld_library_path='LD_LIBRARY_PATH=/vendor/lib:/system/lib'
+            cmd = '%s %s' % (ld_library_path, cmd)
+            if self._have_root_shell:
+                pass
+            elif self._have_su:
+                cmd = "su -c \"%s\"" % cmd
+            elif self._have_android_su:
+                cmd = "su 0 \"%s\"" % cmd
+            else:
+                raise ADBRootError('Can not run command %s as root!' % cmd)
+
+        # prepend cwd and env to command if necessary
+        if cwd:
+            cmd = "cd %s && %s" % (cwd, cmd)
+        if env:
+            envstr = '&& '.join(map(lambda x: 'export %s=%s' %
+                                    (x[0], x[1]), env.iteritems()))
+            cmd = envstr + "&& " + cmd
+        return cmd
+
     def shell(self, cmd, env=None, cwd=None, timeout=None, root=False):
         """Executes a shell command on the device.
 
@@ -954,34 +1357,31 @@ class ADBDevice(ADBCommand):
         exit code.
 
         A subprocess is spawned to execute adb shell for the device
-        with stdout and stderr directed to temporary files. If the
+        with stdout and stderr read into in-memory buffers. If the
         process takes longer than the specified timeout, the process
-        is terminated. The return code is extracted from the stdout
-        and is then removed from the file.
+        is terminated. The return code is extracted from the end of
+        stdout and is then removed from the buffer.
+
+        If the ADBDevice was created with use_shell_session, the
+        command is instead executed over a persistent adb shell
+        session and an ADBShellSessionProcess is returned. If the
+        session fails, the command is executed via a separate adb
+        process as described above.
 
         It is the caller's responsibilty to clean up by closing
-        the stdout and stderr temporary files.
+        the stdout and stderr buffers.
 
         """
-        if root:
-            ld_library_path='LD_LIBRARY_PATH=/vendor/lib:/system/lib'
-            cmd = '%s %s' % (ld_library_path, cmd)
-            if self._have_root_shell:
-                pass
-            elif self._have_su:
-                cmd = "su -c \"%s\"" % cmd
-            elif self._have_android_su:
-                cmd = "su 0 \"%s\"" % cmd
-            else:
-                raise ADBRootError('Can not run command %s as root!' % cmd)
+        cmd = self._build_shell_command(cmd, env=env, cwd=cwd, root=root)
+
+        if timeout is None:
+            timeout = self._timeout
+
+        if self._use_shell_session:
+            adb_process = self._shell_session_command(cmd, timeout)
+            if adb_process:
+                return adb_process
 
-        # prepend cwd and env to command if necessary
-        if cwd:
-            cmd = "cd %s && %s" % (cwd, cmd)
-        if env:
-            envstr = '&& '.join(map(lambda x: 'export %s=%s' %
-                                    (x[0], x[1]), env.iteritems()))
-            cmd = envstr + "&& " + cmd
         cmd += "; echo rc=$?"
 
         args = [self._adb_path]
@@ -994,20 +1394,11 @@ class ADBDevice(ADBCommand):
         args.extend(["wait-for-device", "shell", cmd])
         adb_process = ADBProcess(args)
 
-        if timeout is None:
-            timeout = self._timeout
-
-        start_time = time.time()
-        exitcode = adb_process.proc.poll()
-        while ((time.time() - start_time) <= timeout) and exitcode == None:
-            time.sleep(self._polling_interval)
-            exitcode = adb_process.proc.poll()
-        if exitcode == None:
-            adb_process.proc.kill()
-            adb_process.timedout = True
-            adb_process.exitcode = adb_process.proc.poll()
+        exitcode = self._wait_for_process(adb_process, timeout)
+        if adb_process.timedout:
+            adb_process.exitcode = exitcode
         elif exitcode == 0:
-            adb_process.exitcode = self._get_exitcode(adb_process.stdout_file)
+            adb_process.exitcode = adb_process.strip_exitcode()
         else:
             adb_process.exitcode = exitcode
 
@@ -1016,6 +1407,101 @@ class ADBDevice(ADBCommand):
 
         return adb_process
 
+    def shell_batch(self, cmds, env=None, cwd=None, timeout=None, root=False):
+        """Executes a list of shell commands on the device using a single
+        adb shell invocation, returning the exitcode and output of each
+        command.
+
+        :param cmds: list of commands to be executed in order. Each
+            entry is either a string containing the command or a
+            dictionary containing the command in the key 'cmd' and
+            optionally any of the keys 'env', 'cwd' and 'root' which
+            override the corresponding arguments for that command.
+        :param env: optional dictionary of environment variables and
+            their values.
+        :param cwd: optional string containing the directory from which
+            to execute.
+        :param timeout: optional integer specifying the maximum time in
+            seconds for any spawned adb process to complete before
+            throwing an ADBTimeoutError.
+            This timeout is per adb call. The total time spent
+            may exceed this value. If it is not specified, the value
+            set in the ADBDevice constructor is used.
+        :param root: optional boolean specifying if the commands should
+            be executed as root.
+        :returns: list containing an (exitcode, output) tuple for each
+            command where output is the combined stdout/stderr of the
+            command. exitcode is None if the command could not be
+            executed.
+        :raises: * ADBTimeoutError
+                 * ADBRootError
+                 * ADBError
+
+        Each command is executed in its own subshell so that a failing
+        command does not prevent the following commands from being
+        executed. The output of each command is terminated by a marker
+        containing its exitcode. If the resulting command line would be
+        too long for adb, the commands are split over as few adb
+        invocations as possible.
+
+        """
+        if timeout is None:
+            timeout = self._timeout
+        token = uuid.uuid4().hex[:8]
+        start_marker = 'ADBBATCH_%s_START' % token
+        end_marker = 'ADBBATCH_%s_END' % token
+        quoted_start_marker = 'ADBBATCH_"%s"_START' % token
+        quoted_end_marker = 'ADBBATCH_"%s"_END' % token
+        # shell() strips the newline following the last marker.
+        re_result = re.compile(r'(.*?)%s:([0-9]+)(?:\r*\n|$)' % end_marker,
+                               re.DOTALL)
+
+        scripts = []
+        script = None
+        for entry in cmds:
+            if isinstance(entry, basestring):
+                entry = {'cmd': entry}
+            part = '( %s ) </dev/null 2>&1; echo %s:$?' % (
+                self._build_shell_command(entry['cmd'],
+                                          env=entry.get('env', env),
+                                          cwd=entry.get('cwd', cwd),
+                                          root=entry.get('root', root)),
+                quoted_end_marker)
+            if (script is not None and
+                len(script) + len(part) + 2 <= self.SHELL_BATCH_MAX_LENGTH):
+                script += '; ' + part
+                scripts[-1][1] += 1
+            else:
+                script = 'echo %s; %s' % (quoted_start_marker, part)
+                scripts.append([script, 1])
+            scripts[-1][0] = script
+
+        results = []
+        for script, count in scripts:
+            adb_process = None
+            try:
+                adb_process = self.shell(script, timeout=timeout)
+                if adb_process.timedout:
+                    raise ADBTimeoutError("%s" % adb_process)
+                output = adb_process.stdout_file.read()
+                pos = output.find(start_marker)
+                if pos == -1:
+                    raise ADBError("%s" % adb_process)
+                pos = output.find('\n', pos) + 1
+                for match in re_result.finditer(output, pos):
+                    results.append((int(match.group(2)), match.group(1)))
+                    count -= 1
+                results.extend([(None, '')] * count)
+            finally:
+                if adb_process:
+                    adb_process.stdout_file.close()
+                    adb_process.stderr_file.close()
+            if self._verbose:
+                self._logger.debug('shell_batch: %s, results: %s' %
+                                   (script, results))
+
+        return results
+
     def shell_bool(self, cmd, env=None, cwd=None, timeout=None, root=False):
         """Executes a shell command on the device returning True on success
         and False on failure.
@@ -1098,7 +1584,7 @@ class ADBDevice(ADBCommand):
 
             return output
         finally:
-            if adb_process and isinstance(adb_process.stdout_file, file):
+            if adb_process:
                 adb_process.stdout_file.close()
                 adb_process.stderr_file.close()
 
@@ -1156,6 +1642,33 @@ class ADBDevice(ADBCommand):
 
         return lines
 
+    def get_logcat_stream(self, filter_specs=['*:V'], format="time",
+                          max_lines=100000):
+        """Starts a long running adb logcat process for the device
+        returning an ADBLogcatStream which collects its output.
+
+        :param filter_specs: optional list containing logcat messages to
+            be included.
+        :param format: optional logcat format.
+        :param max_lines: optional maximum number of lines retained.
+        :returns: :class:`ADBLogcatStream`
+
+        The stream first returns the current contents of the device's
+        logcat and then any lines subsequently logged. The caller is
+        responsible for calling stop() on the returned object.
+
+        """
+        args = [self._adb_path]
+        if self._adb_host:
+            args.extend(['-H', self._adb_host])
+        if self._adb_port:
+            args.extend(['-P', str(self._adb_port)])
+        if self._device_serial:
+            args.extend(['-s', self._device_serial])
+        args.extend(["wait-for-device", "logcat", "-v", format] +
+                    filter_specs)
+        return ADBLogcatStream(args, max_lines)
+
     def get_prop(self, prop, timeout=None):
         """Gets value of a property from the device via adb shell getprop.
 
@@ -1171,9 +1684,49 @@ class ADBDevice(ADBCommand):
                  * ADBError
 
         """
+        if prop.startswith('ro.'):
+            # Read-only properties can not change until the device is
+            # rebooted and can be answered from the snapshot.
+            return self.get_props(timeout=timeout).get(prop, '')
         output = self.shell_output('getprop %s' % prop, timeout=timeout)
         return output
 
+    def get_props(self, timeout=None, refresh=False):
+        """Gets all of the properties of the device via a single adb shell
+        getprop.
+
+        :param timeout: optional integer specifying the maximum time in
+            seconds for any spawned adb process to complete before
+            throwing an ADBTimeoutError.
+            This timeout is per adb call. The total time spent
+            may exceed this value. If it is not specified, the value
+            set in the ADBDevice constructor is used.
+        :param refresh: optional boolean specifying if the properties
+            are to be read from the device even if a snapshot is
+            cached.
+        :returns: dictionary of property names and values.
+        :raises: * ADBTimeoutError
+                 * ADBError
+
+        The properties are cached until invalidate_props() is called,
+        which is done when the device is rebooted. Callers interested
+        in properties which may change at run time should use
+        get_prop() or pass refresh=True.
+
+        """
+        if self._props is None or refresh:
+            output = self.shell_output('getprop', timeout=timeout)
+            props = {}
+            for match in re.finditer(r'^\[([^\]]+)\]: \[(.*)\]\r?$',
+                                     output, re.MULTILINE):
+                props[match.group(1)] = match.group(2)
+            self._props = props
+        return self._props
+
+    def invalidate_props(self):
+        """Discards the cached snapshot of the device's properties."""
+        self._props = None
+
     def get_state(self, timeout=None):
         """Returns the device's state via adb get-state.
 
@@ -1584,7 +2137,7 @@ class ADBDevice(ADBCommand):
             self._logger.debug('get_process_list: %s' % ret)
             return ret
         finally:
-            if adb_process and isinstance(adb_process.stdout_file, file):
+            if adb_process:
                 adb_process.stdout_file.close()
                 adb_process.stderr_file.close()
 
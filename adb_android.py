@@ -148,6 +148,8 @@ class ADBAndroidMixin(object):
         to determine if the device has completed booting.
 
         """
+        self.close_shell_session()
+        self.invalidate_props()
         self.command_output(["reboot"], timeout=timeout)
         self.command_output(["wait-for-device"], timeout=timeout)
         return self.is_device_ready(timeout=timeout)
@@ -315,8 +317,7 @@ class ADBAndroidMixin(object):
                  * ADBError
 
         """
-        version = self.shell_output("getprop ro.build.version.release",
-                                    timeout=timeout, root=root)
+        version = self.get_prop("ro.build.version.release", timeout=timeout)
         if StrictVersion(version) >= StrictVersion('3.0'):
             self.shell_output("am force-stop %s" % app_name,
                               timeout=timeout, root=root)
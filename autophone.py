@@ -17,10 +17,12 @@ import signal
 import socket
 import sys
 import threading
+import time
 import traceback
 
 from manifestparser import TestManifest
 
+import buildindex
 import builds
 import buildserver
 import jobs
@@ -76,6 +78,11 @@ class PhoneData(object):
 
 class AutoPhone(object):
 
+    # Maximum number of builds trigger_builds looks up at the same time.
+    MAX_BUILD_LOOKUPS = 8
+    # Number of threads which look up the builds queued by new_job.
+    BUILD_RESOLVERS = 4
+
     class CmdTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
 
         allow_reuse_address = True
@@ -117,6 +124,12 @@ class AutoPhone(object):
 
         self._next_worker_num = 0
         self.jobs = jobs.Jobs(self.mailer)
+        # The builds announced by pulse or triggered are added to the
+        # build index so that trigger_runs.py can find them without
+        # crawling the build archive.
+        self.build_index = None
+        if options.build_index:
+            self.build_index = buildindex.BuildIndex(options.build_index)
         self.phone_workers = {}  # indexed by phone id
         self.lock = threading.RLock()
         self.shared_lock = multiprocessing.Lock()
@@ -136,6 +149,12 @@ class AutoPhone(object):
         # PhoneWorkerSubProcess workers.
         self.queue = multiprocessing.Queue()
 
+        # Queue of the builds to be tested. The build resolver threads
+        # look up the builds' data without holding the lock and then
+        # add their jobs. See new_job.
+        self.build_queue = Queue.Queue()
+        self.build_resolvers = []
+
         console_logger.info('Loading tests.')
         self.read_tests()
 
@@ -210,8 +229,26 @@ class AutoPhone(object):
                                               name='CmdTCPThread')
         self.server_thread.daemon = True
         self.server_thread.start()
+        self.start_build_resolvers()
         self.worker_msg_loop()
 
+    def start_build_resolvers(self):
+        for i in range(self.BUILD_RESOLVERS):
+            thread = threading.Thread(target=self.build_resolver,
+                                      name='BuildResolver-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self.build_resolvers.append(thread)
+
+    def stop_build_resolvers(self):
+        """Stop the build resolver threads after they have added the
+        jobs for the builds which are already queued."""
+        for thread in self.build_resolvers:
+            self.build_queue.put(None)
+        for thread in self.build_resolvers:
+            thread.join()
+        self.build_resolvers = []
+
     def check_for_dead_workers(self):
         if self.state != ProcessStates.RUNNING:
             return
@@ -335,6 +372,16 @@ class AutoPhone(object):
                 self.server.shutdown()
             if self.server_thread:
                 self.server_thread.join()
+            if self.state in (ProcessStates.RESTARTING,
+                              ProcessStates.SHUTTINGDOWN):
+                # Add the jobs for the queued builds so that they are
+                # not lost. The build resolvers need the lock to add
+                # them.
+                self.lock_release()
+                try:
+                    self.stop_build_resolvers()
+                finally:
+                    self.lock_acquire()
             for p in self.phone_workers.values():
                 p.stop()
             self.lock_release()
@@ -359,63 +406,139 @@ class AutoPhone(object):
 
             os.execvp(sys.executable, newargv)
 
-    # Start the phones for testing
-    def new_job(self, job_data):
-        logger.debug('new_job: %s' % job_data)
-        build_url = job_data['build']
-        tests = job_data['tests']
+    def resolve_build(self, build_url):
+        """Return the build data of build_url with its Treeherder
+        revision_hash added, or None if the build data was not found.
 
+        The lookups access the network and may be retried for minutes,
+        so this must not be called while holding the lock.
+        """
         build_data = utils.get_build_data(build_url)
-        logger.debug('new_job: build_data %s' % build_data)
+        logger.debug('resolve_build: build_data %s' % build_data)
 
         if not build_data:
-            logger.warning('new_job: Could not find build_data for %s' %
-                                build_url)
-            return
+            logger.warning('resolve_build: Could not find build_data for %s' %
+                           build_url)
+            return None
+
+        if self.build_index:
+            self.build_index.add_builds([{'url': build_url,
+                                          'tree': build_data['repo'],
+                                          'revision': build_data['revision'],
+                                          'build_id': build_data['id']}])
 
-        revision_hash = utils.get_treeherder_revision_hash(
+        build_data['revision_hash'] = utils.get_treeherder_revision_hash(
             self.options.treeherder_url,
             build_data['repo'],
             build_data['revision'])
 
-        logger.debug('new_job: revision_hash %s' % revision_hash)
-
-        phoneids = set([test.phone.id for test in tests])
-        for phoneid in phoneids:
-            p = self.phone_workers[phoneid]
-            logger.debug('new_job: worker phoneid %s' % phoneid)
-            # Determine if we will test this build, which tests to run and if we
-            # need to enable unittests.
-            runnable_tests = PhoneTest.match(tests=tests, phoneid=phoneid)
-            if not runnable_tests:
-                logger.debug('new_job: Ignoring build %s for phone %s' % (build_url, phoneid))
-                continue
-            enable_unittests = False
-            for t in runnable_tests:
-                enable_unittests = enable_unittests or t.enable_unittests
-
-            new_tests = self.jobs.new_job(build_url,
-                                          build_id=build_data['id'],
-                                          changeset=build_data['changeset'],
-                                          tree=build_data['repo'],
-                                          revision=build_data['revision'],
-                                          revision_hash=revision_hash,
-                                          tests=runnable_tests,
-                                          enable_unittests=enable_unittests,
-                                          device=phoneid)
+        logger.debug('resolve_build: revision_hash %s' %
+                     build_data['revision_hash'])
+        return build_data
+
+    # Start the phones for testing
+    def new_job(self, job_data):
+        """Queue the jobs for a build.
+
+        :param job_data: dict containing the build url and either the
+            tests to run or the pulse message announcing the build.
+
+        The build resolver threads look up the build without holding
+        the lock, so that a slow archive or Treeherder server does not
+        block the commands and the workers' messages, then add its
+        jobs.
+        """
+        logger.debug('new_job: %s' % job_data)
+        self.build_queue.put(job_data)
+
+    def build_resolver(self):
+        while True:
+            job_data = self.build_queue.get()
+            if job_data is None:
+                return
+            try:
+                self.resolve_job(job_data)
+            except Exception:
+                logger.exception('build_resolver: %s' % job_data)
+
+    def resolve_job(self, job_data):
+        build_url = job_data['build']
+        build_data = self.resolve_build(build_url)
+        if not build_data:
+            return
+        self.lock_acquire(data=build_url)
+        try:
+            if 'pulse' in job_data:
+                tests = self.match_pulse_tests(job_data['pulse'])
+            else:
+                tests = job_data['tests']
+            self.add_jobs([(build_url, build_data, tests)])
+        finally:
+            self.lock_release(data=build_url)
+
+    def add_jobs(self, builds):
+        """Add the jobs for the tests of each build to the jobs database
+        in a single transaction and notify the workers.
+
+        :param builds: list of (build_url, build_data, tests) tuples
+            where build_data was returned by resolve_build.
+
+        Returns a dict mapping each build_url to the list of the
+        (phoneid, job_id, new_tests) tuples of its jobs.
+        """
+        new_jobs = []
+        for build_url, build_data, tests in builds:
+            phoneids = set([test.phone.id for test in tests])
+            for phoneid in phoneids:
+                logger.debug('add_jobs: worker phoneid %s' % phoneid)
+                # Determine if we will test this build, which tests to run and if we
+                # need to enable unittests.
+                runnable_tests = PhoneTest.match(tests=tests, phoneid=phoneid)
+                if not runnable_tests:
+                    logger.debug('add_jobs: Ignoring build %s for phone %s' % (build_url, phoneid))
+                    continue
+                enable_unittests = False
+                for t in runnable_tests:
+                    enable_unittests = enable_unittests or t.enable_unittests
+
+                new_jobs.append({'build_url': build_url,
+                                 'build_id': build_data['id'],
+                                 'changeset': build_data['changeset'],
+                                 'tree': build_data['repo'],
+                                 'revision': build_data['revision'],
+                                 'revision_hash': build_data['revision_hash'],
+                                 'tests': runnable_tests,
+                                 'enable_unittests': enable_unittests,
+                                 'device': phoneid})
+
+        added = {}
+        for job, (job_id, new_tests) in zip(new_jobs,
+                                            self.jobs.new_jobs(new_jobs)):
+            build_url = job['build_url']
+            phoneid = job['device']
+            added.setdefault(build_url, []).append((phoneid, job_id, new_tests))
             if new_tests:
                 self.treeherder.submit_pending(phoneid,
                                                build_url,
-                                               build_data['repo'],
-                                               revision_hash,
+                                               job['tree'],
+                                               job['revision_hash'],
                                                tests=new_tests)
-                logger.info('new_job: Notifying device %s of new job '
-                                 '%s for tests %s, enable_unittests=%s.' %
-                                 (phoneid, build_url, runnable_tests,
-                                  enable_unittests))
-                p.new_job()
+                logger.info('add_jobs: Notifying device %s of new job '
+                                 '%s %s for tests %s, enable_unittests=%s.' %
+                                 (phoneid, job_id, build_url, job['tests'],
+                                  job['enable_unittests']))
+                # The worker may have been removed since its tests
+                # were matched.
+                if phoneid in self.phone_workers:
+                    self.phone_workers[phoneid].new_job(job_id)
+        return added
 
     def route_cmd(self, data):
+        cmd, space, params = data.strip().partition(' ')
+        if cmd.lower() == 'autophone-triggerbuilds':
+            # trigger_builds only takes the lock while it is not
+            # looking up the builds.
+            return self.trigger_builds(params)
         response = ''
         self.lock_acquire(data=data)
         try:
@@ -466,23 +589,7 @@ class AutoPhone(object):
         elif cmd == 'autophone-add-device':
             phoneid, space, serialno = params.partition(' ')
             try:
-                dm = ADBDevice(device=serialno,
-                               device_ready_retry_wait=self.options.device_ready_retry_wait,
-                               device_ready_retry_attempts=self.options.device_ready_retry_attempts,
-                               verbose=self.options.verbose)
-
-                dm.power_on()
-                device = {"device_name": phoneid,
-                          "serialno": serialno,
-                          "dm" : dm}
-                device['osver'] = dm.get_prop('ro.build.version.release')
-                device['hardware'] = dm.get_prop('ro.product.model')
-                device['abi'] = dm.get_prop('ro.product.cpu.abi')
-                try:
-                    sdk = int(dm.get_prop('ro.build.version.sdk'))
-                    device['sdk'] = 'api-9' if sdk <= 10 else 'api-11'
-                except ValueError:
-                    device['sdk'] = 'api-9'
+                device = self.init_device(phoneid, serialno)
                 self._devices[phoneid] = device
                 # We must reload the test manifest again to pick up the
                 # new device's test configuration.
@@ -511,6 +618,8 @@ class AutoPhone(object):
             response = self.trigger_jobs(params)
         elif cmd == 'autophone-status':
             response = 'state: %s\n' % self.state
+            response += 'http cache: %s\n' % utils.http_cache
+            response += 'build queue: %d\n' % self.build_queue.qsize()
             phoneids = self.phone_workers.keys()
             phoneids.sort()
             for i in phoneids:
@@ -539,6 +648,11 @@ autophone-shutdown
 autophone-status
     Generate a status report for each device.
 
+autophone-triggerbuilds <json>
+    Trigger the tests for several builds. <json> is an object with
+    builds, test_names and devices lists. Responds with a json list
+    of the number of jobs and tests added for each build.
+
 autophone-stop
     Immediately stop autophone and all worker processes; may be
     delayed by pending download.
@@ -667,35 +781,136 @@ ok
             logger.exception('register_cmd:')
             self.stop()
 
+    def init_device(self, device_name, serialno):
+        """Connect to the device, power it on and collect its
+        properties returning the device dictionary used by
+        register_cmd."""
+        dm = ADBDevice(device=serialno,
+                       device_ready_retry_wait=self.options.device_ready_retry_wait,
+                       device_ready_retry_attempts=self.options.device_ready_retry_attempts,
+                       verbose=self.options.verbose,
+                       use_shell_session=self.options.device_shell_session)
+        dm.power_on()
+        device = {"device_name": device_name,
+                  "serialno": serialno,
+                  "dm" : dm}
+        props = dm.get_props()
+        device['osver'] = props.get('ro.build.version.release', '')
+        device['hardware'] = props.get('ro.product.model', '')
+        device['abi'] = props.get('ro.product.cpu.abi', '')
+        try:
+            sdk = int(props.get('ro.build.version.sdk', ''))
+            device['sdk'] = 'api-9' if sdk <= 10 else 'api-11'
+        except ValueError:
+            device['sdk'] = 'api-9'
+        # The worker subprocess will start its own shell session.
+        dm.close_shell_session()
+        return device
+
     def read_devices(self):
+        """Initialize the devices listed in the devices ini file.
+
+        The devices are initialized concurrently by at most
+        options.device_init_concurrency threads. Each device is
+        registered as soon as its initialization completes. A device
+        which has not completed its initialization within
+        options.device_init_timeout seconds is skipped and its thread
+        is abandoned and replaced so that it does not hold up the
+        remaining devices. An abandoned thread exits without
+        initializing another device if its device ever completes, so
+        no more than options.device_init_concurrency threads take
+        devices from the pending queue.
+        """
         cfg = ConfigParser.RawConfigParser()
         cfg.read(self.options.devicescfg)
 
+        pending = Queue.Queue()
+        results = Queue.Queue()
+        started = {} # start times indexed by device name
+        abandoned = set() # names of the devices which timed out
+        started_lock = threading.Lock()
+        remaining = set()
         for device_name in cfg.sections():
             # failure for a device to have a serialno option is fatal.
             serialno = cfg.get(device_name, 'serialno')
-            console_logger.info("Initializing device name=%s, serialno=%s" % (device_name, serialno))
-            try:
-                dm = ADBDevice(device=serialno,
-                               device_ready_retry_wait=self.options.device_ready_retry_wait,
-                               device_ready_retry_attempts=self.options.device_ready_retry_attempts,
-                               verbose=self.options.verbose)
-                dm.power_on()
-                device = {"device_name": device_name,
-                          "serialno": serialno,
-                          "dm" : dm}
-                device['osver'] = dm.get_prop('ro.build.version.release')
-                device['hardware'] = dm.get_prop('ro.product.model')
-                device['abi'] = dm.get_prop('ro.product.cpu.abi')
+            pending.put((device_name, serialno))
+            remaining.add(device_name)
+
+        def initializer():
+            device_name = None
+            while True:
+                with started_lock:
+                    if device_name in abandoned:
+                        # This thread has been replaced.
+                        return
+                    try:
+                        device_name, serialno = pending.get_nowait()
+                    except Queue.Empty:
+                        return
+                    started[device_name] = time.time()
+                console_logger.info("Initializing device name=%s, serialno=%s" % (device_name, serialno))
                 try:
-                    sdk = int(dm.get_prop('ro.build.version.sdk'))
-                    device['sdk'] = 'api-9' if sdk <= 10 else 'api-11'
-                except ValueError:
-                    device['sdk'] = 'api-9'
-                self._devices[device_name] = device
-                self.register_cmd(device)
-            except (ADBError, ADBTimeoutError), e:
-                console_logger.error('Unable to add device due to %s.' % e.message)
+                    result = (device_name,
+                              self.init_device(device_name, serialno),
+                              None)
+                except (ADBError, ADBTimeoutError), e:
+                    result = (device_name, None, e.message)
+                except Exception, e:
+                    logger.exception('read_devices: %s' % device_name)
+                    result = (device_name, None, '%s' % e)
+                with started_lock:
+                    started.pop(device_name, None)
+                results.put(result)
+
+        def start_initializer():
+            thread = threading.Thread(target=initializer,
+                                      name='DeviceInitializer')
+            thread.daemon = True
+            thread.start()
+
+        for i in range(min(self.options.device_init_concurrency,
+                           len(remaining))):
+            start_initializer()
+
+        timeout = self.options.device_init_timeout
+        while remaining:
+            with started_lock:
+                deadlines = [started[name] + timeout for name in remaining
+                             if name in started]
+            if deadlines:
+                wait = max(0, min(deadlines) - time.time())
+            else:
+                wait = timeout
+            try:
+                device_name, device, error = results.get(timeout=wait)
+            except Queue.Empty:
+                now = time.time()
+                with started_lock:
+                    expired = [name for name in remaining
+                               if name in started and
+                               started[name] + timeout <= now]
+                    for device_name in expired:
+                        del started[device_name]
+                        abandoned.add(device_name)
+                    replacements = min(len(expired), pending.qsize())
+                for device_name in expired:
+                    console_logger.error('Unable to add device %s: '
+                                         'initialization did not complete '
+                                         'within %d seconds.' %
+                                         (device_name, timeout))
+                    remaining.discard(device_name)
+                for i in range(replacements):
+                    start_initializer()
+                continue
+            if device_name not in remaining:
+                # The device was already skipped due to a timeout.
+                continue
+            remaining.discard(device_name)
+            if error:
+                console_logger.error('Unable to add device due to %s.' % error)
+                continue
+            self._devices[device_name] = device
+            self.register_cmd(device)
 
     def read_tests(self):
         self._tests = []
@@ -757,19 +972,14 @@ ok
             self._tests.extend(tests)
 
 
-    def trigger_jobs(self, data):
-        logger.info('Received user-specified job: %s' % data)
-        trigger_data = json.loads(data)
-        if 'build' not in trigger_data:
-            return 'invalid args'
-        build_url = trigger_data['build']
+    def match_trigger_tests(self, build_url, test_names, devices):
+        """Return the tests matching build_url, test_names and devices
+        of a user-specified job."""
         tests = []
-        test_names = trigger_data['test_names']
         if not test_names:
             # No test names specified, force PhoneTest.match
             # to return tests with any name.
             test_names = [None]
-        devices = trigger_data['devices']
         if not devices:
             # No devices specified, force PhoneTest.match
             # to return tests for any device.
@@ -779,6 +989,17 @@ ok
                 tests.extend(PhoneTest.match(test_name=test_name,
                                              phoneid=device,
                                              build_url=build_url))
+        return tests
+
+    def trigger_jobs(self, data):
+        logger.info('Received user-specified job: %s' % data)
+        trigger_data = json.loads(data)
+        if 'build' not in trigger_data:
+            return 'invalid args'
+        build_url = trigger_data['build']
+        tests = self.match_trigger_tests(build_url,
+                                         trigger_data['test_names'],
+                                         trigger_data['devices'])
         if tests:
             job_data = {
                 'build': build_url,
@@ -787,39 +1008,103 @@ ok
             self.new_job(job_data)
         return 'ok'
 
+    def trigger_builds(self, data):
+        """Trigger the jobs for several user-specified builds.
+
+        data is a json object with builds, test_names and devices
+        lists. The builds are looked up concurrently without holding
+        the lock, which is only taken to match their tests and to add
+        all of their jobs in a single transaction.
+
+        Returns a json list of dicts containing the build, the number
+        of jobs and tests added for it and an error or None.
+        """
+        logger.info('Received user-specified builds: %s' % data)
+        try:
+            trigger_data = json.loads(data)
+            build_urls = trigger_data['builds']
+        except (ValueError, KeyError, TypeError):
+            return 'invalid args'
+        test_names = trigger_data.get('test_names')
+        devices = trigger_data.get('devices')
+
+        summary = []
+        seen = set()
+        for build_url in build_urls:
+            if build_url not in seen:
+                seen.add(build_url)
+                summary.append({'build': build_url, 'jobs': 0, 'tests': 0,
+                                'error': None})
+
+        self.lock_acquire(data='trigger_builds')
+        try:
+            build_tests = {}
+            for item in summary:
+                build_tests[item['build']] = self.match_trigger_tests(
+                    item['build'], test_names, devices)
+        finally:
+            self.lock_release(data='trigger_builds')
+
+        build_data = dict(builds.fetch_concurrently(
+            self.resolve_build,
+            [build_url for build_url in build_tests if build_tests[build_url]],
+            self.MAX_BUILD_LOOKUPS))
+
+        self.lock_acquire(data='trigger_builds')
+        try:
+            added = self.add_jobs([(build_url, build_data[build_url],
+                                    build_tests[build_url])
+                                   for build_url in build_data
+                                   if build_data[build_url]])
+        finally:
+            self.lock_release(data='trigger_builds')
+
+        for item in summary:
+            build_url = item['build']
+            if not build_tests[build_url]:
+                item['error'] = 'no matching tests'
+            elif not build_data[build_url]:
+                item['error'] = 'build data not found'
+            else:
+                for phoneid, job_id, new_tests in added.get(build_url, []):
+                    if new_tests:
+                        item['jobs'] += 1
+                        item['tests'] += len(new_tests)
+        return json.dumps(summary)
+
     def reset_phones(self):
         logger.info('Resetting phones...')
         for phoneid, phone in self.phone_workers.iteritems():
             phone.reboot()
 
     def on_build(self, msg):
-        self.lock_acquire()
-        try:
-            if self.state != ProcessStates.RUNNING:
-                return
-            logger.debug('PULSE BUILD FOUND %s' % msg)
-            build_url = msg['packageUrl']
-            if msg['branch'] != 'try':
-                tests = PhoneTest.match(build_url=build_url)
-            else:
-                # Autophone try builds will have a comment of the form:
-                # try: -b o -p android-api-9,android-api-11 -u autophone-smoke,autophone-s1s2 -t none
-                tests = []
-                reTests = re.compile('try:.* -u (.*) -t.*')
-                match = reTests.match(msg['comments'])
-                if match:
-                    test_names = [t for t in match.group(1).split(',')
-                                  if t.startswith('autophone-')]
-                    if 'autophone-tests' in test_names:
-                        # Match all test names
-                        test_names = [None]
-                    for test_name in test_names:
-                        tests.extend(PhoneTest.match(test_name=test_name,
-                                                     build_url=build_url))
-            job_data = {'build': build_url, 'tests': tests}
-            self.new_job(job_data)
-        finally:
-            self.lock_release()
+        if self.state != ProcessStates.RUNNING:
+            return
+        logger.debug('PULSE BUILD FOUND %s' % msg)
+        job_data = {'build': msg['packageUrl'], 'pulse': msg}
+        self.new_job(job_data)
+
+    def match_pulse_tests(self, msg):
+        """Return the tests to run for the build announced by the pulse
+        message msg."""
+        build_url = msg['packageUrl']
+        if msg['branch'] != 'try':
+            return PhoneTest.match(build_url=build_url)
+        # Autophone try builds will have a comment of the form:
+        # try: -b o -p android-api-9,android-api-11 -u autophone-smoke,autophone-s1s2 -t none
+        tests = []
+        reTests = re.compile('try:.* -u (.*) -t.*')
+        match = reTests.match(msg['comments'])
+        if match:
+            test_names = [t for t in match.group(1).split(',')
+                          if t.startswith('autophone-')]
+            if 'autophone-tests' in test_names:
+                # Match all test names
+                test_names = [None]
+            for test_name in test_names:
+                tests.extend(PhoneTest.match(test_name=test_name,
+                                             build_url=build_url))
+        return tests
 
     def on_jobaction(self, job_action):
         self.lock_acquire()
@@ -994,6 +1279,9 @@ def main(options):
     adbhost.start_server()
 
 
+    if options.http_cache_dir:
+        utils.http_cache = utils.HttpCache(cache_dir=options.http_cache_dir)
+
     product = 'fennec'
     build_platforms = ['android',
                        'android-api-9',
@@ -1012,6 +1300,8 @@ def main(options):
             override_build_dir=options.override_build_dir,
             build_cache_size=options.build_cache_size,
             build_cache_expires=options.build_cache_expires,
+            build_cache_max_downloads=options.build_cache_max_downloads,
+            build_cache_max_bytes=options.build_cache_max_bytes,
             treeherder_url=options.treeherder_url)
     except builds.BuildCacheException, e:
         print '''%s
@@ -1061,6 +1351,7 @@ unpacked tests package for the build.
     console_logger.info('Shutting down build-cache server...')
     build_cache_server.shutdown()
     build_cache_server_thread.join()
+    build_cache.close()
     console_logger.info('Done.')
     return 0
 
@@ -59,12 +59,33 @@ class AutophoneCrashProcessor(object):
         """Minidump directory in Firefox profile."""
         return os.path.join(self.remote_profile_dir, 'minidumps')
 
+    def _delete_anr_traces_cmds(self):
+        return ['rm %s' % traces,
+                'echo > %s' % traces,
+                'chmod 666 %s' % traces]
+
+    def _delete_tombstones_cmds(self):
+        return ['rm -r %s' % tombstones]
+
+    def _delete_crash_dumps_cmds(self):
+        return ['rm -r %s' % os.path.join(self.remote_dump_dir, '*')]
+
+    def _check_anr_traces_results(self, results):
+        """Warns if the ANR traces file could not be recreated. The
+        results of removing the file are ignored since it need not
+        exist."""
+        for exitcode, output in results[1:]:
+            if exitcode != 0:
+                logger.warning("Could not initialize ANR traces %s, %s" %
+                               (traces, output))
+                break
+
     def delete_anr_traces(self, root=True):
         """Empty ANR traces.txt file."""
         try:
-            self.adb.rm(traces, root=root)
-            self.adb.shell_output('echo > %s' % traces, root=root)
-            self.adb.chmod(traces, mask='666', root=root)
+            self._check_anr_traces_results(
+                self.adb.shell_batch(self._delete_anr_traces_cmds(),
+                                     root=root))
         except ADBError, e:
             logger.warning("Could not initialize ANR traces %s, %s" % (traces, e))
 
@@ -95,18 +116,32 @@ class AutophoneCrashProcessor(object):
 
     def delete_tombstones(self, root=True):
         """Deletes any existing tombstone files from device."""
-        self.adb.rm(tombstones, force=True, recursive=True, root=root)
+        try:
+            self.adb.shell_batch(self._delete_tombstones_cmds(), root=root)
+        except ADBError, e:
+            logger.debug("Could not delete tombstones: %s" % e)
 
     def delete_crash_dumps(self, root=True):
         """Deletes any existing crash dumps in the Firefox profile."""
-        self.adb.rm(os.path.join(self.remote_profile_dir, 'minidumps', '*'),
-                    force=True, recursive=True, root=root)
+        try:
+            self.adb.shell_batch(self._delete_crash_dumps_cmds(), root=root)
+        except ADBError, e:
+            logger.debug("Could not delete crash dumps: %s" % e)
 
-    def clear(self):
+    def clear(self, root=True):
         """Delete any existing ANRs, tombstones and crash dumps on the device."""
-        self.delete_anr_traces()
-        self.delete_tombstones()
-        self.delete_crash_dumps()
+        anr_cmds = self._delete_anr_traces_cmds()
+        try:
+            results = self.adb.shell_batch(anr_cmds +
+                                           self._delete_tombstones_cmds() +
+                                           self._delete_crash_dumps_cmds(),
+                                           root=root)
+            # Failing to remove non-existent tombstones or crash dumps
+            # is not an error.
+            self._check_anr_traces_results(results[:len(anr_cmds)])
+        except ADBError, e:
+            logger.warning("Could not clear ANR traces, tombstones and "
+                           "crash dumps: %s" % e)
 
     def check_for_tombstones(self, root=True):
         """Copies tombstones from the device to the upload_dir before deleting
@@ -263,7 +298,9 @@ class AutophoneCrashProcessor(object):
         Note that the crash dumps are deleted as a side effect.
 
         :param symbols_path: path on host to the directory
-            containing the symbols for the Firefox build being tested.
+            containing the symbols for the Firefox build being tested
+            or a callable returning the path. The callable is only
+            called if there are crash dumps to process.
         :param stackwalk_binary: path on host to the
             minidump_stackwalk binary to be used to parse the dump files.
         :param clean: If True, remove dump files after processing.
@@ -302,6 +339,8 @@ class AutophoneCrashProcessor(object):
             logger.warning("Found %d dump files -- limited to %d!" % (len(dump_files), max_dumps))
             del dump_files[max_dumps:]
         logger.debug('AutophoneCrashProcessor.dump_files: %s' % dump_files)
+        if dump_files and callable(symbols_path):
+            symbols_path = symbols_path()
         for path, extra in dump_files:
             info = self._process_dump_file(path, extra, symbols_path, stackwalk_binary, clean=clean)
             stackwalk_output = ["Crash dump filename: %s" % info.minidump_path]
@@ -330,7 +369,8 @@ class AutophoneCrashProcessor(object):
         upload_dir before being deleted from the device.
 
         :param symbols_path: path on host to the directory
-            containing the symbols for the Firefox build being tested.
+            containing the symbols for the Firefox build being tested
+            or a callable returning the path. See get_crashes.
         :param stackwalk_binary: path on host to the
             minidump_stackwalk binary to be used to parse the dump files.
         :param clean: If True, remove dump files after processing.
@@ -0,0 +1,239 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from build_dates import (TIMESTAMP, convert_buildid_to_date,
+                         convert_datetime_to_string)
+
+# Set the logger globally in the file, but this must be reset when
+# used in a child process.
+logger = logging.getLogger()
+
+platform_regex = re.compile(r'\.(android-[^./]+)\.[^./]+$')
+
+
+class BuildIndex(object):
+    """A persistent index of the builds in the build archives.
+
+    BuildLocation adds the builds it finds in the build directories
+    it lists and the build ids and revisions it reads from their .txt
+    files. AutoPhone adds the builds it is notified of by pulse or
+    triggered to test. The find_builds_* methods of BuildLocation use
+    the index to avoid listing build directories and reading .txt
+    files they have already seen, or to answer a query without
+    crawling the archive at all.
+
+    A build directory is only known to contain all of its builds once
+    BuildLocation has listed it, see add_listed_directories. The
+    builds added by AutoPhone do not make their directories complete.
+
+    Since the index is only a cache of the archive, database errors
+    are logged and treated as if the builds were not indexed.
+    """
+
+    FILENAME = 'builds.sqlite'
+    # Number of seconds sqlite waits for a lock held by another
+    # connection before raising OperationalError.
+    SQL_BUSY_TIMEOUT = 60
+    # Maximum number of values in an sqlite "in" expression.
+    SQL_MAX_VALUES = 500
+    # Version of the database schema stored in the user_version pragma.
+    SCHEMA_VERSION = 2
+    # Number of seconds after the timestamp of a build directory after
+    # which all of its builds are expected to have been uploaded. A
+    # directory listed earlier is listed again by later searches.
+    UPLOAD_PERIOD = 6*60*60
+
+    def __init__(self, filename=FILENAME):
+        self.filename = filename
+        self._local = threading.local()
+        try:
+            conn = self._conn()
+            conn.execute('pragma journal_mode=wal')
+            version = conn.execute('pragma user_version').fetchone()[0]
+            if version < 1:
+                conn.execute('create table if not exists builds ('
+                             'url text primary key, '
+                             'directory text, '
+                             'build_id text, '
+                             'tree text, '
+                             'revision text, '
+                             'platform text, '
+                             'build_type text, '
+                             'timestamp int)')
+                conn.execute('create index if not exists builds_directory '
+                             'on builds(directory)')
+                conn.execute('create index if not exists builds_timestamp '
+                             'on builds(timestamp)')
+                conn.execute('create index if not exists builds_revision '
+                             'on builds(revision)')
+            if version < 2:
+                conn.execute('create table if not exists directories ('
+                             'directory text primary key, '
+                             'timestamp int, '
+                             'listed_at int)')
+                conn.execute('pragma user_version=%d' % self.SCHEMA_VERSION)
+            conn.commit()
+        except sqlite3.Error:
+            logger.exception('BuildIndex: unable to open %s' % filename)
+
+    def _conn(self):
+        """Return the current thread's connection to the index,
+        opening it on first use. See Jobs._conn.
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn and self._local.pid == os.getpid():
+            conn.rollback()
+            return conn
+        conn = sqlite3.connect(self.filename, timeout=self.SQL_BUSY_TIMEOUT)
+        conn.row_factory = sqlite3.Row
+        conn.execute('pragma synchronous=normal')
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    def close(self):
+        """Close the current thread's connection to the index."""
+        conn = getattr(self._local, 'conn', None)
+        if conn and self._local.pid == os.getpid():
+            conn.close()
+        self._local.conn = None
+
+    def add_builds(self, builds):
+        """Add builds to the index or update the builds already indexed.
+
+        :param builds: list of dicts each containing a url item and
+            optionally tree, build_id, revision and timestamp items,
+            the number of seconds since the epoch of the build's
+            directory. Items which are None or missing do not replace
+            the indexed values. If the build has no timestamp, the
+            time of its build id is used.
+        """
+        rows = []
+        for build in builds:
+            url = build['url']
+            match = platform_regex.search(url)
+            build_time = None
+            if build.get('build_id'):
+                build_time = convert_buildid_to_date(build['build_id'])
+            if build_time:
+                build_time = int(convert_datetime_to_string(build_time,
+                                                            TIMESTAMP))
+            rows.append({'url': url,
+                         'directory': url[:url.rindex('/') + 1],
+                         'build_id': build.get('build_id'),
+                         'tree': build.get('tree'),
+                         'revision': build.get('revision'),
+                         'platform': match.group(1) if match else None,
+                         'build_type': 'debug' if 'debug' in url else 'opt',
+                         'timestamp': build.get('timestamp'),
+                         'build_time': build_time})
+        if not rows:
+            return
+        try:
+            conn = self._conn()
+            conn.executemany('insert or ignore into builds '
+                             '(url, directory, platform, build_type) '
+                             'values (:url, :directory, :platform, :build_type)',
+                             rows)
+            conn.executemany('update builds set '
+                             'build_id=coalesce(:build_id, build_id), '
+                             'tree=coalesce(:tree, tree), '
+                             'revision=coalesce(:revision, revision), '
+                             'timestamp=coalesce(:timestamp, timestamp, '
+                             ':build_time) '
+                             'where url=:url', rows)
+            conn.commit()
+        except sqlite3.Error:
+            logger.exception('BuildIndex.add_builds')
+
+    def add_listed_directories(self, directories):
+        """Record that build directories have been listed and that
+        the builds found in them have been added to the index.
+
+        :param directories: dict mapping each build directory to its
+            timestamp, the number of seconds since the epoch.
+        """
+        if not directories:
+            return
+        listed_at = int(time.time())
+        try:
+            conn = self._conn()
+            conn.executemany('insert or replace into directories '
+                             '(directory, timestamp, listed_at) '
+                             'values (?, ?, ?)',
+                             [(directory, timestamp, listed_at)
+                              for directory, timestamp in directories.iteritems()])
+            conn.commit()
+        except sqlite3.Error:
+            logger.exception('BuildIndex.add_listed_directories')
+
+    def _select(self, column, values):
+        """Return the indexed builds whose column is one of values."""
+        builds = []
+        values = list(values)
+        try:
+            conn = self._conn()
+            for i in range(0, len(values), self.SQL_MAX_VALUES):
+                chunk = values[i:i + self.SQL_MAX_VALUES]
+                cursor = conn.execute(
+                    'select * from builds where %s in (%s)' % (
+                        column, ','.join('?' * len(chunk))), chunk)
+                builds.extend([dict(row) for row in cursor])
+        except sqlite3.Error:
+            logger.exception('BuildIndex._select')
+        return builds
+
+    def get_builds(self, urls):
+        """Return a dict mapping each of the urls which is indexed to a
+        dict of its indexed values."""
+        return dict([(build['url'], build)
+                     for build in self._select('url', urls)])
+
+    def get_directories(self, directories):
+        """Return a dict mapping each of the build directories which
+        was listed at least UPLOAD_PERIOD seconds after its timestamp
+        to the list of the urls of its builds."""
+        result = {}
+        directories = list(directories)
+        try:
+            conn = self._conn()
+            for i in range(0, len(directories), self.SQL_MAX_VALUES):
+                chunk = directories[i:i + self.SQL_MAX_VALUES]
+                cursor = conn.execute(
+                    'select directory from directories where '
+                    'listed_at >= timestamp + ? and directory in (%s)' %
+                    ','.join('?' * len(chunk)),
+                    [self.UPLOAD_PERIOD] + chunk)
+                for row in cursor:
+                    result[row['directory']] = []
+        except sqlite3.Error:
+            logger.exception('BuildIndex.get_directories')
+            return {}
+        for build in self._select('directory', result.keys()):
+            result[build['directory']].append(build['url'])
+        for urls in result.values():
+            urls.sort()
+        return result
+
+    def find_builds(self, prefix, start_timestamp, end_timestamp):
+        """Return the list of dicts of the indexed values of the builds
+        whose urls begin with prefix and whose timestamps are between
+        start_timestamp and end_timestamp ordered by timestamp."""
+        try:
+            conn = self._conn()
+            cursor = conn.execute(
+                'select * from builds where timestamp between ? and ? '
+                'and substr(url, 1, ?) = ? order by timestamp, url',
+                (start_timestamp, end_timestamp, len(prefix), prefix))
+            return [dict(row) for row in cursor]
+        except sqlite3.Error:
+            logger.exception('BuildIndex.find_builds')
+            return []
@@ -3,29 +3,35 @@
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import ConfigParser
+import HTMLParser
+import Queue
+import StringIO
 import base64
 import datetime
+import errno
 import glob
+import hashlib
+import httplib
 import json
 import logging
 import math
 import os
 import re
 import shutil
+import socket
+import sys
 import tempfile
+import threading
 import time
 import urllib
 import urllib2
 import urlparse
 import zipfile
 
-from bs4 import BeautifulSoup
-
 import utils
 from build_dates import (TIMESTAMP, DIRECTORY_DATE, DIRECTORY_DATETIME,
                          parse_datetime, convert_datetime_to_string,
-                         set_time_zone, convert_buildid_to_date,
-                         convert_timestamp_to_date)
+                         set_time_zone, convert_timestamp_to_date)
 
 # Set the logger globally in the file, but this must be reset when
 # used in a child process.
@@ -44,28 +50,96 @@ repo_urls = {
 
 urls_repos = dict([(url, repo) for repo, url in repo_urls.items()])
 
+# The links of the build directories parsed by url_links are cached
+# for LINKS_TTL seconds since the same build directories are listed
+# repeatedly when searching for builds. The search directories are not
+# cached, since new build directories are added to them as builds
+# complete.
+LINKS_TTL = 5*60
+_links_cache = {}
+_links_lock = threading.Lock()
+
+
+class Link(object):
+    """A link found by parse_links. It provides the get and get_text
+    methods of the BeautifulSoup tags previously returned by
+    url_links."""
+
+    __slots__ = ('href', 'text')
+
+    def __init__(self, href, text):
+        self.href = href
+        self.text = text
+
+    def get(self, name, default=None):
+        if name == 'href':
+            return self.href
+        return default
+
+    def get_text(self):
+        return self.text
+
+
+# Directory listings are generated by the server, so their anchors
+# can be found with a regular expression instead of parsing the page.
+anchor_regex = re.compile(r'<a\s[^>]*?\bhref\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s>]+))'
+                          r'[^>]*>(.*?)</a\s*>', re.IGNORECASE | re.DOTALL)
+tag_regex = re.compile(r'<[^>]*>')
+_html_parser = HTMLParser.HTMLParser()
+
+
+def parse_links(content):
+    """A generator which returns a Link for each of the anchors with
+    an href in the html content as it is found."""
+    if isinstance(content, str):
+        content = content.decode('utf-8', 'replace')
+    for match in anchor_regex.finditer(content):
+        href = match.group(1)
+        if href is None:
+            href = match.group(2)
+        if href is None:
+            href = match.group(3)
+        text = tag_regex.sub('', match.group(4))
+        yield Link(_html_parser.unescape(href), _html_parser.unescape(text))
+
+
 # lifted from mozregression:utils.py:urlLinks
-def url_links(url):
+def url_links(url, ttl=0):
     """Return list of all non-navigation links found in web page.
 
     arguments:
     url - location of web page.
+    ttl - number of seconds the links are cached, 0 to not cache them.
 
-    returns: list of BeautifulSoup links.
+    returns: list of Links.
     """
+    now = time.time()
+    with _links_lock:
+        cached = _links_cache.get(url)
+    if cached and cached[0] > now:
+        return list(cached[1])
+
     content = utils.get_remote_text(url)
     if not content:
         return []
 
-    soup = BeautifulSoup(content)
     # do not return a generator but an array, so we can store it for later use
-    return [link for link in soup.findAll('a')
-            if not link.get('href').startswith('?') and
-            link.get_text() != 'Parent Directory']
-
-def get_revision_timestamps(repo, first_revision, last_revision):
-    """Returns a tuple containing timestamps for the revisions from
-    the given repo.
+    links = [link for link in parse_links(content)
+             if not link.get('href').startswith('?') and
+             link.get_text() != 'Parent Directory']
+    with _links_lock:
+        for expired_url in [u for u, (expires, l) in _links_cache.iteritems()
+                            if expires <= now]:
+            del _links_cache[expired_url]
+        if ttl > 0:
+            _links_cache[url] = (now + ttl, links)
+    return list(links)
+
+def get_revision_pushes(repo, first_revision, last_revision):
+    """Returns a dict mapping the changesets pushed to the given repo
+    from the push of first_revision through the push of last_revision
+    to the datetime of their push or None if the pushlog could not be
+    retrieved. The changesets are abbreviated to 12 characters.
 
     arguments:
     repo            - name of repository. For example, one of
@@ -73,24 +147,81 @@ def get_revision_timestamps(repo, first_revision, last_revision):
                       mozilla-inbound, fx-team, b2g-inbound
     first_revision  - string.
     last_revision - string.
-
-    returns: first_timestamp, last_timestamp.
     """
-    prefix = '%sjson-pushes?changeset=' % repo_urls[repo]
-    first = utils.get_remote_json('%s%s' % (prefix, first_revision))
-    last = utils.get_remote_json('%s%s' % (prefix, last_revision))
-
-    return first[first.keys()[0]]['date'], last[last.keys()[0]]['date']
+    prefix = '%sjson-pushes?' % repo_urls[repo]
+    first = utils.get_remote_json('%schangeset=%s' % (prefix, first_revision))
+    pushes = utils.get_remote_json('%sfromchange=%s&tochange=%s' % (
+        prefix, first_revision, last_revision))
+    if not first or pushes is None:
+        return None
+    revisions = {}
+    for push in first.values() + pushes.values():
+        push_datetime = convert_timestamp_to_date(push['date'])
+        for changeset in push['changesets']:
+            revisions[changeset[:12]] = push_datetime
+    return revisions
+
+
+def fetch_concurrently(func, args, max_fetches):
+    """A generator which returns a (arg, func(arg)) tuple for each of
+    args as soon as it is available. func is called by up to
+    max_fetches threads at the same time. If func raises an exception,
+    it is logged and the result is None.
+    """
+    args = list(args)
+    pending = Queue.Queue()
+    for arg in args:
+        pending.put(arg)
+    fetched = Queue.Queue()
+    cancel = threading.Event()
+
+    def fetcher():
+        while not cancel.is_set():
+            try:
+                arg = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                result = func(arg)
+            except Exception:
+                logger.exception('fetch_concurrently: %s(%s)' % (
+                    func.__name__, arg))
+                result = None
+            fetched.put((arg, result))
+
+    for i in range(min(max_fetches, len(args))):
+        thread = threading.Thread(target=fetcher,
+                                  name='%s-%d' % (func.__name__, i))
+        thread.daemon = True
+        thread.start()
+    try:
+        for i in range(len(args)):
+            yield fetched.get()
+    finally:
+        # Stop fetching if the caller stops early.
+        cancel.set()
 
 
 class BuildLocation(object):
+    # Maximum number of directory listings or build .txt files
+    # fetched at the same time.
+    MAX_FETCHES = 8
+    # The build directories searched for the builds of a revision
+    # range are those from REVISION_WINDOW_BEFORE before the push of
+    # the first revision to REVISION_WINDOW_AFTER after the push of
+    # the last revision.
+    REVISION_WINDOW_BEFORE = datetime.timedelta(hours=1)
+    REVISION_WINDOW_AFTER = datetime.timedelta(hours=12)
+
     def __init__(self, repos, buildtypes,
-                 product, build_platforms, buildfile_ext):
+                 product, build_platforms, buildfile_ext,
+                 build_index=None):
         self.repos = repos
         self.buildtypes = buildtypes
         self.product = product
         self.build_platforms = build_platforms
         self.buildfile_ext = buildfile_ext
+        self.build_index = build_index
         buildfile_pattern = self.product + '.*\.('
         for platform in self.build_platforms:
             if platform.startswith('android-x86'):
@@ -150,10 +281,16 @@ class BuildLocation(object):
         """
         raise NotImplementedError()
 
-    def find_latest_builds(self):
+    def is_build_directory_name(self, directory_name):
+        """Returns True if directory_name is the name of a build
+        directory in a search directory of this location.
+        """
+        return self.build_time_from_directory_name(directory_name) is not None
+
+    def find_latest_builds(self, crawl=True):
         window = datetime.timedelta(days=3)
         now = datetime.datetime.now()
-        builds = self.find_builds_by_time(now - window, now)
+        builds = self.find_builds_by_time(now - window, now, crawl=crawl)
         if not builds:
             logger.error('Could not find any nightly builds in the last '
                          '%d days!' % window.days)
@@ -212,23 +349,109 @@ class BuildLocation(object):
         logger.debug('find_builds_by_directory: builds %s' % builds)
         return builds
 
-    def find_builds_by_time(self, start_time, end_time):
+    def url_links(self, url):
+        """Return the links of the directory url. The links of build
+        directories are cached for LINKS_TTL seconds."""
+        if self.is_build_directory_name(url.rstrip('/').split('/')[-1]):
+            return url_links(url, ttl=LINKS_TTL)
+        return url_links(url)
+
+    def fetch_links(self, urls):
+        """A generator which returns a (url, links) tuple for each of
+        the urls as soon as its links have been fetched by url_links.
+        """
+        for url, links in fetch_concurrently(self.url_links, urls,
+                                             self.MAX_FETCHES):
+            yield url, links or []
+
+    def build_urls(self, directory, links):
+        """Returns the urls of the builds of any platform in the build
+        directory with the given links."""
+        urls = []
+        for link in links:
+            filename = link.get_text()
+            if (filename.startswith(self.product) and
+                filename.endswith(self.buildfile_ext)):
+                urls.append('%s%s' % (directory, filename))
+        return urls
+
+    def match_build(self, build_urls):
+        """Returns the first of the build_urls for one of the
+        build_platforms or None."""
+        for build_url in build_urls:
+            filename = os.path.basename(build_url)
+            logger.debug('match_build: checking filename: %s' % filename)
+            if self.build_regex.match(filename):
+                return build_url
+        return None
+
+    def find_indexed_directories(self, search_directory, start_time, end_time):
+        """Returns a dict mapping the build directories in
+        search_directory between start_time and end_time which are in
+        the build_index to the urls of their builds."""
+        directories = {}
+        for build in self.build_index.find_builds(
+                search_directory,
+                int(convert_datetime_to_string(start_time, TIMESTAMP)),
+                int(convert_datetime_to_string(end_time, TIMESTAMP))):
+            directory_name = build['directory'][len(search_directory):].strip('/')
+            if not self.is_build_directory_name(directory_name):
+                continue
+            directories.setdefault(build['directory'], []).append(build['url'])
+        return directories
+
+    def find_builds_by_time(self, start_time, end_time, crawl=True):
+        """Returns the list of the urls of the builds whose build
+        directories are between start_time and end_time. See
+        iter_builds_by_time.
+        """
+        return list(self.iter_builds_by_time(start_time, end_time,
+                                             crawl=crawl))
+
+    def iter_builds_by_time(self, start_time, end_time, crawl=True):
+        """A generator which returns the urls of the builds whose
+        build directories are between start_time and end_time in the
+        order in which they are found. The build directories are
+        listed concurrently, so callers can start using the builds
+        before the search is complete.
+
+        If the location has a build_index, only the build directories
+        which are not in the index are listed and the builds found in
+        them are added to the index. If crawl is False, the builds are
+        only looked up in the index.
+        """
         logger.debug('Finding builds between %s and %s' %
                      (start_time, end_time))
 
         start_time = set_time_zone(start_time)
         end_time = set_time_zone(end_time)
 
-        builds = []
-
-        for directory_repo, directory in self.get_search_directories_by_time(start_time,
-                                                                             end_time):
-            logger.debug('Checking repo %s directory %s...' % (directory_repo, directory))
-            directory_links = url_links(directory)
+        search_directories = list(
+            self.get_search_directories_by_time(start_time, end_time))
+        found = False
+        if self.build_index and not crawl:
+            for directory_repo, directory in search_directories:
+                indexed = self.find_indexed_directories(directory,
+                                                        start_time, end_time)
+                for directory_href in sorted(indexed):
+                    build_url = self.match_build(indexed[directory_href])
+                    if build_url:
+                        found = True
+                        yield build_url
+            if not found:
+                logger.error('No builds found.')
+            return
+
+        build_directories = []
+        build_directory_info = {}
+        search_directory_repos = dict([(directory, directory_repo)
+                                       for directory_repo, directory in search_directories])
+        for directory, directory_links in self.fetch_links(search_directory_repos.keys()):
+            logger.debug('Checking directory %s...' % directory)
             for directory_link in directory_links:
                 directory_name = directory_link.get_text().rstrip('/')
                 directory_href = '%s%s/' % (directory, directory_name)
-                logger.debug('find_builds_by_time: directory: href: %s, name: %s' % (
+                logger.debug('iter_builds_by_time: directory: href: %s, name: %s' % (
                     directory_href, directory_name))
                 build_time = self.build_time_from_directory_name(directory_name)
 
@@ -238,159 +461,250 @@ class BuildLocation(object):
                 if build_time < start_time or build_time > end_time:
                     continue
 
-                build_links = url_links(directory_href)
-                for build_link in build_links:
-                    filename = build_link.get_text()
-                    logger.debug('find_builds_by_time: checking filename: %s' % filename)
-                    if self.build_regex.match(filename):
-                        logger.debug('find_builds_by_time: found filename: %s' % filename)
-                        builds.append('%s%s' % (directory_href, filename))
-                        break
-        if not builds:
+                build_directories.append(directory_href)
+                build_directory_info[directory_href] = (
+                    search_directory_repos[directory], build_time)
+
+        indexed = {}
+        if self.build_index:
+            indexed = self.build_index.get_directories(build_directories)
+        for directory_href in build_directories:
+            if directory_href in indexed:
+                build_url = self.match_build(indexed[directory_href])
+                if build_url:
+                    found = True
+                    yield build_url
+
+        unindexed = [directory_href for directory_href in build_directories
+                     if directory_href not in indexed]
+        for directory_href, build_links in self.fetch_links(unindexed):
+            build_urls = self.build_urls(directory_href, build_links)
+            # An empty listing may be a failed fetch, so the directory
+            # is only recorded as listed if it has links.
+            if self.build_index and build_links:
+                directory_repo, build_time = build_directory_info[directory_href]
+                timestamp = int(convert_datetime_to_string(build_time, TIMESTAMP))
+                self.build_index.add_builds([{'url': build_url,
+                                              'tree': directory_repo,
+                                              'timestamp': timestamp}
+                                             for build_url in build_urls])
+                self.build_index.add_listed_directories(
+                    {directory_href: timestamp})
+            build_url = self.match_build(build_urls)
+            if build_url:
+                logger.debug('iter_builds_by_time: found build: %s' % build_url)
+                found = True
+                yield build_url
+        if not found:
             logger.error('No builds found.')
-        return builds
 
-    def find_builds_by_revision(self, first_revision, last_revision):
+    def find_builds_by_revision(self, first_revision, last_revision,
+                                crawl=True):
+        """Returns the urls of the builds of the changesets pushed from
+        first_revision through last_revision ordered by push and build
+        id.
+
+        The pushlog of the range is retrieved once per repo. Only the
+        build .txt files in the build directories whose timestamps are
+        near the pushes are retrieved, concurrently in batches, until
+        the build of the last push is found.
+
+        If the location has a build_index, the build directories and
+        .txt files which are in the index are not retrieved and those
+        which are retrieved are added to the index. If crawl is False,
+        the builds are only looked up in the index.
+        """
         logger.debug('Finding builds between revisions %s and %s' %
                      (first_revision, last_revision))
 
-        range = datetime.timedelta(hours=12)
         builds = []
 
         for repo in self.repos:
             try:
-                first_timestamp, last_timestamp = get_revision_timestamps(
-                    repo,
-                    first_revision,
-                    last_revision)
+                revisions = get_revision_pushes(repo,
+                                                first_revision,
+                                                last_revision)
             except Exception:
                 logger.exception('repo %s' % repo)
                 continue
+            if not revisions:
+                continue
 
-            first_datetime = convert_timestamp_to_date(first_timestamp)
-            last_datetime = convert_timestamp_to_date(last_timestamp)
+            first_datetime = min(revisions.values())
+            last_datetime = max(revisions.values())
             logger.debug('find_builds_by_revision: repo %s, '
                          'first_revision: %s, first_datetime: %s, '
-                         'last_revision: %s, last_datetime: %s' % (
+                         'last_revision: %s, last_datetime: %s, '
+                         'changesets: %d' % (
                              repo, first_revision, first_datetime,
-                             last_revision, last_datetime))
-            if not first_datetime or not last_datetime:
-                continue
-            for search_directory_repo, search_directory in self.get_search_directories_by_time(first_datetime,
-                                                                                               last_datetime):
+                             last_revision, last_datetime, len(revisions)))
+            window_start = first_datetime - self.REVISION_WINDOW_BEFORE
+            window_end = last_datetime + self.REVISION_WINDOW_AFTER
+
+            search_directories = []
+            for search_directory_repo, search_directory in self.get_search_directories_by_time(window_start,
+                                                                                               window_end):
                 # search_directory_repo is not None for Tinderbox builds and
                 # can be used to filter the search directories.
-                logger.debug('find_builds_by_revision: Checking repo: %s '
-                             'search_directory_repo %s search_directory %s...' %
-                             (repo, search_directory_repo, search_directory))
                 if search_directory_repo and search_directory_repo != repo:
-                    logger.info('find_builds_by_revision: skipping repo %s, '
-                                'search_directory_repo: %s, search_directory: %s' %
-                                (repo, search_directory_repo, search_directory))
+                    logger.debug('find_builds_by_revision: skipping repo %s, '
+                                 'search_directory_repo: %s, search_directory: %s' %
+                                 (repo, search_directory_repo, search_directory))
                     continue
-
-                format = None
-                datetimestamps = []
-
-                for link in url_links(search_directory):
+                search_directories.append(search_directory)
+
+            # The build directories of each search directory in
+            # ascending order of their timestamps.
+            pending = {}
+            indexed = {}
+            directory_timestamps = {}
+            if self.build_index and not crawl:
+                for search_directory in search_directories:
+                    directories = self.find_indexed_directories(
+                        search_directory, window_start, window_end)
+                    if self.does_build_directory_contain_repo_name():
+                        directories = dict([(d, urls) for d, urls in directories.iteritems()
+                                            if repo in d[len(search_directory):]])
+                    indexed.update(directories)
+                    pending[search_directory] = sorted(directories)
+                search_directories = []
+            for search_directory, links in self.fetch_links(search_directories):
+                directory_names = set()
+                datetimestamps = set()
+                for link in links:
+                    datetimestring = link.get('href').strip('/')
+                    if self.does_build_directory_contain_repo_name() and repo not in datetimestring:
+                        continue
                     try:
-                        datetimestring = link.get('href').strip('/')
-                        if self.does_build_directory_contain_repo_name() and repo not in datetimestring:
-                            logger.info('find_builds_by_revisions:'
-                                        'skipping datetimestring: repo: %s, '
-                                        'datetimestring: %s' % (repo, datetimestring))
-                            continue
-
-                        logger.debug('find_builds_by_revisions: datetimestring: %s' % datetimestring)
                         link_format, link_datetime = parse_datetime(datetimestring)
-                        if not format:
-                            format = link_format
-                        logger.debug('find_builds_by_revisions: link_format: %s,'
-                                     'link_datetime: %s' % (link_format, link_datetime))
-                        if link_datetime > first_datetime - range and link_datetime < last_datetime + range:
-                            datetimestamps.append(set_time_zone(link_datetime))
                     except ValueError:
-                        pass
-
-                total_datetimestamps = len(datetimestamps)
-                datetimestamps = sorted(set(datetimestamps))
-                unique_datetimestamps = len(datetimestamps)
-                logger.debug('find_builds_by_revision: total_datetimestamps=%d, unique_datetimestamps=%d' %
-                             (total_datetimestamps,
-                              unique_datetimestamps))
-
-                logger.debug('find_builds_by_revisions: datetimestamps: %s' % datetimestamps)
-
-                start_time = None
-                end_time = None
-                for datetimestamp in datetimestamps:
+                        continue
+                    link_datetime = set_time_zone(link_datetime)
+                    if window_start <= link_datetime <= window_end:
+                        directory_names.add(datetimestring)
+                        datetimestamps.add(link_datetime)
+                pending[search_directory] = []
+                for datetimestamp in sorted(datetimestamps):
                     for directory_repo, directory_name in self.directory_names_from_datetimestamp(datetimestamp):
-
-                        # Since Autophone requires returning builds
-                        # for each of its supported platforms, arm,
-                        # or x86, we need to search each to get
-                        # all of the builds. That is why we don't
-                        # terminate this loop when we find the first
-                        # build which matches the ending revision.
-
-                        logger.debug('find_builds_by_revisions: '
-                                     'datetimestamp: %s, repo: %s, '
-                                     'search_directory_repo: %s, '
-                                     'search_directory: %s, directory_repo: %s, '
-                                     'directory_name: %s' %
-                                     (datetimestamp, repo, search_directory_repo,
-                                      search_directory, directory_repo,
-                                      directory_name))
-
-                        try:
-                            links = url_links("%s%s/" % (search_directory, directory_name))
-                        except urllib2.HTTPError:
+                        # Only look in the directories which exist.
+                        if directory_name in directory_names:
+                            build_directory = '%s%s/' % (search_directory,
+                                                         directory_name)
+                            pending[search_directory].append(build_directory)
+                            directory_timestamps[build_directory] = int(
+                                convert_datetime_to_string(datetimestamp, TIMESTAMP))
+
+            # The build directories are searched in batches of
+            # MAX_FETCHES per search directory until a build of the
+            # push of last_revision is found. Since Autophone requires
+            # returning builds for each of its supported platforms,
+            # arm, or x86, each search directory is searched to the
+            # end of the range.
+            repo_builds = []
+            while pending:
+                batch = []
+                for search_directory in pending.keys():
+                    batch.extend([(search_directory, build_directory)
+                                  for build_directory in pending[search_directory][:self.MAX_FETCHES]])
+                    pending[search_directory] = pending[search_directory][self.MAX_FETCHES:]
+                batch_directories = [build_directory
+                                     for search_directory, build_directory in batch]
+                if self.build_index and crawl:
+                    indexed.update(self.build_index.get_directories(
+                        [build_directory for build_directory in batch_directories
+                         if build_directory not in indexed]))
+                build_directory_urls = {}
+                for build_directory in batch_directories:
+                    if build_directory in indexed:
+                        build_directory_urls[build_directory] = [
+                            build_url for build_url in indexed[build_directory]
+                            if self.build_regex.match(os.path.basename(build_url))]
+                unindexed = [build_directory for build_directory in batch_directories
+                             if build_directory not in indexed]
+                for build_directory, links in self.fetch_links(unindexed):
+                    build_directory_urls[build_directory] = []
+                    for link in links:
+                        match = self.buildtxt_regex.match(link.get('href'))
+                        if match:
+                            build_directory_urls[build_directory].append(
+                                '%s%s%s' % (build_directory, match.group(1),
+                                            self.buildfile_ext))
+                    # Index the builds of every platform so that the
+                    # directory need not be listed again.
+                    if self.build_index and links:
+                        timestamp = directory_timestamps[build_directory]
+                        self.build_index.add_builds([
+                            {'url': build_url, 'timestamp': timestamp}
+                            for build_url in self.build_urls(build_directory,
+                                                             links)])
+                        self.build_index.add_listed_directories(
+                            {build_directory: timestamp})
+                build_urls = [build_url
+                              for search_directory, build_directory in batch
+                              for build_url in build_directory_urls[build_directory]]
+                build_data = {}
+                if self.build_index:
+                    for build_url, build in self.build_index.get_builds(build_urls).iteritems():
+                        if build['tree'] and build['revision'] and build['build_id']:
+                            build_data[build_url] = {'repo': build['tree'],
+                                                     'revision': build['revision'],
+                                                     'id': build['build_id']}
+                if crawl:
+                    fetched = dict(fetch_concurrently(
+                        utils.get_build_data,
+                        [build_url for build_url in build_urls
+                         if build_url not in build_data],
+                        self.MAX_FETCHES))
+                    build_data.update(fetched)
+                    if self.build_index:
+                        self.build_index.add_builds([
+                            {'url': build_url,
+                             'tree': data['repo'],
+                             'revision': data['revision'],
+                             'build_id': data['id'],
+                             'timestamp': directory_timestamps.get(
+                                 build_url[:build_url.rindex('/') + 1])}
+                            for build_url, data in fetched.iteritems() if data])
+                for search_directory, build_directory in batch:
+                    # Use the first build in range in each directory.
+                    for build_url in build_directory_urls[build_directory]:
+                        data = build_data.get(build_url)
+                        if not data:
+                            continue
+                        if repo != data['repo']:
+                            logger.info('find_builds_by_revisions: '
+                                        'skipping build: %s != %s'
+                                        % (repo, data['repo']))
+                            continue
+                        push_datetime = revisions.get(data['revision'][:12])
+                        if not push_datetime:
                             continue
-                        for link in links:
-                            href = link.get('href')
-                            match = self.buildtxt_regex.match(href)
-                            if match:
-                                build_url = "%s%s/%s%s" % (search_directory,
-                                                         directory_name,
-                                                         match.group(1),
-                                                         self.buildfile_ext)
-                                logger.debug('find_builds_by_revisions: '
-                                             'found build: datetimestamp: %s, '
-                                             'repo: %s, search_directory_repo:%s,'
-                                             'search_directory: %s, '
-                                             'directory_repo: %s, '
-                                             'directory_name: %s, found build: %s'
-                                             % (datetimestamp, repo,
-                                             search_directory_repo,
-                                             search_directory, directory_repo,
-                                             directory_name, build_url))
-                                build_data = utils.get_build_data(build_url)
-                                if build_data:
-                                    if repo != build_data['repo']:
-                                        logger.info('find_builds_by_revisions: '
-                                                    'skipping build: %s != %s'
-                                                    % (repo,
-                                                       urls_repos[build_data['repo']]))
-                                        continue
-                                    if build_data['revision'].startswith(first_revision):
-                                        start_time = convert_buildid_to_date(build_data['id'])
-                                    elif build_data['revision'].startswith(last_revision):
-                                        end_time = convert_buildid_to_date(build_data['id'])
-                                    if start_time:
-                                        builds.append(build_url)
-                                        break
-                    if end_time:
+                        logger.debug('find_builds_by_revisions: found build: %s' %
+                                     build_url)
+                        repo_builds.append((push_datetime, data['id'], build_url))
+                        if push_datetime == last_datetime:
+                            pending[search_directory] = []
                         break
+                for search_directory in pending.keys():
+                    if not pending[search_directory]:
+                        del pending[search_directory]
+
+            repo_builds.sort()
+            builds.extend([build_url for push_datetime, buildid, build_url in repo_builds])
 
         return builds
 
 
 class Nightly(BuildLocation):
 
+    main_http_url = 'http://ftp.mozilla.org/pub/mobile/nightly/'
+
     def __init__(self, repos, buildtypes,
-                 product, build_platforms, buildfile_ext):
+                 product, build_platforms, buildfile_ext,
+                 build_index=None):
         BuildLocation.__init__(self, repos, buildtypes,
-                               product, build_platforms, buildfile_ext)
+                               product, build_platforms, buildfile_ext,
+                               build_index=build_index)
         self.nightly_dirname_regexs = []
         for repo in repos:
             pattern = '(.*)-%s-(' % repo
@@ -410,7 +724,7 @@ class Nightly(BuildLocation):
         y = start_time.year
         m = start_time.month
         while y < end_time.year or (y == end_time.year and m <= end_time.month):
-            yield None, 'http://ftp.mozilla.org/pub/mobile/nightly/%d/%02d/' % (y, m)
+            yield None, '%s%d/%02d/' % (self.main_http_url, y, m)
             if m == 12:
                 y += 1
                 m = 1
@@ -431,6 +745,12 @@ class Nightly(BuildLocation):
                      (directory_name, build_time))
         return build_time
 
+    def is_build_directory_name(self, directory_name):
+        for r in self.nightly_dirname_regexs:
+            if r.match(directory_name):
+                return True
+        return False
+
     def directory_names_from_datetimestamp(self, datetimestamp):
         dates = [convert_datetime_to_string(datetimestamp, DIRECTORY_DATE), # only really needed for non mobile
                  convert_datetime_to_string(datetimestamp, DIRECTORY_DATETIME)]
@@ -445,9 +765,11 @@ class Tinderbox(BuildLocation):
     main_http_url = 'http://ftp.mozilla.org/pub/mozilla.org/mobile/tinderbox-builds/'
 
     def __init__(self, repos, buildtypes,
-                 product, build_platforms, buildfile_ext):
+                 product, build_platforms, buildfile_ext,
+                 build_index=None):
         BuildLocation.__init__(self, repos, buildtypes,
-                               product, build_platforms, buildfile_ext)
+                               product, build_platforms, buildfile_ext,
+                               build_index=build_index)
 
     def get_search_directories_by_time(self, start_time, end_time):
         logger.debug('Tinderbox:get_search_directories_by_time(%s, %s)' % (start_time, end_time))
@@ -465,6 +787,9 @@ class Tinderbox(BuildLocation):
             build_time = None
         return build_time
 
+    def is_build_directory_name(self, directory_name):
+        return directory_name.isdigit()
+
     def directory_names_from_datetimestamp(self, datetimestamp):
         yield None, convert_datetime_to_string(datetimestamp, TIMESTAMP)
 
@@ -478,17 +803,236 @@ class BuildCacheException(Exception):
     pass
 
 
+class BuildDownloadCancelled(Exception):
+    pass
+
+
+DOWNLOAD_CHUNK_SIZE = 1024*1024
+DOWNLOAD_ATTEMPTS = 5
+DOWNLOAD_RETRY_WAIT = 10
+DOWNLOAD_TIMEOUT = 60
+
+
+def file_checksum(path, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """Return the sha256 hex digest of the file at path."""
+    checksum = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            checksum.update(data)
+    return checksum.hexdigest()
+
+
+def download_file(url, path, cancel=None, resume=True,
+                  attempts=DOWNLOAD_ATTEMPTS, retry_wait=DOWNLOAD_RETRY_WAIT,
+                  chunk_size=DOWNLOAD_CHUNK_SIZE, timeout=DOWNLOAD_TIMEOUT):
+    """Download url to path and return a tuple of the size and sha256
+    hex digest of the downloaded file.
+
+    HTTP downloads which fail or are cut short are retried up to
+    attempts times. If resume is True and path already contains part of
+    the file, either from an earlier attempt or an earlier call, the
+    download continues from the end of path using a Range request.
+    The HTTP errors returned by the server, such as 404, are not
+    retried.
+
+    :param cancel: optional threading.Event. If it is set, the download
+        is abandoned by raising BuildDownloadCancelled. path is left in
+        place so that the download can be resumed later.
+    :raises: IOError if the download fails.
+    """
+    if not urlparse.urlparse(url).scheme.startswith('http'):
+        # Local builds are copied in one pass.
+        resume = False
+        attempts = 1
+    if not resume and os.path.exists(path):
+        os.unlink(path)
+    attempt = 0
+    while True:
+        attempt += 1
+        if cancel and cancel.is_set():
+            raise BuildDownloadCancelled(url)
+        try:
+            return _download_file(url, path, cancel, chunk_size, timeout)
+        except urllib2.HTTPError:
+            raise
+        except (IOError, httplib.HTTPException, socket.error), e:
+            if attempt >= attempts:
+                if not isinstance(e, IOError):
+                    raise IOError('%s retrieving %s' % (e, url))
+                raise
+            logger.warning('Attempt %d/%d %s retrieving %s. Retrying.' %
+                           (attempt, attempts, e, url))
+            time.sleep(retry_wait)
+
+
+def _download_file(url, path, cancel, chunk_size, timeout):
+    scheme = urlparse.urlparse(url).scheme
+    offset = 0
+    if os.path.exists(path):
+        offset = os.path.getsize(path)
+    if not scheme.startswith('http'):
+        conn = urllib.urlopen(url)
+    else:
+        request = urllib2.Request(url)
+        if offset:
+            request.add_header('Range', 'bytes=%d-' % offset)
+        try:
+            conn = urllib2.urlopen(request, timeout=timeout)
+        except urllib2.HTTPError, e:
+            if e.code != 416 or not offset:
+                raise
+            # The partial file is not a prefix of the current file.
+            # Start again from the beginning.
+            logger.warning('Range not satisfiable. Restarting download of %s.' %
+                           url)
+            os.unlink(path)
+            return _download_file(url, path, cancel, chunk_size, timeout)
+    try:
+        total = None
+        if conn.info().getheader('Content-Length'):
+            total = int(conn.info().getheader('Content-Length'))
+        if offset and scheme.startswith('http') and conn.getcode() != 206:
+            # The server ignored the Range header.
+            offset = 0
+        checksum = hashlib.sha256()
+        if offset:
+            logger.info('Resuming download of %s at %d bytes.' % (url, offset))
+            with open(path, 'rb') as f:
+                while True:
+                    data = f.read(chunk_size)
+                    if not data:
+                        break
+                    checksum.update(data)
+        size = offset
+        with open(path, 'ab' if offset else 'wb') as f:
+            while True:
+                if cancel and cancel.is_set():
+                    raise BuildDownloadCancelled(url)
+                data = conn.read(chunk_size)
+                if not data:
+                    break
+                f.write(data)
+                checksum.update(data)
+                size += len(data)
+    finally:
+        conn.close()
+    if total is not None and size - offset < total:
+        raise IOError('Incomplete download of %s: received %d of %d bytes.' %
+                      (url, size - offset, total))
+    return size, checksum.hexdigest()
+
+
+class BuildArtifact(object):
+    """A file to be downloaded into the build cache.
+
+    :param name: name of the artifact used in error messages.
+    :param url: url of the artifact.
+    :param path: path of the artifact in the cache.
+    :param extract: if True, the artifact is a zip file which is
+        extracted into the directory path.
+    :param required: if False, a failure to download the artifact is
+        not an error.
+    :param verify: if True, the artifact is a zip file whose members
+        are tested once it is downloaded.
+    :param shared: if True, the extracted files are hard links to the
+        BuildCache's content addressed store so that files which are
+        identical across builds are only stored once.
+    """
+    def __init__(self, name, url, path, extract=False, required=True,
+                 verify=False, shared=False):
+        self.name = name
+        self.url = url
+        self.path = path
+        self.extract = extract
+        self.required = required
+        self.verify = verify
+        self.shared = shared
+        # The size and sha256 checksum of the downloaded file.
+        self.size = None
+        self.checksum = None
+
+    @property
+    def download_path(self):
+        """The path the artifact is downloaded to before it is moved
+        or extracted into place. A partial download is left here so
+        that it can be resumed."""
+        return self.path + '.download'
+
+    def ignore_error(self, e):
+        logger.exception('Error retrieving %s: %s.' % (self.name, self.url))
+
+
+class SymbolsArtifact(BuildArtifact):
+    """The crashreporter symbols which are not available for all builds."""
+    def ignore_error(self, e):
+        if isinstance(e, urllib2.HTTPError) and e.code == 404:
+            logger.info('No symbols found: %s.' % self.url)
+        elif isinstance(e, IOError):
+            if '550 Failed to change directory' in str(e):
+                logger.info('No symbols found: %s.' % self.url)
+            elif 'No such file or directory' in str(e):
+                logger.info('No symbols found: %s.' % self.url)
+            else:
+                logger.exception('IO Error retrieving symbols: %s.' % self.url)
+        elif isinstance(e, zipfile.BadZipfile):
+            logger.info('Ignoring zipfile.BadZipfile Error retrieving symbols: %s.' % self.url)
+        else:
+            BuildArtifact.ignore_error(self, e)
+
+
+class BuildCacheEntry(object):
+    """The in-memory record of a build directory in the BuildCache."""
+    def __init__(self, name, lastused=0, flushed=0):
+        self.name = name
+        # Size in bytes of the directory or None if it must be measured.
+        self.size = None
+        # Number of changes to the directory, used to detect changes
+        # made while it was being measured.
+        self.changes = 0
+        # Time the build was last returned by get.
+        self.lastused = lastused
+        # lastused as last written to the directory's lastused file.
+        self.flushed = flushed
+        # Number of gets in progress for the build.
+        self.active = 0
+
+
 class BuildCache(object):
 
     MAX_NUM_BUILDS = 20
     EXPIRE_AFTER_DAYS = 1
+    MAX_DOWNLOADS = 4
+    # Maximum total size in bytes of the cached builds. 0 for no limit.
+    MAX_CACHE_BYTES = 0
+    # Number of seconds after a build is returned by get during which
+    # it is assumed to be in use by a job and is not evicted.
+    JOB_PIN_SECONDS = 2*60*60
+    # Maximum number of seconds between runs of the eviction thread.
+    EVICT_INTERVAL = 60
+    # Extensions of the extracted test files which are shared through
+    # the store. The test harnesses run with their working directory in
+    # the build's tests directory and may rewrite their own scripts and
+    # configuration files there, so only the test content which they
+    # serve to the device and never write is shared. Every other file
+    # is a private copy of the build.
+    SHARED_EXTENSIONS = ('.html', '.htm', '.xhtml', '.xul', '.xml',
+                         '.svg', '.css', '.js', '.png', '.jpg', '.jpeg',
+                         '.gif', '.ico', '.bmp', '.ogg', '.ogv', '.oga',
+                         '.webm', '.mp3', '.mp4', '.wav', '.opus',
+                         '.ttf', '.otf', '.woff')
 
     def __init__(self, repos, buildtypes,
                  product, build_platforms, buildfile_ext,
                  cache_dir='builds', override_build_dir=None,
                  build_cache_size=MAX_NUM_BUILDS,
                  build_cache_expires=EXPIRE_AFTER_DAYS,
-                 treeherder_url=None):
+                 build_cache_max_downloads=MAX_DOWNLOADS,
+                 build_cache_max_bytes=MAX_CACHE_BYTES,
+                 treeherder_url=None,
+                 build_index=None):
         self.repos = repos
         self.buildtypes = buildtypes
         self.product = product
@@ -508,30 +1052,57 @@ class BuildCache(object):
             os.mkdir(self.cache_dir)
         self.build_cache_size = build_cache_size
         self.build_cache_expires = build_cache_expires
+        self.build_cache_max_downloads = build_cache_max_downloads
+        self.build_cache_max_bytes = build_cache_max_bytes
         self.treeherder_url = treeherder_url
+        # build_index is an optional BuildIndex used by the
+        # BuildLocations of the find_* methods.
+        self.build_index = build_index
         logger.debug('BuildCache: %s' % self.__dict__)
+        # get may be called concurrently for different builds.
+        # _entries is the in-memory index of the build directories
+        # which is used by clean_cache to evict builds. It is
+        # populated from the cache directory by the eviction thread
+        # which is started by the first get and stopped by close. _download_semaphore limits
+        # the number of files being downloaded at the same time.
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._scanned = False
+        # _metadata memoizes the contents of each build's metadata.json.
+        self._metadata = {}
+        # The extracted test files of every build are hard links to
+        # the files in the content addressed store, store_dir. Files
+        # are removed from the store once no build links to them.
+        self.store_dir = os.path.join(self.cache_dir, '.store')
+        self._store_size = None
+        self._evict_event = threading.Event()
+        self._evict_stop = threading.Event()
+        self._evict_thread = None
+        self._download_semaphore = threading.BoundedSemaphore(
+            build_cache_max_downloads)
 
     def build_location(self, s):
         if 'nightly' in s:
             return Nightly(self.repos, self.buildtypes,
                            self.product, self.build_platforms,
-                           self.buildfile_ext)
+                           self.buildfile_ext, build_index=self.build_index)
         if 'tinderbox' in s:
             return Tinderbox(self.repos, self.buildtypes,
                              self.product, self.build_platforms,
-                             self.buildfile_ext)
+                             self.buildfile_ext, build_index=self.build_index)
         if 'inboundarchive' in s:
             return InboundArchive(self.repos, self.buildtypes,
                                   self.product, self.build_platforms,
-                                  self.buildfile_ext)
+                                  self.buildfile_ext,
+                                  build_index=self.build_index)
         return None
 
-    def find_latest_builds(self, build_location_name='nightly'):
+    def find_latest_builds(self, build_location_name='nightly', crawl=True):
         build_location = self.build_location(build_location_name)
         if not build_location:
             logger.error('unsupported build_location "%s"' % build_location_name)
             return []
-        return build_location.find_latest_builds()
+        return build_location.find_latest_builds(crawl=crawl)
 
     def find_builds_by_directory(self, directory, build_location_name='nightly'):
         build_location = self.build_location(build_location_name)
@@ -541,22 +1112,35 @@ class BuildCache(object):
 
         return build_location.find_builds_by_directory(directory)
 
-    def find_builds_by_time(self, start_time, end_time, build_location_name='nightly'):
+    def find_builds_by_time(self, start_time, end_time, build_location_name='nightly',
+                            crawl=True):
         build_location = self.build_location(build_location_name)
         if not build_location:
             logger.error('unsupported build_location "%s"' % build_location_name)
             return []
 
-        return build_location.find_builds_by_time(start_time, end_time)
+        return build_location.find_builds_by_time(start_time, end_time,
+                                                  crawl=crawl)
+
+    def iter_builds_by_time(self, start_time, end_time,
+                            build_location_name='nightly', crawl=True):
+        build_location = self.build_location(build_location_name)
+        if not build_location:
+            logger.error('unsupported build_location "%s"' % build_location_name)
+            return []
+
+        return build_location.iter_builds_by_time(start_time, end_time,
+                                                  crawl=crawl)
 
     def find_builds_by_revision(self, first_revision, last_revision,
-                                build_location_name='nightly'):
+                                build_location_name='nightly', crawl=True):
         build_location = self.build_location(build_location_name)
         if not build_location:
             logger.error('unsupported build_location "%s"' % build_location_name)
             return []
 
-        return build_location.find_builds_by_revision(first_revision, last_revision)
+        return build_location.find_builds_by_revision(first_revision, last_revision,
+                                                      crawl=crawl)
 
     def get(self, buildurl, force=False, enable_unittests=False):
         """Returns info on a cached build, fetching it if necessary.
@@ -566,9 +1150,9 @@ class BuildCache(object):
         If 'success' is True, the dict also contains a 'metadata' item, which is
         a json encoding of BuildMetadata.  The path to the build is the
         'dir' item, which is a directory containing build.apk,
-        symbols/, and, if enable_unittests is true, robocop.apk and tests/.
+        and, if enable_unittests is true, robocop.apk and tests/.
         If not found, fetches them, assuming a standard file structure.
-        Cleans the cache before getting started.
+        The crashreporter symbols are only fetched by get_symbols.
         If self.override_build_dir is set, 'dir' is set to
         that value without verifying the contents nor fetching anything (though
         it will still try to open build.apk to read in the metadata).
@@ -590,112 +1174,356 @@ class BuildCache(object):
                 'error': '' if metadata is not None else 'metadata is None',
                 'metadata': metadata_json
             }
+        build_dir = base64.b64encode(buildurl)
+        entry = self._acquire_entry(build_dir)
+        try:
+            return self._get(buildurl, build_dir, force, enable_unittests)
+        finally:
+            self._release_entry(entry)
+
+    def get_symbols(self, buildurl):
+        """Returns the crashreporter symbols of a build, fetching them
+        if necessary. Returns a dict with a boolean 'success' item, an
+        'error' item and a 'symbols' item containing the path to the
+        directory of symbols or None if the build has no symbols.
+
+        Symbols are only needed to process crash dumps, so they are
+        fetched on demand rather than by get.
+        """
+        if self.override_build_dir:
+            symbols_path = os.path.join(self.override_build_dir, 'symbols')
+            return {
+                'success': True,
+                'error': '',
+                'symbols': (os.path.abspath(symbols_path)
+                            if os.path.exists(symbols_path) else None)
+            }
+        build_dir = base64.b64encode(buildurl)
+        entry = self._acquire_entry(build_dir)
+        try:
+            cache_build_dir = os.path.join(self.cache_dir, build_dir)
+            symbols_path = os.path.join(cache_build_dir, 'symbols')
+            if not os.path.exists(symbols_path):
+                if not os.path.exists(cache_build_dir):
+                    os.makedirs(cache_build_dir)
+                # XXX: assumes fixed buildurl-> symbols_url mapping
+                symbols_url = re.sub('.apk$', '.crashreporter-symbols.zip', buildurl)
+                self._fetch_artifacts([SymbolsArtifact('symbols', symbols_url,
+                                                       symbols_path, extract=True,
+                                                       required=False)])
+                self._entry_changed(build_dir)
+            return {
+                'success': True,
+                'error': '',
+                'symbols': (os.path.abspath(symbols_path)
+                            if os.path.exists(symbols_path) else None)
+            }
+        finally:
+            self._release_entry(entry)
+
+    def _acquire_entry(self, build_dir):
+        """Return the index entry of the build, marking it in use."""
+        with self._lock:
+            if not self._evict_thread and not self._evict_stop.is_set():
+                self._evict_thread = threading.Thread(
+                    target=self._evict_loop, name='BuildCacheEvictThread')
+                self._evict_thread.daemon = True
+                self._evict_thread.start()
+            entry = self._entries.get(build_dir)
+            if not entry:
+                entry = self._entries[build_dir] = BuildCacheEntry(build_dir)
+            entry.active += 1
+        return entry
+
+    def _release_entry(self, entry):
+        with self._lock:
+            entry.active -= 1
+            entry.lastused = time.time()
+        self._evict_event.set()
+
+    def _entry_changed(self, build_dir):
+        """Mark the build's directory to be measured again."""
+        with self._lock:
+            entry = self._entries[build_dir]
+            entry.size = None
+            entry.changes += 1
+
+    def _retrieve(self, url, path, cancel=None, resume=True):
+        """Download url to path, waiting while build_cache_max_downloads
+        other downloads are in progress. Returns a tuple of the size
+        and sha256 checksum of the file. See download_file."""
+        with self._download_semaphore:
+            if cancel and cancel.is_set():
+                raise BuildDownloadCancelled(url)
+            logger.debug('BuildCache: retrieving %s' % url)
+            return download_file(url, path, cancel=cancel, resume=resume)
+
+    def _fetch_artifact(self, artifact, cancel, force=False):
+        """Download artifact to its download_path and move, or
+        extract, it into place. Unless force is True, a partial
+        download left by an earlier fetch is resumed. The artifact's
+        size and checksum are only set once it is in place, so that a
+        failed fetch is not recorded."""
+        size, checksum = self._retrieve(
+            artifact.url, artifact.download_path, cancel=cancel,
+            resume=not force)
+        if artifact.verify:
+            try:
+                valid = zipfile.ZipFile(artifact.download_path).testzip() is None
+            except zipfile.BadZipfile:
+                valid = False
+            if not valid:
+                os.unlink(artifact.download_path)
+                raise IOError('%s is not a valid zip file' % artifact.url)
+        if not artifact.extract:
+            os.rename(artifact.download_path, artifact.path)
+            artifact.size, artifact.checksum = size, checksum
+            return
+        tmpdir = tempfile.mkdtemp(dir=os.path.dirname(artifact.path))
+        try:
+            artifact_zipfile = zipfile.ZipFile(artifact.download_path)
+            if artifact.shared:
+                self._extract_shared(artifact_zipfile, tmpdir)
+            else:
+                artifact_zipfile.extractall(tmpdir)
+            artifact_zipfile.close()
+            if os.path.exists(artifact.path):
+                shutil.rmtree(artifact.path)
+            os.rename(tmpdir, artifact.path)
+            artifact.size, artifact.checksum = size, checksum
+        finally:
+            if os.path.exists(tmpdir):
+                shutil.rmtree(tmpdir)
+            os.unlink(artifact.download_path)
+
+    def _extract_shared(self, artifact_zipfile, path):
+        """Extract artifact_zipfile into the directory path using the
+        content addressed store.
+
+        Each member with one of the SHARED_EXTENSIONS is hashed as it
+        is decompressed. If the store already contains a file with the
+        same sha256 checksum, it is hard linked into path. Otherwise the
+        member is written to path and linked into the store. Only new
+        content is written to disk. Files in the store are read only
+        since they are shared by every build which contains them. The
+        other members are extracted as writable copies.
+        """
+        for member in artifact_zipfile.infolist():
+            arcname = os.path.splitdrive(member.filename)[1]
+            parts = [x for x in arcname.split('/') if x not in ('', '.', '..')]
+            if not parts:
+                continue
+            member_path = os.path.join(path, *parts)
+            if member.filename.endswith('/'):
+                if not os.path.isdir(member_path):
+                    os.makedirs(member_path)
+                continue
+            if not os.path.isdir(os.path.dirname(member_path)):
+                os.makedirs(os.path.dirname(member_path))
+            if not member_path.lower().endswith(self.SHARED_EXTENSIONS):
+                source = artifact_zipfile.open(member)
+                with open(member_path, 'wb') as target:
+                    shutil.copyfileobj(source, target, DOWNLOAD_CHUNK_SIZE)
+                source.close()
+                continue
+            checksum = hashlib.sha256()
+            source = artifact_zipfile.open(member)
+            while True:
+                data = source.read(DOWNLOAD_CHUNK_SIZE)
+                if not data:
+                    break
+                checksum.update(data)
+            source.close()
+            digest = checksum.hexdigest()
+            store_path = os.path.join(self.store_dir, digest[:2], digest)
+            try:
+                os.link(store_path, member_path)
+                continue
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+            source = artifact_zipfile.open(member)
+            with open(member_path, 'wb') as target:
+                shutil.copyfileobj(source, target, DOWNLOAD_CHUNK_SIZE)
+            source.close()
+            os.chmod(member_path, 0444)
+            if not os.path.isdir(os.path.dirname(store_path)):
+                try:
+                    os.makedirs(os.path.dirname(store_path))
+                except OSError, e:
+                    if e.errno != errno.EEXIST:
+                        raise
+            try:
+                os.link(member_path, store_path)
+                with self._lock:
+                    if self._store_size is not None:
+                        self._store_size += member.file_size
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def _fetch_artifacts(self, artifacts, force=False):
+        """Download artifacts concurrently using at most
+        build_cache_max_downloads threads.
+
+        Errors fetching optional artifacts are logged and ignored. The
+        first error fetching a required artifact cancels the remaining
+        downloads. Returns an error message if a required artifact
+        could not be downloaded, otherwise None. Unexpected exceptions
+        are re-raised in the calling thread.
+        """
+        pending = Queue.Queue()
+        for artifact in artifacts:
+            pending.put(artifact)
+        cancel = threading.Event()
+        failures = []
+
+        def fetcher():
+            while not cancel.is_set():
+                try:
+                    artifact = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    self._fetch_artifact(artifact, cancel, force=force)
+                except BuildDownloadCancelled:
+                    return
+                except Exception, e:
+                    if artifact.required:
+                        failures.append((artifact, e, sys.exc_info()))
+                        cancel.set()
+                    else:
+                        artifact.ignore_error(e)
+
+        threads = []
+        for i in range(min(len(artifacts), self.build_cache_max_downloads)):
+            thread = threading.Thread(target=fetcher,
+                                      name='BuildCacheFetcher%d' % i)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        if not failures:
+            return None
+        artifact, e, exc_info = failures[0]
+        if not isinstance(e, IOError):
+            raise exc_info[0], exc_info[1], exc_info[2]
+        err = 'IO Error retrieving %s: %s.' % (artifact.name, artifact.url)
+        logger.error(err, exc_info=exc_info)
+        return err
+
+    def _read_artifact_records(self, cache_build_dir):
+        """Return a dict of the files downloaded into cache_build_dir.
+        Each file name maps to a dict containing its 'size', 'mtime' and
+        'sha256' checksum."""
+        try:
+            with open(os.path.join(cache_build_dir, 'artifacts.json')) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _write_artifact_records(self, cache_build_dir, records):
+        records_path = os.path.join(cache_build_dir, 'artifacts.json')
+        with open(records_path + '.tmp', 'w') as f:
+            json.dump(records, f)
+        os.rename(records_path + '.tmp', records_path)
+
+    def _check_build(self, buildurl, build_path, records):
+        """Return True if the cached build at build_path is intact.
+
+        The apk is tested once when it is downloaded and its size,
+        mtime and checksum are recorded. As long as the size and mtime
+        of the file are unchanged, the build is valid without reading
+        it. If the mtime changed but the size and checksum still match
+        the record, the new mtime is recorded. A build without a record
+        has every member of the apk tested and, if it is valid, is
+        recorded.
+        """
+        record = records.get('build.apk')
+        try:
+            stat = os.stat(build_path)
+            if record:
+                if stat.st_size != record['size']:
+                    valid = False
+                elif stat.st_mtime == record.get('mtime'):
+                    return True
+                else:
+                    valid = file_checksum(build_path) == record['sha256']
+                if not valid:
+                    logger.warning('%s does not match its recorded size and '
+                                   'checksum. Forcing download.' % buildurl)
+                    return False
+                record['mtime'] = stat.st_mtime
+                return True
+            if zipfile.ZipFile(build_path).testzip() is not None:
+                return False
+        except OSError:
+            return False
+        except (zipfile.BadZipfile, IOError), e:
+            logger.warning('%s checking build: %s. Forcing download.' % (e, buildurl))
+            return False
+        records['build.apk'] = {'size': stat.st_size,
+                                'mtime': stat.st_mtime,
+                                'sha256': file_checksum(build_path)}
+        return True
+
+    def _get(self, buildurl, build_dir, force, enable_unittests):
         # If the buildurl is for a local build, force the download since it may
         # have changed even though the buildurl hasn't.
         force = force or not urlparse.urlparse(buildurl).scheme.startswith('http')
-        build_dir = base64.b64encode(buildurl)
-        self.clean_cache([build_dir])
         cache_build_dir = os.path.join(self.cache_dir, build_dir)
         build_path = os.path.join(cache_build_dir, 'build.apk')
         if not os.path.exists(cache_build_dir):
             os.makedirs(cache_build_dir)
 
+        artifacts = []
+        records = self._read_artifact_records(cache_build_dir)
+        original_records = json.dumps(records, sort_keys=True)
+
         # build
-        try:
-            download_build = (force or not os.path.exists(build_path) or
-                              zipfile.ZipFile(build_path).testzip() is not None)
-        except (zipfile.BadZipfile, IOError), e:
-            logger.warning('%s checking build: %s. Forcing download.' % (e, buildurl))
-            download_build = True
+        download_build = (force or
+                          not self._check_build(buildurl, build_path, records))
         if download_build:
-            # retrieve to temporary file then move over, so we don't end
-            # up with half a file if it aborts
-            tmpf = tempfile.NamedTemporaryFile(delete=False)
-            tmpf.close()
-            try:
-                urllib.urlretrieve(buildurl, tmpf.name)
-            except IOError:
-                os.unlink(tmpf.name)
-                err = 'IO Error retrieving build: %s.' % buildurl
-                logger.exception(err)
-                return {'success': False, 'error': err}
-            shutil.move(tmpf.name, build_path)
-        file(os.path.join(cache_build_dir, 'lastused'), 'w')
-
-        # symbols
-        symbols_path = os.path.join(cache_build_dir, 'symbols')
-        if force or not os.path.exists(symbols_path):
-            tmpf = tempfile.NamedTemporaryFile(delete=False)
-            tmpf.close()
-            # XXX: assumes fixed buildurl-> symbols_url mapping
-            symbols_url = re.sub('.apk$', '.crashreporter-symbols.zip', buildurl)
-            try:
-                urllib.urlretrieve(symbols_url, tmpf.name)
-                symbols_zipfile = zipfile.ZipFile(tmpf.name)
-                symbols_zipfile.extractall(symbols_path)
-                symbols_zipfile.close()
-            except IOError, ioerror:
-                if '550 Failed to change directory' in str(ioerror):
-                    logger.info('No symbols found: %s.' % symbols_url)
-                elif 'No such file or directory' in str(ioerror):
-                    logger.info('No symbols found: %s.' % symbols_url)
-                else:
-                    logger.exception('IO Error retrieving symbols: %s.' % symbols_url)
-            except zipfile.BadZipfile:
-                logger.info('Ignoring zipfile.BadZipfile Error retrieving symbols: %s.' % symbols_url)
-                try:
-                    with open(tmpf.name, 'r') as badzipfile:
-                        logger.debug(badzipfile.read())
-                except:
-                    pass
-            os.unlink(tmpf.name)
+            artifacts.append(BuildArtifact('build', buildurl, build_path,
+                                           verify=True))
+            # Any symbols belong to the previous build and are
+            # fetched again by get_symbols when they are needed.
+            symbols_path = os.path.join(cache_build_dir, 'symbols')
+            if os.path.exists(symbols_path):
+                shutil.rmtree(symbols_path)
 
         # tests
         if enable_unittests:
             tests_path = os.path.join(cache_build_dir, 'tests')
             if force or not os.path.exists(tests_path):
-                tmpf = tempfile.NamedTemporaryFile(delete=False)
-                tmpf.close()
                 # XXX: assumes fixed buildurl-> tests_url mapping
                 tests_url = re.sub('.apk$', '.tests.zip', buildurl)
-                try:
-                    urllib.urlretrieve(tests_url, tmpf.name)
-                except IOError:
-                    os.unlink(tmpf.name)
-                    err = 'IO Error retrieving tests: %s.' % tests_url
-                    logger.exception(err)
-                    return {'success': False, 'error': err}
-                tests_zipfile = zipfile.ZipFile(tmpf.name)
-                tests_zipfile.extractall(tests_path)
-                tests_zipfile.close()
-                os.unlink(tmpf.name)
+                artifacts.append(BuildArtifact('tests', tests_url, tests_path,
+                                               extract=True, shared=True))
                 # XXX: assumes fixed buildurl-> robocop mapping
                 robocop_url = urlparse.urljoin(buildurl, 'robocop.apk')
                 robocop_path = os.path.join(cache_build_dir, 'robocop.apk')
-                tmpf = tempfile.NamedTemporaryFile(delete=False)
-                tmpf.close()
-                try:
-                    urllib.urlretrieve(robocop_url, tmpf.name)
-                except IOError:
-                    os.unlink(tmpf.name)
-                    err = 'IO Error retrieving robocop.apk: %s.' % robocop_url
-                    logger.exception(err)
-                    return {'success': False, 'error': err}
-                shutil.move(tmpf.name, robocop_path)
+                artifacts.append(BuildArtifact('robocop.apk', robocop_url,
+                                               robocop_path))
                 # XXX: assumes fixed buildurl-> fennec_ids.txt mapping
                 fennec_ids_url = urlparse.urljoin(buildurl, 'fennec_ids.txt')
                 fennec_ids_path = os.path.join(cache_build_dir, 'fennec_ids.txt')
-                tmpf = tempfile.NamedTemporaryFile(delete=False)
-                tmpf.close()
-                try:
-                    urllib.urlretrieve(fennec_ids_url, tmpf.name)
-                except IOError:
-                    os.unlink(tmpf.name)
-                    err = 'IO Error retrieving fennec_ids.txt: %s.' % \
-                        fennec_ids_url
-                    logger.exception(err)
-                    return {'success': False, 'error': err}
-                shutil.move(tmpf.name, fennec_ids_path)
+                artifacts.append(BuildArtifact('fennec_ids.txt', fennec_ids_url,
+                                               fennec_ids_path))
+
+        err = self._fetch_artifacts(artifacts, force=force)
+        if artifacts:
+            self._entry_changed(build_dir)
+        for artifact in artifacts:
+            if artifact.checksum and not artifact.extract:
+                records[os.path.basename(artifact.path)] = {
+                    'size': artifact.size,
+                    'mtime': os.stat(artifact.path).st_mtime,
+                    'sha256': artifact.checksum}
+        if json.dumps(records, sort_keys=True) != original_records:
+            self._write_artifact_records(cache_build_dir, records)
+        if err:
+            return {'success': False, 'error': err}
 
         metadata = self.build_metadata(buildurl, cache_build_dir)
         if metadata:
@@ -708,59 +1536,246 @@ class BuildCache(object):
             'metadata': metadata_json
         }
 
-    def clean_cache(self, preserve=[]):
-        def lastused_path(d):
-            return os.path.join(self.cache_dir, d, 'lastused')
-
-        def keep_build(d):
-            if preserve and d in preserve:
-                # specifically keep this build
-                return True
-            if not os.path.exists(lastused_path(d)):
+    def close(self):
+        """Stop the eviction thread and wait for it to exit. The cache
+        is no longer cleaned once it is closed."""
+        self._evict_stop.set()
+        self._evict_event.set()
+        with self._lock:
+            thread = self._evict_thread
+        if thread:
+            thread.join()
+
+    def _evict_loop(self):
+        while True:
+            self._evict_event.wait(self.EVICT_INTERVAL)
+            self._evict_event.clear()
+            if self._evict_stop.is_set():
+                return
+            try:
+                self.clean_cache()
+            except Exception:
+                logger.exception('BuildCache: clean_cache')
+
+    def _scan_cache(self):
+        """Add the builds found in the cache directory to the index and
+        remove any directories left by an interrupted eviction. Called
+        with _lock held."""
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.startswith('.evicting-'):
+                shutil.rmtree(path, ignore_errors=True)
+                continue
+            try:
+                lastused = os.stat(os.path.join(path, 'lastused')).st_mtime
+            except OSError:
                 # probably not a build dir
-                return True
-            if ((datetime.datetime.now() -
-                 datetime.datetime.fromtimestamp(os.stat(lastused_path(d)).st_mtime) <=
-                 datetime.timedelta(days=self.build_cache_expires))):
-                # too new
-                return True
-            return False
+                continue
+            if name not in self._entries:
+                self._entries[name] = BuildCacheEntry(name, lastused=lastused,
+                                                      flushed=lastused)
+
+    def _collect_store(self):
+        """Remove the files in the store which are no longer linked to
+        by any build and measure the size of the store."""
+        size = 0
+        for dirpath, dirnames, filenames in os.walk(self.store_dir):
+            for filename in filenames:
+                store_path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.lstat(store_path)
+                    if stat.st_nlink == 1:
+                        os.unlink(store_path)
+                    else:
+                        size += stat.st_size
+                except OSError:
+                    pass
+        with self._lock:
+            self._store_size = size
+
+    def _measure_entries(self):
+        """Measure the size of each build directory which has changed.
+        Files shared with the store are counted in the store's size."""
+        with self._lock:
+            entries = [(entry, entry.changes) for entry in self._entries.values()
+                       if entry.size is None]
+        for entry, changes in entries:
+            size = 0
+            for dirpath, dirnames, filenames in os.walk(
+                    os.path.join(self.cache_dir, entry.name)):
+                for filename in filenames:
+                    try:
+                        stat = os.lstat(os.path.join(dirpath, filename))
+                    except OSError:
+                        continue
+                    if stat.st_nlink == 1:
+                        size += stat.st_size
+            with self._lock:
+                if entry.changes == changes:
+                    entry.size = size
+
+    def _flush_lastused(self):
+        """Record the last use of each build as the mtime of its
+        lastused file so that it survives a restart."""
+        with self._lock:
+            entries = [(entry, entry.lastused) for entry in self._entries.values()
+                       if entry.lastused > entry.flushed]
+        for entry, lastused in entries:
+            lastused_path = os.path.join(self.cache_dir, entry.name, 'lastused')
+            try:
+                if not os.path.exists(lastused_path):
+                    file(lastused_path, 'w').close()
+                os.utime(lastused_path, (lastused, lastused))
+                entry.flushed = lastused
+            except (IOError, OSError):
+                # The build was evicted.
+                pass
+
+    def clean_cache(self):
+        """Evict builds from the cache.
 
-        builds = [(x, os.stat(lastused_path(x)).st_mtime) for x in
-                  os.listdir(self.cache_dir) if not keep_build(x)]
-        builds.sort(key=lambda x: x[1])
-        while len(builds) > self.build_cache_size:
-            b = builds.pop(0)[0]
-            logger.info('Expiring %s' % b)
-            shutil.rmtree(os.path.join(self.cache_dir, b))
+        Builds are evicted in least recently used order until the total
+        size of the cache is at most build_cache_max_bytes. In addition,
+        only build_cache_size of the builds which have not been used in
+        build_cache_expires days are kept. A build is never evicted
+        while a get is in progress for it or for JOB_PIN_SECONDS after
+        it was last used.
+
+        clean_cache is normally called by the eviction thread after
+        each get and every EVICT_INTERVAL seconds.
+        """
+        with self._lock:
+            scanned = self._scanned
+            if not scanned:
+                self._scan_cache()
+                self._scanned = True
+        if not scanned:
+            self._collect_store()
+        self._measure_entries()
+        self._flush_lastused()
+
+        while self._evict():
+            pass
+
+    def _evict(self):
+        """Evict the builds selected by clean_cache's rules. Returns True
+        if builds were evicted and the rules should be applied again.
+
+        Evicting a build only frees the files it shares with the store
+        once no other build links to them. So while the store is in
+        use, builds are evicted to meet build_cache_max_bytes one at a
+        time, and the store is collected in between.
+        """
+        now = time.time()
+        expires = now - self.build_cache_expires * 24 * 60 * 60
+        with self._lock:
+            entries = sorted(self._entries.values(), key=lambda e: e.lastused)
+            total = (sum([entry.size or 0 for entry in entries]) +
+                     (self._store_size or 0))
+            evictable = [entry for entry in entries
+                         if not entry.active and
+                         now - entry.lastused > self.JOB_PIN_SECONDS]
+            expired = [entry for entry in evictable if entry.lastused < expires]
+            victims = expired[:max(0, len(expired) - self.build_cache_size)]
+            total -= sum([entry.size or 0 for entry in victims])
+            if self.build_cache_max_bytes:
+                for entry in evictable:
+                    if (total <= self.build_cache_max_bytes or
+                        (victims and self._store_size)):
+                        break
+                    if entry not in victims:
+                        victims.append(entry)
+                        total -= entry.size or 0
+                if total > self.build_cache_max_bytes and not victims:
+                    logger.warning('BuildCache: %d bytes of builds in use exceed '
+                                   'build_cache_max_bytes %d' %
+                                   (total, self.build_cache_max_bytes))
+            # Move the evicted directories out of the way while the
+            # lock is held so that a subsequent get of the same build
+            # starts from an empty directory.
+            evicted = []
+            for entry in victims:
+                logger.info('Expiring %s' % entry.name)
+                del self._entries[entry.name]
+                path = os.path.join(self.cache_dir, entry.name)
+                self._metadata.pop(path, None)
+                evicting_path = os.path.join(self.cache_dir,
+                                             '.evicting-%s' % entry.name)
+                try:
+                    os.rename(path, evicting_path)
+                    evicted.append(evicting_path)
+                except OSError:
+                    pass
+        for path in evicted:
+            shutil.rmtree(path, ignore_errors=True)
+        if evicted:
+            self._collect_store()
+        return bool(victims)
 
     def build_metadata(self, build_url, build_dir):
-        # If the build is a local build, do not rely on any
-        # existing cached build.
-        remote = urlparse.urlparse(build_url).scheme.startswith('http')
+        """Returns the BuildMetadata of build_dir/build.apk or None if
+        the apk is bad.
+
+        The metadata is memoized in memory and in build_dir/metadata.json
+        keyed by the build url and the size and modification time of
+        build.apk so that the apk is only read again when the build
+        changes. The Treeherder revision_hash is persisted with the
+        metadata and is only looked up again if it was not resolved.
+        """
+        build_path = os.path.join(build_dir, 'build.apk')
         build_metadata_path = os.path.join(build_dir, 'metadata.json')
-        if remote and os.path.exists(build_metadata_path):
+        stat = os.stat(build_path)
+        key = {'url': build_url, 'size': stat.st_size, 'mtime': stat.st_mtime}
+        with self._lock:
+            saved = self._metadata.get(build_dir)
+        if not saved:
             try:
-                return BuildMetadata().from_json(
-                    json.loads(file(build_metadata_path).read()))
+                saved = json.loads(file(build_metadata_path).read())
             except (ValueError, IOError):
+                saved = {}
+        metadata = None
+        if saved.get('key') == key:
+            try:
+                metadata = BuildMetadata().from_json(saved['metadata'])
+            except (KeyError, TypeError, ValueError):
                 pass
-        tmpdir = tempfile.mkdtemp()
+        if not metadata:
+            metadata = self._read_metadata(build_url, build_dir, build_path)
+            if not metadata:
+                return None
+            # A local build is copied into the cache each time it is
+            # used, so keep the revision_hash if the revision is the
+            # same.
+            previous = saved.get('metadata') or {}
+            if (previous.get('tree') == metadata.tree and
+                previous.get('revision') == metadata.revision):
+                metadata.revision_hash = previous.get('revision_hash')
+        if not metadata.revision_hash and self.treeherder_url:
+            metadata.lookup_revision_hash(self.treeherder_url)
+        # The symbols are fetched after the metadata is first saved.
+        symbols = os.path.join(metadata.dir, 'symbols')
+        metadata.symbols = symbols if os.path.exists(symbols) else None
+
+        current = {'key': key, 'metadata': metadata.to_json()}
+        if current != saved:
+            file(build_metadata_path, 'w').write(json.dumps(current))
+        with self._lock:
+            self._metadata[build_dir] = current
+        return metadata
+
+    def _read_metadata(self, build_url, build_dir, build_path):
         try:
-            build_path = os.path.join(build_dir, 'build.apk')
             apkfile = zipfile.ZipFile(build_path)
-            apkfile.extract('application.ini', tmpdir)
-            apkfile.extract('package-name.txt', tmpdir)
+            application_ini = apkfile.read('application.ini')
+            procname = apkfile.read('package-name.txt').strip()
+            apkfile.close()
         except zipfile.BadZipfile:
             # we should have already tried to redownload bad zips, so treat
             # this as fatal.
             logger.exception('%s is a bad apk; aborting job.' % build_path)
-            shutil.rmtree(tmpdir)
             return None
-        with open(os.path.join(tmpdir, 'package-name.txt')) as package_file:
-            procname = package_file.read().strip()
         cfg = ConfigParser.RawConfigParser()
-        cfg.read(os.path.join(tmpdir, 'application.ini'))
+        cfg.readfp(StringIO.StringIO(application_ini), 'application.ini')
         rev = cfg.get('App', 'SourceStamp')
         ver = cfg.get('App', 'Version')
         try:
@@ -785,22 +1800,17 @@ class BuildCache(object):
                 break
         if not tree:
             raise BuildCacheException('build %s contains an unknown SourceRepository %s' %
-                                      (apkfile, repo))
+                                      (build_path, repo))
 
         build_type = 'debug' if 'debug' in build_url else 'opt'
-        metadata = BuildMetadata(url=build_url,
-                                 dir=build_dir,
-                                 tree=tree,
-                                 id=buildid,
-                                 revision='%srev/%s' % (repo_urls[tree], rev),
-                                 app_name=procname,
-                                 version=ver,
-                                 build_type=build_type,
-                                 treeherder_url=self.treeherder_url)
-        shutil.rmtree(tmpdir)
-        if metadata:
-            file(build_metadata_path, 'w').write(json.dumps(metadata.to_json()))
-        return metadata
+        return BuildMetadata(url=build_url,
+                             dir=build_dir,
+                             tree=tree,
+                             id=buildid,
+                             revision='%srev/%s' % (repo_urls[tree], rev),
+                             app_name=procname,
+                             version=ver,
+                             build_type=build_type)
 
 
 class BuildMetadata(object):
@@ -813,7 +1823,8 @@ class BuildMetadata(object):
                  app_name=None,
                  version=None,
                  build_type=None,
-                 treeherder_url=None):
+                 treeherder_url=None,
+                 revision_hash=None):
         self._date = None
         self.url = url
         if not dir:
@@ -830,20 +1841,31 @@ class BuildMetadata(object):
         self.revision = revision
         self.app_name = app_name
         self.version = version
-        self.revision_hash = None
-
-        if treeherder_url:
-            # TODO: Should be consistent with changeset and revision
-            # variable names in terms of the changeset url and the
-            # revision id.
-            changeset = os.path.basename(urlparse.urlparse(revision).path)
-            self.revision_hash = utils.get_treeherder_revision_hash(
-                treeherder_url, tree, changeset)
-            if not self.revision_hash:
-                logger.warning('Failed to get the revision_hash for %s' %
-                               self.revision)
+        self.revision_hash = revision_hash
+        if treeherder_url and not revision_hash:
+            self.lookup_revision_hash(treeherder_url)
         logger.debug('BuildMetadata: %s' % self.__dict__)
 
+    def lookup_revision_hash(self, treeherder_url):
+        """Sets revision_hash to the Treeherder revision_hash of the
+        build's changeset and returns it."""
+        # TODO: Should be consistent with changeset and revision
+        # variable names in terms of the changeset url and the
+        # revision id.
+        changeset = os.path.basename(urlparse.urlparse(self.revision).path)
+        self.revision_hash = utils.get_treeherder_revision_hash(
+            treeherder_url, self.tree, changeset)
+        if not self.revision_hash:
+            logger.warning('Failed to get the revision_hash for %s' %
+                           self.revision)
+        return self.revision_hash
+
+    @property
+    def symbols_url(self):
+        """The url of the build's crashreporter symbols zip file."""
+        # XXX: assumes fixed buildurl-> symbols_url mapping
+        return re.sub('.apk$', '.crashreporter-symbols.zip', self.url)
+
     @property
     def date(self):
         if not self._date:
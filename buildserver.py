@@ -11,10 +11,67 @@ import urlparse
 
 DEFAULT_PORT = 28008
 
+class BuildFetch(object):
+    """A BuildCache.get or BuildCache.get_symbols in progress in the
+    BuildCacheServer."""
+
+    def __init__(self, force, enable_unittests, symbols=False):
+        self.force = force
+        self.enable_unittests = enable_unittests
+        self.symbols = symbols
+        self.results = None
+        self.done = threading.Event()
+
+    def satisfies(self, force, enable_unittests, symbols=False):
+        """Returns True if the results of this fetch can be used for a
+        request with the given options."""
+        return ((self.force or not force) and
+                (self.enable_unittests or not enable_unittests) and
+                self.symbols == symbols)
+
+
 class BuildCacheServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """Serves builds from build_cache to the workers.
+
+    Requests for different builds are handled concurrently. Concurrent
+    requests for the same build share a single BuildCache.get. Requests
+    for a build's symbols are serialized with the requests for the
+    build. The number of simultaneous downloads is limited by the
+    BuildCache.
+    """
 
     build_cache = None
-    cache_lock = threading.Lock()
+
+    def __init__(self, *args, **kwargs):
+        SocketServer.TCPServer.__init__(self, *args, **kwargs)
+        self.fetches_lock = threading.Lock()
+        self.fetches = {}
+
+    def get(self, build, force=False, enable_unittests=False, symbols=False):
+        while True:
+            with self.fetches_lock:
+                fetch = self.fetches.get(build)
+                if not fetch:
+                    fetch = BuildFetch(force, enable_unittests, symbols)
+                    self.fetches[build] = fetch
+                    break
+            fetch.done.wait()
+            if (fetch.results and fetch.results.get('success') and
+                fetch.satisfies(force, enable_unittests, symbols)):
+                return fetch.results
+            # The fetch failed or did not fetch everything this request
+            # needs. Fetch the build again.
+        try:
+            if symbols:
+                fetch.results = self.build_cache.get_symbols(build)
+            else:
+                fetch.results = self.build_cache.get(
+                    build, force=force, enable_unittests=enable_unittests)
+        finally:
+            with self.fetches_lock:
+                del self.fetches[build]
+            fetch.done.set()
+        return fetch.results
 
 
 class BuildCacheHandler(SocketServer.BaseRequestHandler):
@@ -43,17 +100,14 @@ class BuildCacheHandler(SocketServer.BaseRequestHandler):
                     return
                 cmds = line.split()
                 build = cmds[0]
-                force = False
-                enable_unittests = False
-                cmds = cmds[1:]
-                for cmd in cmds:
-                    force = (cmd.lower() == 'force')
-                    enable_unittests = (cmd.lower() == 'enable_unittests')
-                self.server.cache_lock.acquire()
-                results = self.server.build_cache.get(build,
-                                                      force=force,
-                                                      enable_unittests=enable_unittests)
-                self.server.cache_lock.release()
+                cmds = [cmd.lower() for cmd in cmds[1:]]
+                force = 'force' in cmds
+                enable_unittests = 'enable_unittests' in cmds
+                symbols = 'symbols' in cmds
+                results = self.server.get(build,
+                                          force=force,
+                                          enable_unittests=enable_unittests,
+                                          symbols=symbols)
                 self.request.send(json.dumps(results) + '\n')
 
 
@@ -81,6 +135,17 @@ class BuildCacheClient(object):
             line += ' force'
         if enable_unittests:
             line += ' enable_unittests'
+        return self._request(line)
+
+    def get_symbols(self, url):
+        """Returns a dict whose 'symbols' item is the path to the
+        directory containing the crashreporter symbols of the build
+        or None if there are none."""
+        if not self.sock:
+            self.connect()
+        return self._request(url + ' symbols')
+
+    def _request(self, line):
         self.sock.sendall(line + '\n')
         buf = ''
         while not '\n' in buf:
@@ -7,6 +7,7 @@ import json
 import logging
 import os
 import sqlite3
+import threading
 import time
 import traceback
 
@@ -19,11 +20,18 @@ class Jobs(object):
     MAX_ATTEMPTS = 3
     SQL_RETRY_DELAY = 60
     SQL_MAX_RETRIES = 10
+    # Number of seconds sqlite waits for a lock held by another
+    # connection before raising OperationalError.
+    SQL_BUSY_TIMEOUT = 60
+    # Version of the database schema stored in the user_version pragma.
+    # Increment it and add a step to _migrate when changing the schema.
+    SCHEMA_VERSION = 1
 
     def __init__(self, mailer, default_device=None):
         self.mailer = mailer
         self.default_device = default_device
         self.filename = 'jobs.sqlite'
+        self._local = threading.local()
 
         if not os.path.exists(self.filename):
             conn = self._conn()
@@ -49,7 +57,44 @@ class Jobs(object):
                          'repos text, '
                          'jobid integer)')
             conn.commit()
-            conn.close()
+        self._migrate()
+
+    def _migrate(self):
+        """Upgrade the database schema to SCHEMA_VERSION.
+
+        Version 1 adds the is_try column which replaces ordering the
+        jobs by instr(build_url, "try"), the indexes used by
+        get_next_job, its sweep of failed jobs and the tests queries,
+        and switches the database to write-ahead logging so that
+        readers do not block writers.
+        """
+        conn = self._conn()
+        self._execute_sql(conn, 'pragma journal_mode=wal')
+        cursor = self._execute_sql(conn, 'pragma user_version')
+        version = cursor.fetchone()[0]
+        cursor.close()
+        if version < 1:
+            logger.info('jobs: migrating %s to schema version 1' %
+                        self.filename)
+            columns = [row[1] for row in
+                       self._execute_sql(conn, 'pragma table_info(jobs)')]
+            if 'is_try' not in columns:
+                self._execute_sql(conn, 'alter table jobs add column '
+                                  'is_try int default 0')
+            self._execute_sql(conn, 'update jobs set '
+                              'is_try=(instr(build_url, "try") > 0)')
+            self._execute_sql(conn, 'create index if not exists '
+                              'jobs_device_is_try_created '
+                              'on jobs(device, is_try, created)')
+            self._execute_sql(conn, 'create index if not exists '
+                              'jobs_device_attempts '
+                              'on jobs(device, attempts)')
+            self._execute_sql(conn, 'create index if not exists '
+                              'tests_jobid on tests(jobid)')
+            self._execute_sql(conn, 'create index if not exists '
+                              'tests_guid on tests(guid)')
+            self._execute_sql(conn, 'pragma user_version=1')
+        self._commit_connection(conn)
 
     def report_sql_error(self, attempt, email_sent, sql, values):
         message = '%s %s' % (sql, values)
@@ -68,18 +113,38 @@ class Jobs(object):
         return email_sent
 
     def _conn(self):
+        """Return the current thread's connection to the jobs database,
+        opening it on first use.
+
+        Each thread keeps its connection open for the life of the
+        thread so that sqlite can reuse its prepared statements.
+        Connections are never shared with child processes. Contention
+        with other processes is handled by sqlite's busy timeout.
+        Any transaction left open by a previously failed operation is
+        rolled back.
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn and self._local.pid == os.getpid():
+            conn.rollback()
+            return conn
         attempt = 0
         email_sent = False
         while True:
             attempt += 1
             try:
-                conn = sqlite3.connect(self.filename)
+                conn = sqlite3.connect(self.filename,
+                                       timeout=self.SQL_BUSY_TIMEOUT)
+                # synchronous=normal is safe when using write-ahead
+                # logging and avoids syncing on every commit.
+                conn.execute('pragma synchronous=normal')
                 break
             except sqlite3.OperationalError:
                 email_sent = self.report_sql_error(
                     attempt, email_sent,
                     'connect(%s)' % self.filename,
                     None)
+        self._local.conn = conn
+        self._local.pid = os.getpid()
         return conn
 
     def _commit_connection(self, conn):
@@ -96,19 +161,12 @@ class Jobs(object):
                     '_commit_connection(%s)' % self.filename,
                     None)
 
-    def _close_connection(self, conn):
-        attempt = 0
-        email_sent = False
-        while True:
-            attempt += 1
-            try:
-                conn.close()
-                break
-            except sqlite3.OperationalError:
-                email_sent = self.report_sql_error(
-                    attempt, email_sent,
-                    '_close_connection(%s)' % self.filename,
-                    None)
+    def close(self):
+        """Close the current thread's connection to the jobs database."""
+        conn = getattr(self._local, 'conn', None)
+        if conn and self._local.pid == os.getpid():
+            conn.close()
+        self._local.conn = None
 
     def _execute_sql(self, conn, sql, values=()):
         """Execute sql statement.
@@ -131,19 +189,50 @@ class Jobs(object):
         self._execute_sql(conn, 'delete from tests')
         self._execute_sql(conn, 'delete from jobs')
         self._commit_connection(conn)
-        self._close_connection(conn)
 
     def new_job(self, build_url, build_id=None, changeset=None, tree=None,
                 revision=None, revision_hash=None, tests=None,
                 enable_unittests=False, device=None):
+        """Add the tests for build_url on device to the jobs database.
+
+        Returns a tuple of the id of the job and the list of tests
+        which were added. Tests which are already queued for the job
+        are not added again.
+        """
+        return self.new_jobs([{'build_url': build_url,
+                               'build_id': build_id,
+                               'changeset': changeset,
+                               'tree': tree,
+                               'revision': revision,
+                               'revision_hash': revision_hash,
+                               'tests': tests,
+                               'enable_unittests': enable_unittests,
+                               'device': device}])[0]
+
+    def new_jobs(self, jobs):
+        """Add several jobs to the jobs database in a single transaction.
+
+        :param jobs: list of dicts each containing the keyword
+            arguments of new_job.
+
+        Returns a list of the (job id, new tests) tuples returned by
+        new_job for each of jobs.
+        """
+        now = datetime.datetime.now().isoformat()
+        conn = self._conn()
+        results = [self._insert_job(conn, now, **job) for job in jobs]
+        self._commit_connection(conn)
+        return results
+
+    def _insert_job(self, conn, now, build_url, build_id=None, changeset=None,
+                    tree=None, revision=None, revision_hash=None, tests=None,
+                    enable_unittests=False, device=None):
         logger.debug('jobs.new_job: %s %s %s %s %s %s %s %s %s' % (
             build_url, build_id, changeset, tree, revision, revision_hash,
             tests, enable_unittests, device))
         if not device:
             device = self.default_device
-        now = datetime.datetime.now().isoformat()
 
-        conn = self._conn()
         job_cursor = self._execute_sql(
             conn,
             'select id from jobs where device=? and build_url=?',
@@ -156,9 +245,13 @@ class Jobs(object):
         else:
             job_cursor = self._execute_sql(
                 conn,
-                'insert into jobs values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0, ?)',
+                'insert into jobs (id, created, last_attempt, build_url, '
+                'build_id, changeset, tree, revision, revision_hash, '
+                'enable_unittests, attempts, device, is_try) '
+                'values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0, ?, ?)',
                 values=(None, now, None, build_url, build_id, changeset, tree,
-                        revision, revision_hash, enable_unittests, device))
+                        revision, revision_hash, enable_unittests, device,
+                        'try' in build_url))
             job_id = job_cursor.lastrowid
             job_cursor.close()
 
@@ -186,10 +279,8 @@ class Jobs(object):
                 'insert into tests values (?, ?, ?, ?, ?, ?, ?)',
                 values=(None, test.name, test.config_file, test.chunk,
                         test.job_guid, repos, job_id))
-        self._commit_connection(conn)
-        self._close_connection(conn)
 
-        return new_tests
+        return job_id, new_tests
 
     def jobs_pending(self, device=None):
         conn = self._conn()
@@ -201,7 +292,6 @@ class Jobs(object):
             values=(device,))
         count = cursor.fetchone()[0]
         cursor.close()
-        self._close_connection(conn)
         return count
 
     def set_job_attempts(self, jobid, attempts):
@@ -220,17 +310,13 @@ class Jobs(object):
 
         conn = self._conn()
 
-        # Find the ids of the jobs whose attempts exceed the maximum.
-        # First delete the associated tests, then the jobs.
-        job_cursor = self._execute_sql(
+        # Delete the jobs whose attempts exceed the maximum. First
+        # delete the associated tests, then the jobs.
+        self._execute_sql(
             conn,
-            'select id from jobs where device=? and attempts>=?',
+            'delete from tests where jobid in '
+            '(select id from jobs where device=? and attempts>=?)',
             values=(device, self.MAX_ATTEMPTS))
-        job_ids = [job[0] for job in job_cursor]
-        for job_id in job_ids:
-            self._execute_sql(conn, 'delete from tests where jobid=?',
-                              values=(job_id,))
-        job_cursor.close()
         self._execute_sql(
             conn,
             'delete from jobs where device=? and attempts>=?',
@@ -238,19 +324,24 @@ class Jobs(object):
 
         self._commit_connection(conn)
 
-        job_cursor = self._execute_sql(
-            conn,
-            'select id,created,last_attempt,build_url,'
-            'build_id,changeset,tree,revision,revision_hash,'
-            'enable_unittests,attempts,instr(build_url,"try") as istry '
-            'from jobs where device=? order by istry desc, '
-            'created %s' % order,
-            values=(device,))
-
-        job_row = job_cursor.fetchone()
-        job_cursor.close()
+        # Try jobs take precedence. Querying each kind separately
+        # allows the jobs_device_is_try_created index to satisfy the
+        # ordering in either direction.
+        job_row = None
+        for is_try in (1, 0):
+            job_cursor = self._execute_sql(
+                conn,
+                'select id,created,last_attempt,build_url,'
+                'build_id,changeset,tree,revision,revision_hash,'
+                'enable_unittests,attempts,is_try '
+                'from jobs where device=? and is_try=? '
+                'order by created %s limit 1' % order,
+                values=(device, is_try))
+            job_row = job_cursor.fetchone()
+            job_cursor.close()
+            if job_row:
+                break
         if not job_row:
-            self._close_connection(conn)
             return None
 
         job = {'id': job_row[0],
@@ -304,7 +395,6 @@ class Jobs(object):
                     job['tests'].append(test)
         logger.debug('jobs.get_next_job: %s' % job)
         self._commit_connection(conn)
-        self._close_connection(conn)
         return job
 
     def cancel_test(self, test_guid, device=None):
@@ -327,7 +417,6 @@ class Jobs(object):
         if not job_ids:
             logger.debug('jobs.cancel_test: test %s for device %s '
                          'already deleted' % (test_guid, device))
-            self._close_connection(conn)
             return
 
         job_id = job_ids[0]
@@ -355,14 +444,12 @@ class Jobs(object):
                 'delete from jobs where id=?',
                 values=(job_id,))
         self._commit_connection(conn)
-        self._close_connection(conn)
 
     def test_completed(self, test_guid):
         logger.debug('jobs.test_completed: %s' % test_guid)
         conn = self._conn()
         self._execute_sql(conn, 'delete from tests where guid=?', values=(test_guid,))
         self._commit_connection(conn)
-        self._close_connection(conn)
 
     def job_completed(self, job_id):
         logger.debug('jobs.job_completed: %s' % job_id)
@@ -370,4 +457,3 @@ class Jobs(object):
         self._execute_sql(conn, 'delete from tests where jobid=?', values=(job_id,))
         self._execute_sql(conn, 'delete from jobs where id=?', values=(job_id,))
         self._commit_connection(conn)
-        self._close_connection(conn)
@@ -0,0 +1,92 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import re
+
+
+class LogcatEventMatcher(object):
+    """Extracts the timestamps of the first occurrences of named events
+    from logcat output in the 'time' format.
+
+    The events are given as a list of (name, pattern) tuples in order
+    of precedence where pattern is a regular expression which is
+    matched against the text following the timestamp of a line. A line
+    is attributed to the first event in the list which has not already
+    been found and whose pattern matches the line.
+
+    The patterns of the events which remain to be found are combined
+    into a single alternation so that each line is matched once. The
+    combined expressions are cached so that a matcher can be reset and
+    reused without recompiling them.
+
+    Lines can be fed incrementally as they become available:
+
+    ::
+
+       matcher = LogcatEventMatcher([('start', '.*Gecko'),
+                                     ('stop', '.*Throbber stop')])
+       cursor = None
+       while not matcher.done:
+           lines, cursor = logcat.get_since(cursor)
+           matcher.feed(lines)
+       print matcher.base_time, matcher.times['stop']
+
+    """
+    timestamp_pattern = r'(\d{2}-\d{2} \d{2}:\d{2}:\d{2}\.\d{3})'
+
+    def __init__(self, events):
+        self.events = list(events)
+        self._re_timestamp = re.compile(self.timestamp_pattern)
+        self._compiled = {}
+        self.reset()
+
+    def reset(self):
+        """Forget any events found so far."""
+        #: timestamp of the first line containing a timestamp.
+        self.base_time = None
+        #: dictionary of event names and their timestamps.
+        self.times = {}
+        #: number of lines fed to the matcher.
+        self.lines = 0
+        self._update()
+
+    def _update(self):
+        self._remaining = tuple([i for i, (name, pattern) in
+                                 enumerate(self.events)
+                                 if name not in self.times])
+        if self._remaining and self._remaining not in self._compiled:
+            alternatives = ['(?P<event%d>%s)' % (i, self.events[i][1])
+                            for i in self._remaining]
+            self._compiled[self._remaining] = re.compile(
+                '%s (?:%s)' % (self.timestamp_pattern,
+                               '|'.join(alternatives)))
+        self._re_events = self._compiled.get(self._remaining)
+
+    @property
+    def done(self):
+        """True if all of the events have been found."""
+        return not self._remaining
+
+    def feed(self, lines):
+        """Scan lines for events returning True if all of the events
+        have been found.
+
+        :param lines: list of logcat lines.
+        """
+        for line in lines:
+            if not self._remaining:
+                break
+            self.lines += 1
+            if self.base_time is None:
+                match = self._re_timestamp.match(line)
+                if match:
+                    self.base_time = match.group(1)
+            match = self._re_events.match(line)
+            if match:
+                for i in self._remaining:
+                    if match.group('event%d' % i) is not None:
+                        self.times[self.events[i][0]] = match.group(1)
+                        self._update()
+                        break
+        return self.done
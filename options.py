@@ -4,6 +4,7 @@
 
 from urlparse import urlparse
 
+from buildindex import BuildIndex
 from builds import BuildCache
 from worker import Crashes, PhoneWorker
 
@@ -54,15 +55,24 @@ class AutophoneOptions(object):
         # ini options
         self.build_cache_size = BuildCache.MAX_NUM_BUILDS
         self.build_cache_expires = BuildCache.EXPIRE_AFTER_DAYS
+        self.build_cache_max_downloads = BuildCache.MAX_DOWNLOADS
+        self.build_cache_max_bytes = BuildCache.MAX_CACHE_BYTES
+        self.http_cache_dir = ''
+        self.build_index = BuildIndex.FILENAME
         self.device_ready_retry_wait = PhoneWorker.DEVICE_READY_RETRY_WAIT
         self.device_ready_retry_attempts = PhoneWorker.DEVICE_READY_RETRY_ATTEMPTS
         self.device_battery_min = PhoneWorker.DEVICE_BATTERY_MIN
         self.device_battery_max = PhoneWorker.DEVICE_BATTERY_MAX
+        self.device_init_concurrency = PhoneWorker.DEVICE_INIT_CONCURRENCY
+        self.device_init_timeout = PhoneWorker.DEVICE_INIT_TIMEOUT
+        self.device_shell_session = False
+        self.device_logcat_stream = False
         self.phone_retry_limit = PhoneWorker.DEVICE_READY_RETRY_ATTEMPTS
         self.phone_retry_wait = PhoneWorker.DEVICE_READY_RETRY_WAIT
         self.phone_max_reboots = PhoneWorker.PHONE_MAX_REBOOTS
         self.phone_ping_interval = PhoneWorker.PHONE_PING_INTERVAL
         self.phone_command_queue_timeout = PhoneWorker.PHONE_COMMAND_QUEUE_TIMEOUT
+        self.phone_job_sweep_interval = PhoneWorker.PHONE_JOB_SWEEP_INTERVAL
         self.phone_crash_window = Crashes.CRASH_WINDOW
         self.phone_crash_limit = Crashes.CRASH_LIMIT
         # other
@@ -114,15 +124,24 @@ class AutophoneOptions(object):
                      '_treeherder_server',
                      'build_cache_size',
                      'build_cache_expires',
+                     'build_cache_max_downloads',
+                     'build_cache_max_bytes',
+                     'http_cache_dir',
+                     'build_index',
                      'device_ready_retry_wait',
                      'device_ready_retry_attempts',
                      'device_battery_min',
                      'device_battery_max',
+                     'device_init_concurrency',
+                     'device_init_timeout',
+                     'device_shell_session',
+                     'device_logcat_stream',
                      'phone_retry_limit',
                      'phone_retry_wait',
                      'phone_max_reboots',
                      'phone_ping_interval',
                      'phone_command_queue_timeout',
+                     'phone_job_sweep_interval',
                      'phone_crash_window',
                      'phone_crash_limit',
                      'debug')
@@ -6,12 +6,15 @@ import ConfigParser
 import datetime
 import logging
 import os
+import posixpath
 import shutil
+import socket
 import tempfile
 import time
 
 from mozprofile import FirefoxProfile
 
+import buildserver
 import utils
 from adb import ADBError
 from logdecorator import LogDecorator
@@ -23,10 +26,40 @@ logger = logging.getLogger()
 
 
 class Logcat(object):
+    # Number of lines preceding the position of a cursor which are
+    # kept in the cursor when logcat is dumped rather than streamed.
+    # They are used to find the position again if lines have been
+    # dropped from the front of the device's logcat buffer.
+    CURSOR_TAIL_LINES = 5
+
     def __init__(self, phonetest):
         self.phonetest = phonetest
         self._accumulated_logcat = []
         self._last_logcat = []
+        # If options.device_logcat_stream is set, logcat is collected
+        # by a long running adb logcat process rather than dumping the
+        # device's logcat on each call to get(). Cursors are counted
+        # from the start of the first stream so that they remain
+        # valid if the stream must be restarted, e.g. after a reboot.
+        self._stream = None
+        self._stream_base = 0
+        self._clear_cursor = 0
+
+    def _get_stream(self):
+        if self._stream and not self._stream.is_alive():
+            self.phonetest.loggerdeco.warning('Restarting logcat stream')
+            self._stream_base += self._stream.cursor
+            self._stream.stop()
+            self._stream = None
+        if not self._stream:
+            self._stream = self.phonetest.dm.get_logcat_stream(
+                filter_specs=['*:V'])
+        return self._stream
+
+    def _get_stream_since(self, cursor):
+        stream = self._get_stream()
+        lines, cursor = stream.get_since(cursor - self._stream_base)
+        return lines, cursor + self._stream_base
 
     def get(self, full=False):
         """Return the contents of logcat as list of strings.
@@ -38,6 +71,21 @@ class Logcat(object):
                      logcat output since the test was initialized or
                      teardown_job was last called.
 
+        """
+        if self.phonetest.options.device_logcat_stream:
+            self._last_logcat, _ = self._get_stream_since(self._clear_cursor)
+            output = []
+            if full:
+                output.extend(self._accumulated_logcat)
+            output.extend(self._last_logcat)
+            return output
+        return self.get_dump(full=full)
+
+    def get_dump(self, full=False):
+        """Return the contents of logcat as list of strings by dumping
+        the device's logcat regardless of whether a logcat stream is
+        being used. See get().
+
         """
         for attempt in range(1, self.phonetest.options.phone_retry_limit+1):
             try:
@@ -56,13 +104,78 @@ class Logcat(object):
                     raise
                 time.sleep(self.phonetest.options.phone_retry_wait)
 
+    def get_since(self, cursor=None):
+        """Return a tuple containing the list of logcat lines since cursor
+        and a cursor positioned after them.
+
+        :param cursor: optional cursor returned by a previous call to
+                       get_since(). If cursor is None, all lines since
+                       the last call to clear() are returned. Cursors
+                       are invalidated by clear().
+
+        """
+        if self.phonetest.options.device_logcat_stream:
+            if cursor is None:
+                cursor = self._clear_cursor
+            return self._get_stream_since(cursor)
+        lines = self.get()
+        start = 0
+        if cursor is not None:
+            start = self._find_cursor(lines, cursor)
+        return lines[start:], (len(lines), lines[-self.CURSOR_TAIL_LINES:])
+
+    def _find_cursor(self, lines, cursor):
+        """Return the index of the first line of a logcat dump which
+        follows the lines read up to cursor.
+
+        A dump cursor is a tuple of the number of lines read and the
+        last of those lines. If the device's logcat buffer has wrapped
+        since cursor was returned, lines have been dropped from the
+        front of the dump, so the last lines are searched for before
+        their expected position. If they are no longer present, all
+        of the lines are new.
+        """
+        count, tail = cursor
+        if not tail:
+            return 0
+        for i in range(min(count, len(lines)) - len(tail), -1, -1):
+            if lines[i:i + len(tail)] == tail:
+                return i + len(tail)
+        return 0
+
     def clear(self):
         """Clears the device's logcat."""
+        if self.phonetest.options.device_logcat_stream:
+            if not self._stream:
+                # Collect the existing logcat and clear it before
+                # starting the stream so that the stream only returns
+                # lines logged after the clear.
+                self.get_dump()
+                self._accumulated_logcat.extend(self._last_logcat)
+                self._last_logcat = []
+                self.phonetest.dm.clear_logcat()
+                self._clear_cursor = self._stream_base
+                self._get_stream()
+                return
+            lines, self._clear_cursor = self._get_stream_since(
+                self._clear_cursor)
+            self._accumulated_logcat.extend(lines)
+            self._last_logcat = []
+            # Clear the device's logcat as well so that a restarted
+            # stream does not repeat lines which were already read.
+            self.phonetest.dm.clear_logcat()
+            return
         self.get()
         self._accumulated_logcat.extend(self._last_logcat)
         self._last_logcat = []
         self.phonetest.dm.clear_logcat()
 
+    def stop(self):
+        """Stops the logcat stream if one is running."""
+        if self._stream:
+            self._stream.stop()
+            self._stream = None
+
 
 class PhoneTest(object):
     # Use instances keyed on phoneid+':'config_file+':'+str(chunk)
@@ -337,11 +450,37 @@ class PhoneTest(object):
         self.update_status(message=message)
         self.test_result.add_failure(testpath, status, message, testresult_status)
 
+    def get_symbols(self):
+        """Return the path to the directory containing the build's
+        symbols, fetching them from the build cache server the first
+        time they are needed. Returns None if the build has no
+        symbols."""
+        if not self.build.symbols:
+            client = buildserver.BuildCacheClient(port=self.options.build_cache_port)
+            self.update_status(message='Fetching symbols for %s' % self.build.id)
+            try:
+                response = client.get_symbols(self.build.url)
+            except (socket.error, ValueError), e:
+                # The crashes are still reported, without symbols.
+                self.loggerdeco.warning('Could not get symbols for %s: %s' %
+                                        (self.build.url, e))
+                return None
+            finally:
+                if client.sock:
+                    client.close()
+            if response and response['success']:
+                self.build.symbols = response['symbols']
+            else:
+                self.loggerdeco.warning('Errors occured getting symbols for %s: %s' %
+                                        (self.build.url,
+                                         response['error'] if response else None))
+        return self.build.symbols
+
     def handle_crashes(self):
         if not self.crash_processor:
             return
 
-        for error in self.crash_processor.get_errors(self.build.symbols,
+        for error in self.crash_processor.get_errors(self.get_symbols,
                                                      self.options.minidump_stackwalk,
                                                      clean=False):
             if error['reason'] == 'java-exception':
@@ -461,6 +600,7 @@ class PhoneTest(object):
         self.start_time = None
         self.stop_time = None
         self._log = None
+        self.logcat.stop()
         self.logcat = Logcat(self)
         if self.loggerdeco_original:
             self.loggerdeco = self.loggerdeco_original
@@ -473,6 +613,15 @@ class PhoneTest(object):
                                   phone_status=phone_status,
                                   message=message)
 
+    def _check_shell_batch(self, cmds, root=False, ignore=0):
+        """Executes cmds using dm.shell_batch raising ADBError if any
+        of the commands after the first ignore commands failed."""
+        results = self.dm.shell_batch(cmds, root=root)
+        for cmd, (exitcode, output) in zip(cmds, results)[ignore:]:
+            if exitcode != 0:
+                raise ADBError('%s failed: exitcode: %s, output: %s' %
+                               (cmd, exitcode, output))
+
     def install_profile(self, profile=None, root=True):
         if not profile:
             profile = FirefoxProfile()
@@ -482,13 +631,25 @@ class PhoneTest(object):
         for attempt in range(1, self.options.phone_retry_limit+1):
             try:
                 self.loggerdeco.debug('Attempt %d installing profile' % attempt)
-                self.dm.rm(self.profile_path, recursive=True,
-                           force=True, root=root)
-                self.dm.chmod(profile_path_parent, root=root)
-                self.dm.mkdir(self.profile_path, root=root)
-                self.dm.chmod(self.profile_path, root=root)
+                # The profile need not exist before it is removed, so
+                # only the results after the rm are checked.
+                self._check_shell_batch(
+                    ['rm -r %s' % self.profile_path,
+                     'chmod 777 %s' % profile_path_parent,
+                     'mkdir %s' % self.profile_path,
+                     'chmod 777 %s' % self.profile_path],
+                    root=root, ignore=1)
                 self.dm.push(profile.profile, self.profile_path)
-                self.dm.chmod(self.profile_path, recursive=True, root=root)
+                cmds = []
+                for dirpath, dirnames, filenames in os.walk(profile.profile):
+                    relpath = os.path.relpath(dirpath, profile.profile)
+                    remote_dir = posixpath.normpath(
+                        posixpath.join(self.profile_path,
+                                       *relpath.split(os.sep)))
+                    for name in dirnames + filenames:
+                        cmds.append('chmod 777 %s' %
+                                    posixpath.join(remote_dir, name))
+                self._check_shell_batch(cmds, root=root)
                 success = True
                 break
             except ADBError:
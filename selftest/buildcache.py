@@ -4,9 +4,12 @@
 
 import datetime
 import logging
+import os
 import shutil
 import tempfile
+import time
 import unittest
+import zipfile
 
 import builds
 
@@ -32,3 +35,305 @@ class BuildsTest(unittest.TestCase):
         for l in buildlist:
             logging.info(l)
         self.assertTrue(buildlist)
+
+
+class BuildCacheEvictionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.now = time.time()
+        self.caches = []
+
+    def tearDown(self):
+        for cache in self.caches:
+            cache.close()
+        shutil.rmtree(self.cache_dir)
+
+    def build_cache(self, **kwargs):
+        cache = builds.BuildCache([], [], 'fennec', [], '.apk',
+                                  cache_dir=self.cache_dir, **kwargs)
+        cache.JOB_PIN_SECONDS = 60
+        self.caches.append(cache)
+        return cache
+
+    def add_build(self, name, size, age):
+        build_dir = os.path.join(self.cache_dir, name)
+        os.mkdir(build_dir)
+        with open(os.path.join(build_dir, 'build.apk'), 'wb') as f:
+            f.write('x' * size)
+        lastused_path = os.path.join(build_dir, 'lastused')
+        open(lastused_path, 'w').close()
+        lastused = self.now - age
+        os.utime(lastused_path, (lastused, lastused))
+
+    def cached_builds(self):
+        return sorted(os.listdir(self.cache_dir))
+
+    def test_byte_budget_evicts_least_recently_used(self):
+        self.add_build('a', 1000, 3000)
+        self.add_build('b', 1000, 2000)
+        self.add_build('c', 1000, 1000)
+        self.add_build('d', 1000, 0)
+        cache = self.build_cache(build_cache_max_bytes=2500)
+        cache.clean_cache()
+        self.assertEqual(self.cached_builds(), ['c', 'd'])
+
+    def test_recently_used_builds_are_pinned(self):
+        self.add_build('a', 1000, 3000)
+        self.add_build('b', 1000, 30)
+        self.add_build('c', 1000, 0)
+        cache = self.build_cache(build_cache_max_bytes=1000)
+        cache.clean_cache()
+        self.assertEqual(self.cached_builds(), ['b', 'c'])
+
+    def test_active_builds_are_pinned(self):
+        self.add_build('a', 1000, 3000)
+        self.add_build('b', 1000, 2000)
+        cache = self.build_cache(build_cache_max_bytes=1000)
+        cache.clean_cache()
+        self.assertEqual(self.cached_builds(), ['b'])
+        # b is the least recently used build but is not evicted while
+        # a get is in progress for it.
+        cache._entries['b'].active = 1
+        self.add_build('c', 1000, 1000)
+        cache._scanned = False
+        cache.clean_cache()
+        self.assertEqual(self.cached_builds(), ['b'])
+
+    def test_expired_builds_count(self):
+        day = 24 * 60 * 60
+        self.add_build('a', 1000, 4 * day)
+        self.add_build('b', 1000, 3 * day)
+        self.add_build('c', 1000, 2 * day)
+        self.add_build('d', 1000, 0)
+        cache = self.build_cache(build_cache_size=1, build_cache_expires=1)
+        cache.clean_cache()
+        self.assertEqual(self.cached_builds(), ['c', 'd'])
+
+    def test_lastused_is_flushed(self):
+        self.add_build('a', 1000, 3000)
+        cache = self.build_cache()
+        cache.clean_cache()
+        cache._entries['a'].lastused = self.now
+        cache.clean_cache()
+        self.assertEqual(
+            int(os.stat(os.path.join(self.cache_dir, 'a', 'lastused')).st_mtime),
+            int(self.now))
+
+
+class BuildCacheStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache = builds.BuildCache([], [], 'fennec', [], '.apk',
+                                       cache_dir=self.cache_dir)
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.cache_dir)
+
+    def extract(self, name, members):
+        zip_path = os.path.join(self.cache_dir, '%s.zip' % name)
+        tests_zipfile = zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED)
+        for member_name, data in members:
+            tests_zipfile.writestr(member_name, data)
+        tests_zipfile.close()
+        path = os.path.join(self.cache_dir, name)
+        os.mkdir(path)
+        self.cache._extract_shared(zipfile.ZipFile(zip_path), path)
+        os.unlink(zip_path)
+        return path
+
+    def store_files(self):
+        return [os.path.join(dirpath, filename)
+                for dirpath, dirnames, filenames in os.walk(self.cache.store_dir)
+                for filename in filenames]
+
+    def test_identical_files_are_shared(self):
+        a = self.extract('a', [('mochitest/common.js', 'common'),
+                               ('mochitest/a.js', 'a')])
+        b = self.extract('b', [('mochitest/common.js', 'common'),
+                               ('mochitest/a.js', 'b')])
+        self.assertEqual(open(os.path.join(b, 'mochitest', 'a.js')).read(), 'b')
+        self.assertEqual(
+            os.stat(os.path.join(a, 'mochitest', 'common.js')).st_ino,
+            os.stat(os.path.join(b, 'mochitest', 'common.js')).st_ino)
+        self.assertNotEqual(
+            os.stat(os.path.join(a, 'mochitest', 'a.js')).st_ino,
+            os.stat(os.path.join(b, 'mochitest', 'a.js')).st_ino)
+        self.assertEqual(len(self.store_files()), 3)
+        self.assertEqual(
+            os.stat(os.path.join(a, 'mochitest', 'common.js')).st_mode & 0222, 0)
+
+    def test_harness_files_are_not_shared(self):
+        members = [('mochitest/runtests.py', 'harness'),
+                   ('mochitest/mochitest.ini', 'config'),
+                   ('mochitest/test.html', 'test')]
+        a = self.extract('a', members)
+        b = self.extract('b', members)
+        for name, data in members[:2]:
+            a_path = os.path.join(a, name)
+            b_path = os.path.join(b, name)
+            self.assertEqual(os.stat(a_path).st_nlink, 1)
+            # The harness may rewrite its files without affecting
+            # other builds.
+            with open(a_path, 'w') as f:
+                f.write('changed')
+            self.assertEqual(open(b_path).read(), data)
+        self.assertEqual(
+            os.stat(os.path.join(a, 'mochitest', 'test.html')).st_ino,
+            os.stat(os.path.join(b, 'mochitest', 'test.html')).st_ino)
+        self.assertEqual([open(path).read() for path in self.store_files()],
+                         ['test'])
+
+    def test_unsafe_member_names(self):
+        a = self.extract('a', [('../../escape.txt', 'x'),
+                               ('/absolute.txt', 'y')])
+        self.assertTrue(os.path.exists(os.path.join(a, 'escape.txt')))
+        self.assertTrue(os.path.exists(os.path.join(a, 'absolute.txt')))
+
+    def test_unused_files_are_collected(self):
+        a = self.extract('a', [('common.js', 'common'), ('a.js', 'a')])
+        self.extract('b', [('common.js', 'common'), ('b.js', 'b')])
+        shutil.rmtree(a)
+        self.cache._collect_store()
+        self.assertEqual(sorted([open(path).read()
+                                 for path in self.store_files()]),
+                         ['b', 'common'])
+        self.assertEqual(self.cache._store_size, len('b') + len('common'))
+
+
+class BuildCacheMetadataTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.build_dir = os.path.join(self.cache_dir, 'build')
+        os.mkdir(self.build_dir)
+        self.lookups = []
+        self.caches = []
+        self.cache = self.build_cache()
+        self.write_apk('abcdef')
+
+    def tearDown(self):
+        for cache in self.caches:
+            cache.close()
+        shutil.rmtree(self.cache_dir)
+
+    def build_cache(self):
+        cache = builds.BuildCache([], [], 'fennec', [], '.apk',
+                                  cache_dir=self.cache_dir,
+                                  treeherder_url='https://treeherder')
+        self.caches.append(cache)
+        return cache
+
+    def write_apk(self, revision, mtime=1000):
+        apk_path = os.path.join(self.build_dir, 'build.apk')
+        apk = zipfile.ZipFile(apk_path, 'w')
+        apk.writestr('application.ini',
+                     '[App]\n'
+                     'Version=40.0a1\n'
+                     'BuildID=20150401030204\n'
+                     'SourceRepository=https://hg.mozilla.org/mozilla-central\n'
+                     'SourceStamp=%s\n' % revision)
+        apk.writestr('package-name.txt', 'org.mozilla.fennec\n')
+        apk.close()
+        os.utime(apk_path, (mtime, mtime))
+
+    def build_metadata(self, cache):
+        original = builds.utils.get_treeherder_revision_hash
+
+        def get_treeherder_revision_hash(treeherder_url, repo, revision):
+            self.lookups.append(revision)
+            return 'hash-%s' % revision
+
+        builds.utils.get_treeherder_revision_hash = get_treeherder_revision_hash
+        try:
+            return cache.build_metadata('http://a/fennec.apk', self.build_dir)
+        finally:
+            builds.utils.get_treeherder_revision_hash = original
+
+    def test_metadata(self):
+        metadata = self.build_metadata(self.cache)
+        self.assertEqual(metadata.app_name, 'org.mozilla.fennec')
+        self.assertEqual(metadata.tree, 'mozilla-central')
+        self.assertEqual(metadata.id, '20150401030204')
+        self.assertEqual(metadata.revision_hash, 'hash-abcdef')
+
+    def test_revision_hash_is_resolved_once(self):
+        self.build_metadata(self.cache)
+        self.build_metadata(self.cache)
+        metadata = self.build_metadata(self.build_cache())
+        self.assertEqual(metadata.revision_hash, 'hash-abcdef')
+        self.assertEqual(self.lookups, ['abcdef'])
+
+    def test_changed_build_is_read_again(self):
+        self.build_metadata(self.cache)
+        self.write_apk('123456', mtime=2000)
+        metadata = self.build_metadata(self.cache)
+        self.assertEqual(metadata.revision, '%srev/123456' %
+                         builds.repo_urls['mozilla-central'])
+        self.assertEqual(self.lookups, ['abcdef', '123456'])
+
+
+class BuildCacheCorruptBuildTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmpdir, 'builds')
+        self.cache = builds.BuildCache([], [], 'fennec', [], '.apk',
+                                       cache_dir=self.cache_dir)
+        self.apk_path = os.path.join(self.tmpdir, 'fennec.apk')
+        self.buildurl = 'file://%s' % self.apk_path
+        self.cache_build_dir = os.path.join(
+            self.cache_dir, builds.base64.b64encode(self.buildurl))
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.tmpdir)
+
+    def write_apk(self, valid=True):
+        apk = zipfile.ZipFile(self.apk_path, 'w', zipfile.ZIP_DEFLATED)
+        apk.writestr('application.ini',
+                     '[App]\n'
+                     'Version=40.0a1\n'
+                     'BuildID=20150401030204\n'
+                     'SourceRepository=https://hg.mozilla.org/mozilla-central\n'
+                     'SourceStamp=abcdef\n')
+        apk.writestr('package-name.txt', 'org.mozilla.fennec\n')
+        apk.close()
+        if not valid:
+            # Corrupt the compressed data of the first member so that
+            # its crc check fails.
+            with open(self.apk_path, 'r+b') as f:
+                f.seek(40)
+                f.write('corrupt')
+
+    def records(self):
+        return self.cache._read_artifact_records(self.cache_build_dir)
+
+    def test_corrupt_build(self):
+        self.write_apk(valid=False)
+        result = self.cache.get(self.buildurl)
+        self.assertFalse(result['success'])
+        self.assertTrue(result['error'].startswith('IO Error retrieving build'))
+        self.assertFalse(os.path.exists(
+            os.path.join(self.cache_build_dir, 'build.apk')))
+        self.assertEqual(self.records(), {})
+
+    def test_corrupt_build_keeps_previous_record(self):
+        self.write_apk()
+        self.cache.get(self.buildurl)
+        records = self.records()
+        self.assertTrue('build.apk' in records)
+        self.write_apk(valid=False)
+        result = self.cache.get(self.buildurl)
+        self.assertFalse(result['success'])
+        self.assertEqual(self.records(), records)
+
+    def test_close_stops_eviction_thread(self):
+        self.write_apk()
+        self.assertTrue(self.cache.get(self.buildurl)['success'])
+        thread = self.cache._evict_thread
+        self.assertTrue(thread.is_alive())
+        self.cache.close()
+        self.assertFalse(thread.is_alive())
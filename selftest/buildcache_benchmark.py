@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Benchmark of the validation of a cached build on a BuildCache hit.
+
+Usage: buildcache_benchmark.py [--size MB] [--calls N] [apk-file]
+
+apk-file is a build to validate. If it is not specified, a synthetic
+apk containing --size megabytes of libraries is generated. The latency
+of the previous ZipFile.testzip check is compared with
+BuildCache._check_build using a recorded checksum whose mtime has
+changed and with an unchanged recorded size and mtime.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import builds
+
+
+def synthetic_apk(path, size):
+    apk = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+    apk.writestr('application.ini', '[App]\n')
+    apk.writestr('package-name.txt', 'org.mozilla.fennec\n')
+    member_size = 1024 * 1024
+    for i in range(size):
+        # Half random, half compressible, similar to native libraries.
+        data = os.urandom(member_size / 2) + 'x' * (member_size / 2)
+        apk.writestr('assets/lib%d.so' % i, data)
+    apk.close()
+
+
+def measure(name, func, calls):
+    times = []
+    for i in xrange(calls):
+        start = time.time()
+        if not func():
+            print 'ERROR: %s failed' % name
+            return
+        times.append(time.time() - start)
+    times.sort()
+    print '%-10s calls: %d, median: %.3f ms, max: %.3f ms' % (
+        name, calls, times[len(times) / 2] * 1000, times[-1] * 1000)
+
+
+def main():
+    parser = OptionParser(usage='%prog [options] [apk-file]')
+    parser.add_option('--size', type='int', default=40,
+                      help='uncompressed size in megabytes of the synthetic apk.')
+    parser.add_option('--calls', type='int', default=20,
+                      help='number of validations to measure.')
+    options, args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        build_path = os.path.join(tmpdir, 'build.apk')
+        if args:
+            shutil.copy(args[0], build_path)
+        else:
+            synthetic_apk(build_path, options.size)
+        print 'apk: %.1f MB' % (os.path.getsize(build_path) / 1024.0 / 1024.0)
+        cache = builds.BuildCache([], [], 'fennec', [], '.apk',
+                                  cache_dir=os.path.join(tmpdir, 'builds'))
+        records = {}
+        cache._check_build('build.apk', build_path, records)
+
+        def checksum():
+            records['build.apk']['mtime'] = None
+            return cache._check_build('build.apk', build_path, records)
+
+        measure('testzip',
+                lambda: zipfile.ZipFile(build_path).testzip() is None,
+                options.calls)
+        measure('checksum', checksum, options.calls)
+        measure('marker',
+                lambda: cache._check_build('build.apk', build_path, records),
+                options.calls)
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main()
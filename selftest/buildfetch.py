@@ -0,0 +1,115 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import threading
+import time
+import unittest
+
+import buildserver
+
+
+class FakeBuildCache(object):
+
+    def __init__(self, delay=0.5):
+        self.delay = delay
+        self.calls = []
+        self.failures = 0
+        self.lock = threading.Lock()
+
+    def get(self, buildurl, force=False, enable_unittests=False):
+        with self.lock:
+            self.calls.append((buildurl, enable_unittests))
+            failed = self.failures > 0
+            self.failures -= 1
+        time.sleep(self.delay)
+        if failed:
+            return {'success': False, 'error': 'failed', 'metadata': None}
+        return {'success': True, 'error': '', 'metadata': buildurl}
+
+    def get_symbols(self, buildurl):
+        with self.lock:
+            self.calls.append((buildurl, 'symbols'))
+        time.sleep(self.delay)
+        return {'success': True, 'error': '', 'symbols': buildurl}
+
+
+class BuildCacheServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.build_cache = FakeBuildCache()
+        self.server = buildserver.BuildCacheServer(
+            ('127.0.0.1', 0), buildserver.BuildCacheHandler)
+        self.server.build_cache = self.build_cache
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def fetch(self, requests):
+        results = []
+
+        def get(url, enable_unittests, symbols=False):
+            client = buildserver.BuildCacheClient(
+                port=self.server.server_address[1])
+            if symbols:
+                results.append(client.get_symbols(url))
+            else:
+                results.append(client.get(url,
+                                          enable_unittests=enable_unittests))
+            client.close()
+
+        threads = [threading.Thread(target=get, args=request)
+                   for request in requests]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results, time.time() - start
+
+    def test_same_build_shares_fetch(self):
+        results, elapsed = self.fetch([('http://a/fennec.apk', False)] * 5)
+        self.assertEqual(self.build_cache.calls,
+                         [('http://a/fennec.apk', False)])
+        self.assertEqual([r['metadata'] for r in results],
+                         ['http://a/fennec.apk'] * 5)
+
+    def test_failed_fetch_is_not_shared(self):
+        self.build_cache.failures = 1
+        results, elapsed = self.fetch([('http://a/fennec.apk', False)] * 3)
+        # Only the request which started the failed fetch gets its
+        # results. The waiting requests fetch the build again.
+        self.assertEqual(self.build_cache.calls,
+                         [('http://a/fennec.apk', False)] * 2)
+        self.assertEqual(sorted([r['success'] for r in results]),
+                         [False, True, True])
+
+    def test_different_builds_run_concurrently(self):
+        results, elapsed = self.fetch([('http://a/fennec.apk', False),
+                                       ('http://b/fennec.apk', False),
+                                       ('http://c/fennec.apk', False)])
+        self.assertEqual(len(self.build_cache.calls), 3)
+        self.assertTrue(elapsed < 2 * self.build_cache.delay)
+
+    def test_symbols_are_serialized_with_build(self):
+        results, elapsed = self.fetch([('http://a/fennec.apk', False),
+                                       ('http://a/fennec.apk', False, True),
+                                       ('http://a/fennec.apk', False, True)])
+        self.assertEqual(sorted(self.build_cache.calls),
+                         [('http://a/fennec.apk', False),
+                          ('http://a/fennec.apk', 'symbols')])
+        self.assertTrue(elapsed >= 2 * self.build_cache.delay)
+
+    def test_fetch_satisfies(self):
+        fetch = buildserver.BuildFetch(False, False)
+        self.assertTrue(fetch.satisfies(False, False))
+        self.assertFalse(fetch.satisfies(False, True))
+        self.assertFalse(fetch.satisfies(True, False))
+        fetch = buildserver.BuildFetch(True, True)
+        self.assertTrue(fetch.satisfies(False, False))
+        self.assertTrue(fetch.satisfies(True, True))
+        self.assertFalse(fetch.satisfies(False, False, symbols=True))
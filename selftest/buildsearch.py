@@ -0,0 +1,257 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import BaseHTTPServer
+import SocketServer
+import datetime
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import urlparse
+
+import buildindex
+import builds
+
+START = 1430000000
+PUSHES = 20
+
+
+def revision(push):
+    return '%012x' % (0xabc000 + push) + '0' * 28
+
+
+def build_timestamp(push):
+    return START + push * 600 + 300
+
+
+class ArchiveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves a pushlog of PUSHES pushes ten minutes apart and a
+    Tinderbox directory with a build of each push five minutes after
+    the push."""
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        url = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        push_of = lambda r: [push for push in range(PUSHES)
+                             if revision(push).startswith(r)][0]
+        pushes = lambda first, last: json.dumps(dict(
+            (str(push), {'date': START + push * 600,
+                         'changesets': [revision(push)]})
+            for push in range(first, last + 1)))
+        if url.path == '/hg/json-pushes' and 'changeset' in query:
+            push = push_of(query['changeset'])
+            body = pushes(push, push)
+        elif url.path == '/hg/json-pushes':
+            body = pushes(push_of(query['fromchange']) + 1,
+                          push_of(query['tochange']))
+        elif url.path == '/tinderbox/mozilla-inbound-android/':
+            body = ''.join(['<a href="%d/">%d/</a>' % (build_timestamp(push),
+                                                       build_timestamp(push))
+                            for push in range(PUSHES)])
+        elif url.path.endswith('.txt'):
+            timestamp = int(url.path.split('/')[-2])
+            push = (timestamp - START) / 600
+            body = '%s\nhttp://hg.mozilla.org/integration/mozilla-inbound/rev/%s\n' % (
+                time.strftime('%Y%m%d%H%M%S', time.localtime(timestamp)),
+                revision(push)[:12])
+        elif url.path.startswith('/tinderbox/mozilla-inbound-android/'):
+            body = ''.join(['<a href="fennec-40.0a1.en-US.%s">'
+                            'fennec-40.0a1.en-US.%s</a>' % (filename, filename)
+                            for filename in ('android-arm.txt',
+                                             'android-arm.apk',
+                                             'android-i386.txt',
+                                             'android-i386.apk')])
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ArchiveServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           ArchiveHandler)
+        self.requests = []
+
+
+class FindBuildsByRevisionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ArchiveServer()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        url = 'http://127.0.0.1:%d/' % self.server.server_address[1]
+        self.original_repo_url = builds.repo_urls['mozilla-inbound']
+        builds.repo_urls['mozilla-inbound'] = url + 'hg/'
+        self.location = builds.Tinderbox(['mozilla-inbound'], ['opt'],
+                                         'fennec', ['android'], '.apk')
+        self.location.main_http_url = url + 'tinderbox/'
+
+    def tearDown(self):
+        builds.repo_urls['mozilla-inbound'] = self.original_repo_url
+        self.server.shutdown()
+        self.server.server_close()
+
+    def find_builds(self, first, last):
+        build_urls = self.location.find_builds_by_revision(
+            revision(first)[:12], revision(last)[:12])
+        return [int(build_url.split('/')[-2]) for build_url in build_urls]
+
+    def test_range(self):
+        self.assertEqual(self.find_builds(5, 8),
+                         [build_timestamp(push) for push in range(5, 9)])
+        pushlog_requests = [path for path in self.server.requests
+                            if 'json-pushes' in path]
+        self.assertEqual(len(pushlog_requests), 2)
+
+    def test_single_revision(self):
+        self.assertEqual(self.find_builds(7, 7), [build_timestamp(7)])
+
+    def test_search_stops_at_last_push(self):
+        self.find_builds(2, 3)
+        txt_requests = [path for path in self.server.requests
+                        if path.endswith('.txt')]
+        self.assertTrue(len(txt_requests) <= 2 * self.location.MAX_FETCHES)
+
+    def test_only_build_directory_listings_are_cached(self):
+        builds._links_cache.clear()
+        search_directory = self.location.main_http_url + 'mozilla-inbound-android/'
+        build_directory = '%s%d/' % (search_directory, build_timestamp(3))
+        for i in range(2):
+            list(self.location.fetch_links([search_directory, build_directory]))
+        listing_requests = [path for path in self.server.requests
+                            if path.startswith('/tinderbox/')]
+        self.assertEqual(sorted(listing_requests),
+                         sorted([urlparse.urlparse(search_directory).path] * 2 +
+                                [urlparse.urlparse(build_directory).path]))
+
+
+class BuildIndexTest(FindBuildsByRevisionTest):
+
+    def setUp(self):
+        FindBuildsByRevisionTest.setUp(self)
+        self.tmpdir = tempfile.mkdtemp()
+        self.location.build_index = buildindex.BuildIndex(
+            os.path.join(self.tmpdir, 'builds.sqlite'))
+        builds._links_cache.clear()
+
+    def tearDown(self):
+        FindBuildsByRevisionTest.tearDown(self)
+        self.location.build_index.close()
+        shutil.rmtree(self.tmpdir)
+
+    def find_builds_by_time(self, first, last, crawl=True):
+        start_time = datetime.datetime.fromtimestamp(build_timestamp(first))
+        end_time = datetime.datetime.fromtimestamp(build_timestamp(last))
+        return [int(build_url.split('/')[-2]) for build_url in
+                self.location.find_builds_by_time(start_time, end_time,
+                                                  crawl=crawl)]
+
+    def test_time_range_from_index(self):
+        expected = [build_timestamp(push) for push in range(3, 7)]
+        self.assertEqual(sorted(self.find_builds_by_time(3, 6)), expected)
+        del self.server.requests[:]
+        self.assertEqual(self.find_builds_by_time(3, 6, crawl=False), expected)
+        self.assertEqual(self.server.requests, [])
+
+    def test_find_builds_by_time_returns_list(self):
+        start_time = datetime.datetime.fromtimestamp(build_timestamp(3))
+        end_time = datetime.datetime.fromtimestamp(build_timestamp(6))
+        build_urls = self.location.find_builds_by_time(start_time, end_time)
+        self.assertTrue(isinstance(build_urls, list))
+        self.assertEqual(sorted(build_urls), sorted(
+            self.location.iter_builds_by_time(start_time, end_time)))
+
+    def test_indexed_directories_are_not_listed(self):
+        self.find_builds_by_time(3, 6)
+        builds._links_cache.clear()
+        del self.server.requests[:]
+        self.assertEqual(len(self.find_builds_by_time(3, 8)), 6)
+        build_directory_requests = [
+            path for path in self.server.requests
+            if path.startswith('/tinderbox/mozilla-inbound-android/1')]
+        self.assertEqual(len(build_directory_requests), 2)
+
+    def test_directory_of_notified_build_is_listed(self):
+        directory = '%smozilla-inbound-android/%d/' % (
+            self.location.main_http_url, build_timestamp(4))
+        # AutoPhone.resolve_build indexes only the build it is notified
+        # of, here the x86 build uploaded to the same directory.
+        self.location.build_index.add_builds([
+            {'url': directory + 'fennec-40.0a1.en-US.android-i386.apk',
+             'tree': 'mozilla-inbound',
+             'revision': revision(4),
+             'build_id': time.strftime('%Y%m%d%H%M%S',
+                                       time.localtime(build_timestamp(4)))}])
+        path = urlparse.urlparse(directory).path
+        expected = [directory + 'fennec-40.0a1.en-US.android-arm.apk']
+        start_time = datetime.datetime.fromtimestamp(build_timestamp(4))
+        self.assertEqual(self.location.find_builds_by_time(start_time,
+                                                           start_time),
+                         expected)
+        self.assertTrue(path in self.server.requests)
+        # Once listed by the crawl, the directory is served from the index.
+        builds._links_cache.clear()
+        del self.server.requests[:]
+        self.assertEqual(self.location.find_builds_by_time(start_time,
+                                                           start_time),
+                         expected)
+        self.assertFalse(path in self.server.requests)
+
+    def test_recently_listed_directory_is_listed_again(self):
+        build_index = self.location.build_index
+        now = int(time.time())
+        build_index.add_listed_directories({'http://a/1/': now,
+                                            'http://a/2/': now - build_index.UPLOAD_PERIOD})
+        build_index.add_builds([{'url': 'http://a/2/fennec.apk'}])
+        self.assertEqual(build_index.get_directories(['http://a/1/',
+                                                      'http://a/2/',
+                                                      'http://a/3/']),
+                         {'http://a/2/': ['http://a/2/fennec.apk']})
+
+    def test_revision_range_from_index(self):
+        expected = self.find_builds(5, 8)
+        del self.server.requests[:]
+        build_urls = self.location.find_builds_by_revision(
+            revision(5)[:12], revision(8)[:12], crawl=False)
+        self.assertEqual([int(build_url.split('/')[-2])
+                          for build_url in build_urls], expected)
+        self.assertEqual([path for path in self.server.requests
+                          if not 'json-pushes' in path], [])
+
+
+class ParseLinksTest(unittest.TestCase):
+
+    def parse(self, content):
+        return [(link.get('href'), link.get_text())
+                for link in builds.parse_links(content)]
+
+    def test_apache_listing(self):
+        content = ('<tr><td><img src="/icons/back.gif" alt="[DIR]"></td>'
+                   '<td><a href="/pub/mobile/">Parent Directory</a></td></tr>'
+                   '<tr><td><a href="1430000300/">1430000300/</a></td></tr>'
+                   '<tr><td><A HREF=\'fennec.apk\'>fennec.apk</A></td></tr>')
+        self.assertEqual(self.parse(content),
+                         [('/pub/mobile/', 'Parent Directory'),
+                          ('1430000300/', '1430000300/'),
+                          ('fennec.apk', 'fennec.apk')])
+
+    def test_markup_in_anchor(self):
+        content = ('<a name="top">top</a>'
+                   '<a class="dir" href=a%26b/><img src="x.gif"> a&amp;b/\n</a>')
+        self.assertEqual(self.parse(content), [('a%26b/', ' a&b/\n')])
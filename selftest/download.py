@@ -0,0 +1,141 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import BaseHTTPServer
+import SocketServer
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+import threading
+import unittest
+import urllib2
+
+import builds
+
+
+class FileHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves server.content at /file with support for Range requests.
+
+    If server.drop_after is set, the connection of the next response is
+    closed after that many bytes of the body have been sent.
+    """
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(self.headers.getheader('Range'))
+        if self.path != '/file':
+            self.send_error(404)
+            return
+        content = server.content
+        start = 0
+        match = re.match(r'bytes=(\d+)-', self.headers.getheader('Range') or '')
+        if match and server.support_range:
+            start = int(match.group(1))
+            if start >= len(content):
+                self.send_error(416)
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (
+                start, len(content) - 1, len(content)))
+        else:
+            self.send_response(200)
+        body = content[start:]
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if server.drop_after is not None:
+            body = body[:server.drop_after]
+            server.drop_after = None
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FileServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, content):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), FileHandler)
+        self.content = content
+        self.support_range = True
+        self.drop_after = None
+        self.requests = []
+
+
+class DownloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.content = os.urandom(1024 * 1024 + 17)
+        self.checksum = hashlib.sha256(self.content).hexdigest()
+        self.server = FileServer(self.content)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%d/file' % self.server.server_address[1]
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'file')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def download(self, **kwargs):
+        kwargs.setdefault('retry_wait', 0)
+        kwargs.setdefault('chunk_size', 64 * 1024)
+        return builds.download_file(self.url, self.path, **kwargs)
+
+    def assertDownloaded(self, result):
+        self.assertEqual(result, (len(self.content), self.checksum))
+        self.assertEqual(open(self.path, 'rb').read(), self.content)
+
+    def test_download(self):
+        self.assertDownloaded(self.download())
+        self.assertEqual(self.server.requests, [None])
+
+    def test_resume_partial_file(self):
+        with open(self.path, 'wb') as f:
+            f.write(self.content[:1000])
+        self.assertDownloaded(self.download())
+        self.assertEqual(self.server.requests, ['bytes=1000-'])
+
+    def test_no_resume(self):
+        with open(self.path, 'wb') as f:
+            f.write('x' * 1000)
+        self.assertDownloaded(self.download(resume=False))
+        self.assertEqual(self.server.requests, [None])
+
+    def test_dropped_connection_is_resumed(self):
+        self.server.drop_after = 5000
+        self.assertDownloaded(self.download())
+        self.assertEqual(self.server.requests, [None, 'bytes=5000-'])
+
+    def test_dropped_connection_attempts_exceeded(self):
+        self.server.drop_after = 5000
+        self.assertRaises(IOError, self.download, attempts=1)
+        self.assertEqual(os.path.getsize(self.path), 5000)
+
+    def test_range_ignored(self):
+        self.server.support_range = False
+        with open(self.path, 'wb') as f:
+            f.write('x' * 1000)
+        self.assertDownloaded(self.download())
+
+    def test_range_not_satisfiable(self):
+        with open(self.path, 'wb') as f:
+            f.write('x' * (len(self.content) + 1))
+        self.assertDownloaded(self.download())
+
+    def test_not_found_is_not_retried(self):
+        self.url += '-missing'
+        self.assertRaises(urllib2.HTTPError, self.download)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_cancel(self):
+        cancel = threading.Event()
+        cancel.set()
+        self.assertRaises(builds.BuildDownloadCancelled, self.download,
+                          cancel=cancel)
@@ -0,0 +1,63 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest
+
+from logcatmatcher import LogcatEventMatcher
+
+THROBBER = '..GeckoToolbarDisplayLayout.*zerdatime (\d+) - Throbber'
+
+LOGCAT = [
+    '--------- beginning of /dev/log/main',
+    '01-02 10:00:00.000 I/ActivityManager(  123): Starting activity',
+    '01-02 10:00:01.000 I/ActivityManager(  123): Start proc org.mozilla.fennec for activity org.mozilla.fennec/.App: pid=1',
+    '01-02 10:00:02.000 I/GeckoToolbarDisplayLayout( 1): zerdatime 1 - Throbber start',
+    '01-02 10:00:03.000 I/GeckoToolbarDisplayLayout( 1): zerdatime 2 - Throbber start',
+    '01-02 10:00:04.000 I/GeckoToolbarDisplayLayout( 1): zerdatime 3 - Throbber stop',
+    '01-02 10:00:05.000 I/GeckoToolbarDisplayLayout( 1): zerdatime 4 - Throbber stop',
+]
+
+
+class LogcatEventMatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.matcher = LogcatEventMatcher(
+            [('start', '.*(Gecko|Start proc org.mozilla.fennec for activity '
+              'org.mozilla.fennec/.App)'),
+             ('throbber_start', '%s start' % THROBBER),
+             ('throbber_stop', '%s stop' % THROBBER)])
+
+    def test_first_occurrences(self):
+        self.assertTrue(self.matcher.feed(LOGCAT))
+        self.assertEqual(self.matcher.base_time, '01-02 10:00:00.000')
+        self.assertEqual(self.matcher.times,
+                         {'start': '01-02 10:00:01.000',
+                          'throbber_start': '01-02 10:00:02.000',
+                          'throbber_stop': '01-02 10:00:04.000'})
+
+    def test_incremental(self):
+        self.assertFalse(self.matcher.feed(LOGCAT[:4]))
+        self.assertEqual(sorted(self.matcher.times.keys()),
+                         ['start', 'throbber_start'])
+        self.assertTrue(self.matcher.feed(LOGCAT[4:]))
+        self.assertEqual(self.matcher.times['throbber_stop'],
+                         '01-02 10:00:04.000')
+
+    def test_precedence(self):
+        # Once start has been found, lines matching both start and a
+        # later event are attributed to the later event.
+        matcher = LogcatEventMatcher([('start', '.*Gecko'),
+                                      ('throbber_start', '%s start' % THROBBER)])
+        matcher.feed(LOGCAT[3:4])
+        self.assertEqual(matcher.times, {'start': '01-02 10:00:02.000'})
+        matcher.feed(LOGCAT[4:5])
+        self.assertEqual(matcher.times['throbber_start'], '01-02 10:00:03.000')
+
+    def test_reset(self):
+        self.matcher.feed(LOGCAT)
+        self.matcher.reset()
+        self.assertEqual(self.matcher.times, {})
+        self.assertEqual(self.matcher.base_time, None)
+        self.assertFalse(self.matcher.done)
+        self.assertTrue(self.matcher.feed(LOGCAT))
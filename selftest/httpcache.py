@@ -0,0 +1,132 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import BaseHTTPServer
+import SocketServer
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import builds
+import utils
+
+
+class ContentHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves server.content with an ETag of server.etag and answers
+    conditional requests with 304 Not Modified."""
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append((self.path,
+                                self.headers.getheader('If-None-Match')))
+        if self.headers.getheader('If-None-Match') == server.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', server.etag)
+        self.send_header('Content-Length', str(len(server.content)))
+        self.end_headers()
+        self.wfile.write(server.content)
+
+    def log_message(self, *args):
+        pass
+
+
+class ContentServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           ContentHandler)
+        self.content = '<a href="a/">a/</a><a href="b/">b/</a>'
+        self.etag = '"1"'
+        self.requests = []
+
+
+class HttpCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ContentServer()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%d/' % self.server.server_address[1]
+        self.cache_dir = tempfile.mkdtemp()
+        self.original_http_cache = utils.http_cache
+        utils.http_cache = self.http_cache()
+
+    def tearDown(self):
+        utils.http_cache = self.original_http_cache
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.cache_dir)
+
+    def http_cache(self, ttl=60, cache_dir=None):
+        return utils.HttpCache(ttls=[(r'/cached', ttl)], cache_dir=cache_dir)
+
+    def test_uncached_url(self):
+        utils.get_remote_text(self.url + 'uncached')
+        utils.get_remote_text(self.url + 'uncached')
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(utils.http_cache.misses, 0)
+
+    def test_hit(self):
+        self.assertEqual(utils.get_remote_text(self.url + 'cached'),
+                         self.server.content)
+        self.assertEqual(utils.get_remote_text(self.url + 'cached'),
+                         self.server.content)
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual((utils.http_cache.hits, utils.http_cache.misses),
+                         (1, 1))
+
+    def test_expired_content_is_revalidated(self):
+        utils.http_cache = self.http_cache(ttl=0.01)
+        utils.get_remote_text(self.url + 'cached')
+        time.sleep(0.02)
+        self.assertEqual(utils.get_remote_text(self.url + 'cached'),
+                         self.server.content)
+        self.assertEqual(self.server.requests,
+                         [('/cached', None), ('/cached', '"1"')])
+        self.assertEqual(utils.http_cache.revalidated, 1)
+
+    def test_changed_content_is_retrieved(self):
+        utils.http_cache = self.http_cache(ttl=0.01)
+        utils.get_remote_text(self.url + 'cached')
+        time.sleep(0.02)
+        self.server.content = 'changed'
+        self.server.etag = '"2"'
+        self.assertEqual(utils.get_remote_text(self.url + 'cached'), 'changed')
+        self.assertEqual(utils.http_cache.revalidated, 0)
+
+    def test_cache_dir(self):
+        utils.http_cache = self.http_cache(cache_dir=self.cache_dir)
+        utils.get_remote_text(self.url + 'cached')
+        utils.http_cache = self.http_cache(cache_dir=self.cache_dir)
+        self.assertEqual(utils.get_remote_text(self.url + 'cached'),
+                         self.server.content)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_invalidate(self):
+        utils.http_cache = self.http_cache(cache_dir=self.cache_dir)
+        utils.get_remote_text(self.url + 'cached')
+        utils.http_cache.invalidate(self.url + 'cached')
+        utils.get_remote_text(self.url + 'cached')
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_url_links_are_cached(self):
+        url = self.url + 'listing/'
+        self.assertEqual([link.get('href') for link in
+                          builds.url_links(url, ttl=builds.LINKS_TTL)],
+                         ['a/', 'b/'])
+        builds.url_links(url, ttl=builds.LINKS_TTL)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_url_links_without_ttl_are_not_cached(self):
+        url = self.url + 'listing/'
+        builds.url_links(url)
+        builds.url_links(url)
+        self.assertEqual(len(self.server.requests), 2)
@@ -0,0 +1,82 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import Queue
+import logging
+import time
+import unittest
+
+import worker
+from logdecorator import LogDecorator
+
+
+class FakeJobs(object):
+    """Jobs database of a single device. A job is removed when it is
+    returned by get_next_job, as if it had been run."""
+
+    def __init__(self):
+        self.pending = []
+        self.queries = 0
+
+    def get_next_job(self, lifo=False, device=None, worker=None):
+        self.queries += 1
+        if not self.pending:
+            return None
+        return {'id': self.pending.pop(0)}
+
+
+class Options(object):
+    lifo = False
+    phone_job_sweep_interval = 0.5
+
+
+class GetNextJobTest(unittest.TestCase):
+
+    def setUp(self):
+        self.worker = worker.PhoneWorkerSubProcess(
+            None, 0, [], None, Options(), None, Queue.Queue(),
+            'jobdispatch', logging.DEBUG, None, None)
+        self.worker.loggerdeco = LogDecorator(logging.getLogger(), {}, '%(message)s')
+        self.worker.jobs = self.jobs = FakeJobs()
+        # The initial check finds the jobs queued before the worker
+        # started.
+        self.assertEqual(self.worker.get_next_job(), None)
+        self.jobs.queries = 0
+
+    def notify(self, job_id):
+        self.worker.handle_cmd(('job', job_id))
+
+    def test_notified_job_is_dispatched(self):
+        self.jobs.pending.append(1)
+        self.notify(1)
+        self.assertEqual(self.worker.get_next_job(), {'id': 1})
+        # The database is checked again in case other jobs are pending.
+        self.assertEqual(self.worker.get_next_job(), None)
+        self.assertEqual(self.jobs.queries, 2)
+        self.assertEqual(self.worker.notified_job_ids, set())
+
+    def test_database_is_not_polled_without_notification(self):
+        for i in range(10):
+            self.assertEqual(self.worker.get_next_job(), None)
+        self.assertEqual(self.jobs.queries, 0)
+
+    def test_missed_notification_is_swept(self):
+        self.jobs.pending.append(1)
+        self.assertEqual(self.worker.get_next_job(), None)
+        self.assertEqual(self.jobs.queries, 0)
+        time.sleep(Options.phone_job_sweep_interval)
+        self.assertEqual(self.worker.get_next_job(), {'id': 1})
+        self.assertEqual(self.jobs.queries, 1)
+
+    def test_dispatched_job_is_not_run_twice(self):
+        self.jobs.pending.append(1)
+        self.notify(1)
+        self.assertEqual(self.worker.get_next_job(), {'id': 1})
+        # A duplicate notification of the job which has already been
+        # dispatched only causes the database to be checked again.
+        self.notify(1)
+        self.assertEqual(self.worker.get_next_job(), None)
+        self.assertEqual(self.worker.get_next_job(), None)
+        self.assertEqual(self.jobs.queries, 2)
+        self.assertEqual(self.worker.notified_job_ids, set())
@@ -0,0 +1,181 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import jobs
+
+
+class FakeTest(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.config_file = 'configs/%s.ini' % name
+        self.chunk = 1
+        self.repos = ['mozilla-central']
+        self.job_guid = None
+
+    def generate_guid(self):
+        self.job_guid = '%s-guid' % self.name
+
+
+class NewJobsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+        os.chdir(self.tmpdir)
+        self.jobs = jobs.Jobs(None)
+        self.commits = 0
+        commit_connection = self.jobs._commit_connection
+
+        def counting_commit(conn):
+            self.commits += 1
+            commit_connection(conn)
+        self.jobs._commit_connection = counting_commit
+
+    def tearDown(self):
+        self.jobs.close()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def job(self, build_url, device, test_names):
+        return {'build_url': build_url,
+                'tree': 'mozilla-central',
+                'tests': [FakeTest(name) for name in test_names],
+                'device': device}
+
+    def test_jobs_added_in_one_transaction(self):
+        results = self.jobs.new_jobs([self.job('http://a/fennec.apk', 'd1',
+                                               ['smoketest', 'webappstartup']),
+                                      self.job('http://a/fennec.apk', 'd2',
+                                               ['smoketest']),
+                                      self.job('http://b/fennec.apk', 'd1',
+                                               ['smoketest'])])
+        self.assertEqual(self.commits, 1)
+        self.assertEqual(len(set([job_id for job_id, tests in results])), 3)
+        self.assertEqual([len(tests) for job_id, tests in results], [2, 1, 1])
+        self.assertEqual(self.jobs.jobs_pending(device='d1'), 2)
+        self.assertEqual(self.jobs.jobs_pending(device='d2'), 1)
+
+    def test_queued_tests_are_not_added_again(self):
+        job_id, tests = self.jobs.new_job('http://a/fennec.apk',
+                                          tests=[FakeTest('smoketest')],
+                                          device='d1')
+        results = self.jobs.new_jobs([self.job('http://a/fennec.apk', 'd1',
+                                               ['smoketest', 'webappstartup'])])
+        self.assertEqual(results[0][0], job_id)
+        self.assertEqual([test.name for test in results[0][1]],
+                         ['webappstartup'])
+        self.assertEqual(self.jobs.jobs_pending(device='d1'), 1)
+
+
+class Worker(object):
+    tests = []
+
+
+class JobsSchemaTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+        os.chdir(self.tmpdir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def create_baseline(self, rows):
+        """Create a jobs.sqlite with the schema used before version 1
+        containing a job for each (build_url, created) tuple in rows."""
+        conn = sqlite3.connect('jobs.sqlite')
+        conn.execute('create table jobs ('
+                     'id integer primary key, '
+                     'created text, '
+                     'last_attempt text, '
+                     'build_url text, '
+                     'build_id text, '
+                     'changeset text, '
+                     'tree text, '
+                     'revision text, '
+                     'revision_hash, '
+                     'enable_unittests int, '
+                     'attempts int, '
+                     'device text)')
+        conn.execute('create table tests ('
+                     'id integer primary key, '
+                     'name text, '
+                     'config_file text, '
+                     'chunk int, '
+                     'guid text, '
+                     'repos text, '
+                     'jobid integer)')
+        for build_url, created in rows:
+            cursor = conn.execute(
+                'insert into jobs (created, build_url, attempts, device) '
+                'values (?, ?, 0, ?)', (created, build_url, 'd1'))
+            conn.execute('insert into tests (name, repos, jobid) '
+                         'values (?, ?, ?)',
+                         ('smoketest', '[]', cursor.lastrowid))
+        conn.commit()
+        conn.close()
+
+    def next_build_urls(self, db, lifo):
+        build_urls = []
+        while True:
+            job = db.get_next_job(lifo=lifo, device='d1', worker=Worker())
+            if not job:
+                return build_urls
+            build_urls.append(job['build_url'])
+            db.job_completed(job['id'])
+
+    def test_baseline_schema_is_migrated(self):
+        self.create_baseline([('http://a/mozilla-central/1.apk', '2015-01-01T00:00:01'),
+                              ('http://a/try/2.apk', '2015-01-01T00:00:02')])
+        db = jobs.Jobs(None)
+        conn = sqlite3.connect('jobs.sqlite')
+        self.assertEqual(conn.execute('pragma user_version').fetchone()[0],
+                         jobs.Jobs.SCHEMA_VERSION)
+        self.assertEqual(
+            conn.execute('select build_url, is_try from jobs '
+                         'order by id').fetchall(),
+            [('http://a/mozilla-central/1.apk', 0), ('http://a/try/2.apk', 1)])
+        self.assertEqual(conn.execute('select count(*) from tests').fetchone()[0],
+                         2)
+        indexes = [row[0] for row in conn.execute(
+            'select name from sqlite_master where type="index"')]
+        for index in ('jobs_device_is_try_created', 'jobs_device_attempts',
+                      'tests_jobid', 'tests_guid'):
+            self.assertTrue(index in indexes, index)
+        conn.close()
+        # Opening the migrated database again leaves it unchanged.
+        db.close()
+        db = jobs.Jobs(None)
+        self.assertEqual(db.jobs_pending(device='d1'), 2)
+        db.close()
+
+    def test_try_jobs_first(self):
+        self.create_baseline([('http://a/mozilla-central/1.apk', '2015-01-01T00:00:01'),
+                              ('http://a/try/2.apk', '2015-01-01T00:00:02'),
+                              ('http://a/mozilla-central/3.apk', '2015-01-01T00:00:03'),
+                              ('http://a/try/4.apk', '2015-01-01T00:00:04')])
+        shutil.copy('jobs.sqlite', 'baseline.sqlite')
+        db = jobs.Jobs(None)
+        self.assertEqual(self.next_build_urls(db, lifo=False),
+                         ['http://a/try/2.apk', 'http://a/try/4.apk',
+                          'http://a/mozilla-central/1.apk',
+                          'http://a/mozilla-central/3.apk'])
+        db.close()
+        os.unlink('jobs.sqlite')
+        shutil.copy('baseline.sqlite', 'jobs.sqlite')
+        db = jobs.Jobs(None)
+        self.assertEqual(self.next_build_urls(db, lifo=True),
+                         ['http://a/try/4.apk', 'http://a/try/2.apk',
+                          'http://a/mozilla-central/3.apk',
+                          'http://a/mozilla-central/1.apk'])
+        db.close()
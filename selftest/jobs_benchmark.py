@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Benchmark of Jobs.get_next_job with a deep backlog of pending jobs.
+
+Usage: jobs_benchmark.py [--jobs N] [--devices N] [--calls N]
+
+A jobs database is created in a temporary directory and loaded with
+--jobs pending jobs spread over --devices devices, one test per job,
+one in ten of which are try jobs. The latency of get_next_job is then
+measured along with the query used before the is_try column and its
+index were added.
+"""
+
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import jobs
+
+
+class Worker(object):
+    tests = []
+
+
+def load(db, njobs, ndevices):
+    conn = db._conn()
+    start = datetime.datetime(2015, 1, 1)
+    job_rows = []
+    test_rows = []
+    for i in xrange(njobs):
+        tree = 'try' if i % 10 == 0 else 'mozilla-inbound'
+        build_url = 'http://ftp.mozilla.org/pub/mobile/tinderbox-builds/%s-android/%d/fennec.apk' % (tree, i)
+        created = (start + datetime.timedelta(seconds=i)).isoformat()
+        job_rows.append((i + 1, created, None, build_url, str(i), str(i),
+                         tree, str(i), None, 0, 0, 'device%d' % (i % ndevices),
+                         tree == 'try'))
+        test_rows.append((None, 'smoketest', 'configs/smoketest.ini', 1,
+                          'guid%d' % i, '[]', i + 1))
+    conn.executemany('insert into jobs (id, created, last_attempt, build_url, '
+                     'build_id, changeset, tree, revision, revision_hash, '
+                     'enable_unittests, attempts, device, is_try) '
+                     'values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', job_rows)
+    conn.executemany('insert into tests values (?, ?, ?, ?, ?, ?, ?)',
+                     test_rows)
+    conn.commit()
+
+
+def legacy_query(db, device):
+    conn = db._conn()
+    cursor = conn.execute(
+        'select id,created,last_attempt,build_url,'
+        'build_id,changeset,tree,revision,revision_hash,'
+        'enable_unittests,attempts,instr(build_url,"try") as istry '
+        'from jobs where device=? order by istry desc, '
+        'created asc', (device,))
+    row = cursor.fetchone()
+    cursor.close()
+    return row
+
+
+def measure(name, func, calls):
+    times = []
+    for i in xrange(calls):
+        start = time.time()
+        func(i)
+        times.append(time.time() - start)
+    times.sort()
+    print '%-14s calls: %d, median: %.2f ms, max: %.2f ms' % (
+        name, calls, times[len(times) / 2] * 1000, times[-1] * 1000)
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--jobs', type='int', default=100000,
+                      help='number of pending jobs.')
+    parser.add_option('--devices', type='int', default=10,
+                      help='number of devices.')
+    parser.add_option('--calls', type='int', default=200,
+                      help='number of get_next_job calls to measure.')
+    options, args = parser.parse_args()
+
+    cwd = os.getcwd()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        os.chdir(tmpdir)
+        db = jobs.Jobs(None)
+        start = time.time()
+        load(db, options.jobs, options.devices)
+        print 'loaded %d jobs in %.1f s' % (options.jobs, time.time() - start)
+        worker = Worker()
+        devices = ['device%d' % i for i in range(options.devices)]
+        measure('legacy query',
+                lambda i: legacy_query(db, devices[i % len(devices)]),
+                options.calls)
+        measure('get_next_job',
+                lambda i: db.get_next_job(device=devices[i % len(devices)],
+                                          worker=worker),
+                options.calls)
+        measure('lifo',
+                lambda i: db.get_next_job(lifo=True,
+                                          device=devices[i % len(devices)],
+                                          worker=worker),
+                options.calls)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Benchmark of the parsing of directory listings by url_links.
+
+Usage: links_benchmark.py [--entries N] [--calls N] [listing-file ...]
+
+listing-file is a saved directory listing page such as
+http://ftp.mozilla.org/pub/mobile/tinderbox-builds/mozilla-inbound-android/.
+If none are specified, a synthetic Apache style listing with --entries
+entries is generated. The parse time and the peak memory used by
+builds.parse_links is compared with that of BeautifulSoup, which
+url_links used previously, if it is installed.
+"""
+
+import os
+import resource
+import sys
+import time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import builds
+
+try:
+    from bs4 import BeautifulSoup
+except ImportError:
+    BeautifulSoup = None
+
+
+def synthetic_listing(entries):
+    rows = ['<tr><td valign="top"><img src="/icons/folder.gif" alt="[DIR]"></td>'
+            '<td><a href="%d/">%d/</a></td>'
+            '<td align="right">01-Apr-2015 03:02  </td>'
+            '<td align="right">  - </td></tr>' % (1430000000 + i * 60,
+                                                    1430000000 + i * 60)
+            for i in range(entries)]
+    return ('<html><head><title>Index of /pub/mobile/tinderbox-builds/'
+            'mozilla-inbound-android</title></head><body>'
+            '<table><tr><th><a href="?C=N;O=D">Name</a></th></tr>'
+            '<tr><td><a href="/pub/mobile/tinderbox-builds/">Parent Directory</a>'
+            '</td></tr>%s</table></body></html>' % ''.join(rows))
+
+
+def parse_beautifulsoup(content):
+    return [(link.get('href'), link.get_text())
+            for link in BeautifulSoup(content, 'html.parser').findAll('a')]
+
+
+def parse_links(content):
+    return [(link.get('href'), link.get_text())
+            for link in builds.parse_links(content)]
+
+
+def peak_memory(func, content):
+    """Return the increase in the peak resident set size in kilobytes
+    of a child process calling func(content)."""
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        func(content)
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        os.write(write_fd, str(after - before))
+        os._exit(0)
+    os.close(write_fd)
+    result = os.read(read_fd, 64)
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+    return int(result)
+
+
+def measure(name, func, content, calls):
+    # Measure the memory first since the child inherits the peak
+    # resident set size of the parent.
+    memory = peak_memory(func, content)
+    times = []
+    for i in xrange(calls):
+        start = time.time()
+        links = func(content)
+        times.append(time.time() - start)
+    times.sort()
+    print '%-14s links: %d, calls: %d, median: %.2f ms, max: %.2f ms, peak memory: +%d KB' % (
+        name, len(links), calls, times[len(times) / 2] * 1000,
+        times[-1] * 1000, memory)
+
+
+def main():
+    parser = OptionParser(usage='%prog [options] [listing-file ...]')
+    parser.add_option('--entries', type='int', default=5000,
+                      help='number of entries in the synthetic listing.')
+    parser.add_option('--calls', type='int', default=10,
+                      help='number of parses to measure.')
+    options, args = parser.parse_args()
+
+    if args:
+        listings = [(path, open(path).read()) for path in args]
+    else:
+        listings = [('synthetic', synthetic_listing(options.entries))]
+    for name, content in listings:
+        print '%s: %.1f KB' % (name, len(content) / 1024.0)
+        measure('parse_links', parse_links, content, options.calls)
+        if BeautifulSoup:
+            measure('BeautifulSoup', parse_beautifulsoup, content, options.calls)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Micro-benchmark comparing the per line regular expression matching
+previously used by S1S2Test.analyze_logcat with LogcatEventMatcher.
+
+Usage: logcat_benchmark.py [--polls N] [logcat-file]
+
+logcat-file is a logcat recorded with 'adb logcat -v time -d'. If it is
+not specified, a synthetic logcat is generated. The logcat is split
+into --polls chunks to simulate analyze_logcat polling the device.
+"""
+
+import logging
+import os
+import re
+import sys
+import time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from logcatmatcher import LogcatEventMatcher
+
+APP_NAME = 'org.mozilla.fennec'
+THROBBER_PREFIX = '..GeckoToolbarDisplayLayout.*zerdatime (\d+) - Throbber'
+
+
+def synthetic_logcat(nlines):
+    lines = []
+    for i in xrange(nlines):
+        lines.append('01-02 10:%02d:%02d.%03d D/dalvikvm( 1234): GC_CONCURRENT '
+                     'freed %dK, 50%% free' % ((i / 60000) % 60,
+                                               (i / 1000) % 60, i % 1000, i))
+    lines[nlines / 10] = ('01-02 10:00:01.000 I/ActivityManager(  123): Start '
+                          'proc %s for activity %s/.App: pid=1' %
+                          (APP_NAME, APP_NAME))
+    lines[nlines / 2] = ('01-02 10:00:02.000 I/GeckoToolbarDisplayLayout( 1): '
+                         'zerdatime 1 - Throbber start')
+    lines[-1] = ('01-02 10:00:04.000 I/GeckoToolbarDisplayLayout( 1): '
+                 'zerdatime 3 - Throbber stop')
+    return lines
+
+
+def legacy(polls, logger):
+    """The original analyze_logcat loop which rescans the full logcat
+    on each poll."""
+    logcat_prefix = '(\d{2}-\d{2} \d{2}:\d{2}:\d{2}\.\d{3})'
+    re_base_time = re.compile('%s' % logcat_prefix)
+    re_start_time = re.compile(
+        '%s .*(Gecko|Start proc %s for activity %s/.App)' % (
+            logcat_prefix, APP_NAME, APP_NAME))
+    re_throbber_start_time = re.compile('%s %s start' %
+                                        (logcat_prefix, THROBBER_PREFIX))
+    re_throbber_stop_time = re.compile('%s %s stop' %
+                                       (logcat_prefix, THROBBER_PREFIX))
+    base_time = start_time = throbber_start_time = throbber_stop_time = 0
+    buf = []
+    for poll in polls:
+        buf.extend(poll)
+        for line in buf:
+            logger.debug('analyze_logcat: %s' % line)
+            match = re_base_time.match(line)
+            if match and not base_time:
+                base_time = match.group(1)
+            match = re_start_time.match(line)
+            if match and not start_time:
+                start_time = match.group(1)
+                continue
+            match = re_throbber_start_time.match(line)
+            if match and not throbber_start_time:
+                throbber_start_time = match.group(1)
+                continue
+            match = re_throbber_stop_time.match(line)
+            if match and not throbber_stop_time:
+                throbber_stop_time = match.group(1)
+                continue
+            if start_time and throbber_start_time and throbber_stop_time:
+                break
+        if throbber_start_time and throbber_stop_time:
+            break
+    return base_time, start_time, throbber_start_time, throbber_stop_time
+
+
+def matcher(polls, event_matcher):
+    event_matcher.reset()
+    for poll in polls:
+        if event_matcher.feed(poll):
+            break
+    times = event_matcher.times
+    return (event_matcher.base_time, times.get('start', 0),
+            times.get('throbber_start', 0), times.get('throbber_stop', 0))
+
+
+def main():
+    parser = OptionParser(usage='%prog [options] [logcat-file]')
+    parser.add_option('--polls', type='int', default=30,
+                      help='number of polls to split the logcat into.')
+    parser.add_option('--lines', type='int', default=200000,
+                      help='number of lines in the synthetic logcat.')
+    parser.add_option('--repeat', type='int', default=3,
+                      help='number of times to repeat each measurement.')
+    options, args = parser.parse_args()
+
+    if args:
+        lines = [line.strip() for line in open(args[0])]
+    else:
+        lines = synthetic_logcat(options.lines)
+    size = (len(lines) + options.polls - 1) / options.polls
+    polls = [lines[i:i + size] for i in xrange(0, len(lines), size)]
+
+    # Logging is configured at INFO as in production so that the cost
+    # of the discarded debug messages is included.
+    logging.basicConfig(level=logging.INFO)
+    logger = logging.getLogger()
+    event_matcher = LogcatEventMatcher(
+        [('start', '.*(Gecko|Start proc %s for activity %s/.App)' % (
+            APP_NAME, APP_NAME)),
+         ('throbber_start', '%s start' % THROBBER_PREFIX),
+         ('throbber_stop', '%s stop' % THROBBER_PREFIX)])
+
+    print 'lines: %d, polls: %d' % (len(lines), len(polls))
+    results = {}
+    for name, func, arg in (('legacy', legacy, logger),
+                            ('matcher', matcher, event_matcher)):
+        best = None
+        for i in range(options.repeat):
+            start = time.time()
+            results[name] = func(polls, arg)
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print '%-8s %8.3f s  %s' % (name, best, results[name])
+    if results['legacy'] != results['matcher']:
+        print 'ERROR: results differ'
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,90 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest
+
+from phonetest import Logcat
+
+
+class FakeDevice(object):
+    """A device whose logcat buffer holds at most size lines."""
+
+    def __init__(self, size=20):
+        self.size = size
+        self.logcat = []
+        self.count = 0
+
+    def log(self, n):
+        for i in range(n):
+            self.logcat.append('01-02 10:00:00.%03d I/Test( 1): line %d' % (
+                self.count % 1000, self.count))
+            self.count += 1
+        del self.logcat[:-self.size]
+
+    def get_logcat(self, filter_specs=None):
+        return list(self.logcat)
+
+    def clear_logcat(self):
+        self.logcat = []
+
+
+class Options(object):
+    device_logcat_stream = False
+    phone_retry_limit = 1
+    phone_retry_wait = 0
+
+
+class FakePhoneTest(object):
+
+    def __init__(self, dm):
+        self.dm = dm
+        self.options = Options()
+
+
+class LogcatDumpCursorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dm = FakeDevice()
+        self.logcat = Logcat(FakePhoneTest(self.dm))
+
+    def line_numbers(self, lines):
+        return [int(line.split()[-1]) for line in lines]
+
+    def test_cursor(self):
+        self.dm.log(5)
+        lines, cursor = self.logcat.get_since()
+        self.assertEqual(self.line_numbers(lines), range(5))
+        lines, cursor = self.logcat.get_since(cursor)
+        self.assertEqual(lines, [])
+        self.dm.log(3)
+        lines, cursor = self.logcat.get_since(cursor)
+        self.assertEqual(self.line_numbers(lines), range(5, 8))
+
+    def test_wrapped_buffer(self):
+        self.dm.log(15)
+        lines, cursor = self.logcat.get_since()
+        # 10 lines are logged, dropping the first 5 from the buffer.
+        self.dm.log(10)
+        lines, cursor = self.logcat.get_since(cursor)
+        self.assertEqual(self.line_numbers(lines), range(15, 25))
+        self.dm.log(2)
+        lines, cursor = self.logcat.get_since(cursor)
+        self.assertEqual(self.line_numbers(lines), range(25, 27))
+
+    def test_buffer_replaced(self):
+        self.dm.log(10)
+        lines, cursor = self.logcat.get_since()
+        # More lines than the buffer holds are logged, so none of the
+        # lines which were read remain and all of the lines are new.
+        self.dm.log(30)
+        lines, cursor = self.logcat.get_since(cursor)
+        self.assertEqual(self.line_numbers(lines), range(20, 40))
+
+    def test_clear(self):
+        self.dm.log(10)
+        lines, cursor = self.logcat.get_since()
+        self.logcat.clear()
+        self.dm.log(3)
+        lines, cursor = self.logcat.get_since()
+        self.assertEqual(self.line_numbers(lines), range(10, 13))
@@ -94,8 +94,11 @@ class UnitTest(PhoneTest):
         PhoneTest.setup_job(self)
         build_dir = self.build.dir
         symbols_path = self.build.symbols
-        if symbols_path and not os.path.exists(symbols_path):
-            symbols_path = None
+        if not symbols_path or not os.path.exists(symbols_path):
+            # The symbols have not been fetched into the build cache.
+            # The test harness downloads them from the url if it
+            # needs to process a crash.
+            symbols_path = self.build.symbols_url
         re_revision = re.compile(r'http.*/rev/(.*)')
         match = re_revision.match(self.build.revision)
         if match:
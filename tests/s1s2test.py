@@ -8,7 +8,6 @@ import glob
 import logging
 import os
 import posixpath
-import re
 import sys
 import urlparse
 from time import sleep
@@ -16,6 +15,7 @@ from time import sleep
 from mozprofile import FirefoxProfile
 
 from adb import ADBError
+from logcatmatcher import LogcatEventMatcher
 from logdecorator import LogDecorator
 from perftest import PerfTest
 from phonetest import PhoneTestResult
@@ -31,6 +31,9 @@ class S1S2Test(PerfTest):
         PerfTest.__init__(self, dm=dm, phone=phone, options=options,
                           config_file=config_file, chunk=chunk, repos=repos)
 
+        # LogcatEventMatchers keyed by application name.
+        self._logcat_matchers = {}
+
         # [paths]
         autophone_directory = os.path.dirname(os.path.abspath(sys.argv[0]))
         self._paths = {}
@@ -431,65 +434,53 @@ class S1S2Test(PerfTest):
                     raise
                 sleep(self.options.phone_retry_wait)
 
+    def get_logcat_matcher(self):
+        """Return the LogcatEventMatcher for the current build's
+        application, compiling it on first use."""
+        app_name = self.build.app_name
+        if app_name not in self._logcat_matchers:
+            throbber_prefix = '..GeckoToolbarDisplayLayout.*zerdatime (\d+) - Throbber'
+            self._logcat_matchers[app_name] = LogcatEventMatcher(
+                [('start', '.*(Gecko|Start proc %s for activity %s/.App)' % (
+                    app_name, app_name)),
+                 ('throbber_start', '%s start' % throbber_prefix),
+                 ('throbber_stop', '%s stop' % throbber_prefix)])
+        return self._logcat_matchers[app_name]
+
     def analyze_logcat(self):
         self.loggerdeco.debug('analyzing logcat')
 
-        logcat_prefix = '(\d{2}-\d{2} \d{2}:\d{2}:\d{2}\.\d{3})'
-        throbber_prefix = '..GeckoToolbarDisplayLayout.*zerdatime (\d+) - Throbber'
-        re_base_time = re.compile('%s' % logcat_prefix)
-        re_start_time = re.compile(
-            '%s .*(Gecko|Start proc %s for activity %s/.App)' % (
-                logcat_prefix, self.build.app_name, self.build.app_name))
-        re_throbber_start_time = re.compile('%s %s start' %
-                                            (logcat_prefix, throbber_prefix))
-        re_throbber_stop_time = re.compile('%s %s stop' %
-                                           (logcat_prefix, throbber_prefix))
-
-        base_time = 0
-        start_time = 0
-        throbber_start_time = 0
-        throbber_stop_time = 0
+        matcher = self.get_logcat_matcher()
+        matcher.reset()
 
         attempt = 1
         max_time = 90 # maximum time to wait for throbbers
         wait_time = 3 # time to wait between attempts
         max_attempts = max_time / wait_time
 
-        while (attempt <= max_attempts and (throbber_start_time == 0 or
-                                            throbber_stop_time == 0)):
-            buf = self.logcat.get()
-            for line in buf:
-                self.loggerdeco.debug('analyze_logcat: %s' % line)
-                match = re_base_time.match(line)
-                if match and not base_time:
-                    base_time = match.group(1)
-                    self.loggerdeco.debug('analyze_logcat: base_time: %s' % base_time)
-                # we want the first throbberstart and throbberstop.
-                match = re_start_time.match(line)
-                if match and not start_time:
-                    start_time = match.group(1)
-                    self.loggerdeco.debug('analyze_logcat: start_time: %s' % start_time)
-                    continue
-                match = re_throbber_start_time.match(line)
-                if match and not throbber_start_time:
-                    throbber_start_time = match.group(1)
-                    self.loggerdeco.debug('analyze_logcat: throbber_start_time: %s' % throbber_start_time)
-                    continue
-                match = re_throbber_stop_time.match(line)
-                if match and not throbber_stop_time:
-                    throbber_stop_time = match.group(1)
-                    self.loggerdeco.debug('analyze_logcat: throbber_stop_time: %s' % throbber_stop_time)
-                    continue
-                if start_time and throbber_start_time and throbber_stop_time:
-                    break
+        # Only scan the logcat lines which have arrived since the
+        # previous attempt.
+        cursor = None
+        while (attempt <= max_attempts and
+               ('throbber_start' not in matcher.times or
+                'throbber_stop' not in matcher.times)):
+            buf, cursor = self.logcat.get_since(cursor)
+            matcher.feed(buf)
+            self.loggerdeco.debug('analyze_logcat: lines: %s, base_time: %s, '
+                                  'times: %s' % (matcher.lines,
+                                                 matcher.base_time,
+                                                 matcher.times))
             if self.fennec_crashed:
                 # If fennec crashed, don't bother looking for the Throbbers
                 break
-            if (start_time == 0 or
-                throbber_start_time == 0 or
-                throbber_stop_time == 0):
+            if not matcher.done:
                 sleep(wait_time)
                 attempt += 1
+
+        base_time = matcher.base_time or 0
+        start_time = matcher.times.get('start', 0)
+        throbber_start_time = matcher.times.get('throbber_start', 0)
+        throbber_stop_time = matcher.times.get('throbber_stop', 0)
         if throbber_start_time and throbber_stop_time == 0:
             self.loggerdeco.info('Unable to find Throbber stop')
 
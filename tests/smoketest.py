@@ -8,10 +8,18 @@ from time import sleep
 from mozprofile import FirefoxProfile
 
 from autophonecrash import AutophoneCrashProcessor
+from logcatmatcher import LogcatEventMatcher
 from phonetest import PhoneTest, PhoneTestResult
 
 
 class SmokeTest(PhoneTest):
+    def __init__(self, dm=None, phone=None, options=None,
+                 config_file=None, chunk=1, repos=[]):
+        PhoneTest.__init__(self, dm=dm, phone=phone, options=options,
+                           config_file=config_file, chunk=chunk, repos=repos)
+        self._throbber_matcher = LogcatEventMatcher(
+            [('throbber_stop', '.*Throbber stop')])
+        self._throbber_cursor = None
 
     @property
     def name(self):
@@ -38,6 +46,8 @@ class SmokeTest(PhoneTest):
 
         # Clear logcat
         self.logcat.clear()
+        self._throbber_matcher.reset()
+        self._throbber_cursor = None
 
         # Run test
         self.loggerdeco.debug('running fennec')
@@ -100,12 +110,10 @@ class SmokeTest(PhoneTest):
         self.install_profile(profile)
 
     def check_throbber(self):
-        buf = self.logcat.get()
-
-        for line in buf:
-            line = line.strip()
-            self.loggerdeco.debug('check_throbber: %s' % line)
-            if 'Throbber stop' in line:
-                return True
-        return False
+        buf, self._throbber_cursor = self.logcat.get_since(
+            self._throbber_cursor)
+        found = self._throbber_matcher.feed(buf)
+        self.loggerdeco.debug('check_throbber: lines: %s, found: %s' %
+                              (self._throbber_matcher.lines, found))
+        return found
 
@@ -13,6 +13,7 @@ from time import sleep
 from mozprofile import FirefoxProfile
 
 from adb import ADBError
+from logcatmatcher import LogcatEventMatcher
 from perftest import PerfTest
 from phonetest import PhoneTestResult
 
@@ -22,6 +23,8 @@ class WebappStartupTest(PerfTest):
         PerfTest.__init__(self, dm=dm, phone=phone, options=options,
                           config_file=config_file, chunk=chunk, repos=repos)
         self.webappstartup_name = None
+        # LogcatEventMatchers keyed by webapp name.
+        self._logcat_matchers = {}
 
     @property
     def name(self):
@@ -492,61 +495,51 @@ class WebappStartupTest(PerfTest):
                     raise
                 sleep(self.options.phone_retry_wait)
 
+    def get_logcat_matcher(self):
+        """Return the LogcatEventMatcher for the current webapp,
+        compiling it on first use."""
+        name = self.webappstartup_name
+        if name not in self._logcat_matchers:
+            chrome_prefix = '..GeckoBrowser.*: zerdatime .* - browser chrome startup finished.'
+            webapp_prefix = '..GeckoConsole.*WEBAPP STARTUP COMPLETE'
+            self._logcat_matchers[name] = LogcatEventMatcher(
+                [('start', '.*(Gecko|Start proc %s for activity %s)' % (
+                    name, name)),
+                 ('chrome', chrome_prefix),
+                 ('startup', webapp_prefix)])
+        return self._logcat_matchers[name]
+
     def analyze_logcat(self):
         self.loggerdeco.debug('analyzing logcat')
 
-        logcat_prefix = '(\d{2}-\d{2} \d{2}:\d{2}:\d{2}\.\d{3})'
-        chrome_prefix = '..GeckoBrowser.*: zerdatime .* - browser chrome startup finished.'
-        webapp_prefix = '..GeckoConsole.*WEBAPP STARTUP COMPLETE'
-        re_base_time = re.compile('%s' % logcat_prefix)
-        re_start_time = re.compile(
-            '%s .*(Gecko|Start proc %s for activity %s)' % (
-                logcat_prefix, self.webappstartup_name, self.webappstartup_name))
-        re_chrome_time = re.compile('%s %s' %
-                                    (logcat_prefix, chrome_prefix))
-        re_startup_time = re.compile('%s %s' %
-                                     (logcat_prefix, webapp_prefix))
-
-        base_time = 0
-        start_time = 0
-        chrome_time = 0
-        startup_time = 0
+        matcher = self.get_logcat_matcher()
+        matcher.reset()
 
         attempt = 1
         max_time = 90 # maximum time to wait for WEBAPP STARTUP COMPLETE
         wait_time = 3 # time to wait between attempts
         max_attempts = max_time / wait_time
 
-        while attempt <= max_attempts and startup_time == 0:
-            buf = self.logcat.get()
-            for line in buf:
-                self.loggerdeco.debug('analyze_logcat: %s' % line)
-                match = re_base_time.match(line)
-                if match and not base_time:
-                    base_time = match.group(1)
-                    self.loggerdeco.debug('analyze_logcat: base_time: %s' % base_time)
-                match = re_start_time.match(line)
-                if match and not start_time:
-                    start_time = match.group(1)
-                    self.loggerdeco.debug('analyze_logcat: start_time: %s' % start_time)
-                    continue
-                match = re_chrome_time.match(line)
-                if match and not chrome_time:
-                    chrome_time = match.group(1)
-                    self.loggerdeco.debug('analyze_logcat: chrome_time: %s' % chrome_time)
-                    continue
-                match = re_startup_time.match(line)
-                if match and not startup_time:
-                    startup_time = match.group(1)
-                    self.loggerdeco.debug('analyze_logcat: startup_time: %s' % startup_time)
-                    continue
-                if start_time and startup_time:
-                    break
+        # Only scan the logcat lines which have arrived since the
+        # previous attempt.
+        cursor = None
+        while attempt <= max_attempts and 'startup' not in matcher.times:
+            buf, cursor = self.logcat.get_since(cursor)
+            matcher.feed(buf)
+            self.loggerdeco.debug('analyze_logcat: lines: %s, base_time: %s, '
+                                  'times: %s' % (matcher.lines,
+                                                 matcher.base_time,
+                                                 matcher.times))
             if self.fennec_crashed:
                 break
-            if start_time == 0 or chrome_time == 0 or startup_time == 0:
+            if not matcher.done:
                 sleep(wait_time)
                 attempt += 1
+
+        base_time = matcher.base_time or 0
+        start_time = matcher.times.get('start', 0)
+        chrome_time = matcher.times.get('chrome', 0)
+        startup_time = matcher.times.get('startup', 0)
         if chrome_time and startup_time == 0:
             self.loggerdeco.info('Unable to find WEBAPP STARTUP COMPLETE')
 
@@ -10,6 +10,7 @@ import re
 import socket
 import sys
 
+import buildindex
 import builds
 
 def from_iso_date_or_datetime(s):
@@ -22,14 +23,62 @@ def from_iso_date_or_datetime(s):
     return d
 
 
-def command_str(build, test_names, devices):
-    job_data = {'build': build,
+def command_str(builds, test_names, devices):
+    job_data = {'builds': builds,
                 'test_names': test_names or [],
                 'devices': devices or []}
-    s = 'autophone-triggerjobs %s' % json.dumps(job_data)
+    s = 'autophone-triggerbuilds %s' % json.dumps(job_data)
     return s
 
 
+def recv_response(s):
+    """Return the next line sent by the server."""
+    response = ''
+    while not response.endswith('\n'):
+        data = s.recv(4096)
+        if not data:
+            break
+        response += data
+    return response.strip()
+
+
+def send_command(s, c, logger):
+    sc = '%s' % c
+    logger.info(sc)
+    print(sc)
+    s.sendall(c + '\n')
+    sr = '- %s' % recv_response(s)
+    logger.info(sr)
+    print(sr)
+
+
+def send_builds(s, builds, test_names, devices, logger):
+    """Trigger the jobs for builds with a single autophone-triggerbuilds
+    command and report the jobs added for each build."""
+    for build in builds:
+        logger.info(build)
+        print(build)
+    s.sendall(command_str(builds, test_names, devices) + '\n')
+    response = recv_response(s)
+    try:
+        summary = json.loads(response)
+    except ValueError:
+        summary = None
+    if not isinstance(summary, list):
+        sr = '- %s' % response
+        logger.info(sr)
+        print(sr)
+        return
+    for item in summary:
+        if item['error']:
+            sr = '- %s: %s' % (item['build'], item['error'])
+        else:
+            sr = '- %s: %d jobs, %d tests' % (item['build'], item['jobs'],
+                                               item['tests'])
+        logger.info(sr)
+        print(sr)
+
+
 def main(args, options):
     # Attempt to connect to the Autophone server early, so we don't
     # waste time fetching builds if the server is not available.
@@ -71,10 +120,14 @@ def main(args, options):
                        'android-x86']
     buildfile_ext = '.apk'
 
+    build_index = None
+    if options.build_index:
+        build_index = buildindex.BuildIndex(options.build_index)
     cache = builds.BuildCache(
         options.repos, options.buildtypes,
         product, build_platforms,
-        buildfile_ext)
+        buildfile_ext, build_index=build_index)
+    crawl = not options.no_crawl
 
     build_urls = []
     if options.build_url:
@@ -82,9 +135,10 @@ def main(args, options):
     elif not args:
         build_urls = cache.find_builds_by_revision(
             options.first_revision, options.last_revision,
-            options.build_location)
+            options.build_location, crawl=crawl)
     elif args[0] == 'latest':
-        build_urls = cache.find_latest_builds(options.build_location)
+        build_urls = cache.find_latest_builds(options.build_location,
+                                              crawl=crawl)
     else:
         if re.match('\d{14}', args[0]):
             # build id
@@ -97,23 +151,25 @@ def main(args, options):
                 end_time = from_iso_date_or_datetime(args[1])
             else:
                 end_time = datetime.datetime.now()
-        build_urls = cache.find_builds_by_time(
-            start_time, end_time, options.build_location)
+        build_urls = cache.iter_builds_by_time(
+            start_time, end_time, options.build_location, crawl=crawl)
 
-    if not build_urls:
+    # iter_builds_by_time returns the builds as they are found, so
+    # each batch of jobs is triggered while the search continues.
+    logger.info('- %s' % recv_response(s))
+    found = False
+    batch = []
+    for b in build_urls:
+        found = True
+        batch.append(b)
+        if len(batch) >= options.batch_size:
+            send_builds(s, batch, options.test_names, options.devices, logger)
+            batch = []
+    if batch:
+        send_builds(s, batch, options.test_names, options.devices, logger)
+    if not found:
         return 1
-    commands = [command_str(b, options.test_names, options.devices)
-                for b in build_urls]
-    commands.append('exit')
-    logger.info('- %s' % s.recv(1024).strip())
-    for c in commands:
-        sc = '%s' % c
-        logger.info(sc)
-        print(sc)
-        s.sendall(c + '\n')
-        sr = '- %s' % s.recv(1024).strip()
-        logger.info(sr)
-        print(sr)
+    send_command(s, 'exit', logger)
     return 0
 
 
@@ -151,6 +207,20 @@ If "latest" is given, test runs are initiated for the most recent build.'''
                       dest='build_location', default='nightly',
                       help='build location to search for builds, defaults to nightly;'
                       ' can be "tinderbox" or "inboundarchive" for both m-c and m-i')
+    parser.add_option('--build-index', action='store', type='string',
+                      dest='build_index', default=buildindex.BuildIndex.FILENAME,
+                      help='sqlite database of the builds found by previous '
+                      'searches and by autophone; defaults to %s. Specify an '
+                      'empty string to not use an index.' %
+                      buildindex.BuildIndex.FILENAME)
+    parser.add_option('--no-crawl', action='store_true',
+                      dest='no_crawl', default=False,
+                      help='find the builds in the build index without '
+                      'searching the build location.')
+    parser.add_option('--batch-size', action='store', type='int',
+                      dest='batch_size', default=50,
+                      help='maximum number of builds to trigger with each '
+                      'command sent to the autophone server; defaults to 50.')
     parser.add_option('--logfile', action='store', type='string',
                       dest='logfile', default='autophone.log',
                       help='Log file to store build system logs, '
@@ -4,12 +4,15 @@
 
 # get_remote_content modelled on treeherder/etc/common.py
 
+import hashlib
 import httplib
 import json
 import logging
 import os
 import random
 import re
+import tempfile
+import threading
 import time
 import urllib2
 import urlparse
@@ -19,13 +22,140 @@ import uuid
 # used in a child process.
 logger = logging.getLogger()
 
+class HttpCache(object):
+    """A thread safe cache of the content of the remote urls retrieved
+    by get_remote_text.
+
+    The content of a url is cached for the ttl in seconds of the first
+    of the (pattern, ttl) pairs in ttls whose regular expression
+    pattern matches the url. Urls which do not match any pattern are
+    not cached. Expired content which was served with an ETag or
+    Last-Modified header is revalidated with a conditional request
+    instead of being retrieved again. If cache_dir is specified, the
+    content is also saved there so that it persists across restarts
+    and is shared by processes.
+
+    hits counts the requests served from the cache, misses the
+    requests which required a request to the server and revalidated
+    the misses which were answered with 304 Not Modified.
+    """
+
+    TTLS = [
+        # Pushlog entries, Treeherder revision lookups and build .txt
+        # files do not change once they exist.
+        (r'/json-pushes\?changeset=', 24*60*60),
+        (r'/json-pushes\?fromchange=', 24*60*60),
+        (r'/revision-lookup/\?revision=', 24*60*60),
+        (r'^https?://(ftp|archive)\.mozilla\.org/.*\.txt$', 24*60*60),
+    ]
+    MAX_ENTRIES = 1000
+
+    def __init__(self, ttls=None, cache_dir=None):
+        if ttls is None:
+            ttls = self.TTLS
+        self.ttls = [(re.compile(pattern), ttl) for pattern, ttl in ttls]
+        self.cache_dir = cache_dir
+        if cache_dir and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def __str__(self):
+        return 'hits: %d, misses: %d, revalidated: %d, entries: %d' % (
+            self.hits, self.misses, self.revalidated, len(self._entries))
+
+    def ttl(self, url):
+        """Return the number of seconds url is to be cached."""
+        for regex, ttl in self.ttls:
+            if regex.search(url):
+                return ttl
+        return 0
+
+    def _path(self, url):
+        return os.path.join(self.cache_dir, hashlib.sha1(url).hexdigest())
+
+    def lookup(self, url):
+        """Return the cached entry for url or None. An entry is a dict
+        with the items content, expires, etag and last_modified.
+        """
+        with self._lock:
+            entry = self._entries.get(url)
+        if entry or not self.cache_dir:
+            return entry
+        try:
+            with open(self._path(url), 'rb') as cache_file:
+                entry = json.loads(cache_file.readline())
+                entry['content'] = cache_file.read()
+        except (IOError, ValueError):
+            return None
+        if entry.get('url') != url:
+            return None
+        with self._lock:
+            self._entries[url] = entry
+        return entry
+
+    def store(self, url, content, etag=None, last_modified=None):
+        """Cache content for url for ttl(url) seconds."""
+        now = time.time()
+        entry = {'url': url,
+                 'expires': now + self.ttl(url),
+                 'etag': etag,
+                 'last_modified': last_modified}
+        if self.cache_dir:
+            try:
+                fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir)
+                with os.fdopen(fd, 'wb') as cache_file:
+                    cache_file.write(json.dumps(entry) + '\n')
+                    cache_file.write(content)
+                os.rename(tmp_path, self._path(url))
+            except (IOError, OSError):
+                logger.exception('HttpCache: unable to save %s' % url)
+        entry['content'] = content
+        with self._lock:
+            if len(self._entries) >= self.MAX_ENTRIES:
+                for expired_url in [u for u, e in self._entries.iteritems()
+                                    if e['expires'] <= now]:
+                    del self._entries[expired_url]
+                if len(self._entries) >= self.MAX_ENTRIES:
+                    del self._entries[min(
+                        self._entries,
+                        key=lambda u: self._entries[u]['expires'])]
+            self._entries[url] = entry
+
+    def invalidate(self, url):
+        """Remove url from the cache."""
+        with self._lock:
+            self._entries.pop(url, None)
+        if self.cache_dir:
+            try:
+                os.unlink(self._path(url))
+            except OSError:
+                pass
+
+    def count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+
+# The cache used by get_remote_text. It may be replaced with a
+# differently configured HttpCache or set to None to disable caching.
+http_cache = HttpCache()
+
+
 def get_remote_text(url):
     """Return the string containing the contents of a remote url if the
     HTTP response code is 200, otherwise return None.
 
+    The contents of http urls are cached by http_cache.
+
     :param url: url of content to be retrieved.
     """
     conn = None
+    cache = http_cache
+    entry = None
 
     try:
         scheme = urlparse.urlparse(url).scheme
@@ -36,11 +166,29 @@ def get_remote_text(url):
             conn = urllib2.urlopen(url)
             return conn.read()
 
+        if cache and not cache.ttl(url):
+            cache = None
+        headers = {}
+        if cache:
+            entry = cache.lookup(url)
+            if entry and entry['expires'] > time.time():
+                cache.count('hits')
+                return entry['content']
+            cache.count('misses')
+            if entry and entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry and entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+
         while True:
-            conn = urllib2.urlopen(url)
+            conn = urllib2.urlopen(urllib2.Request(url, headers=headers))
             code = conn.getcode()
             if code == 200:
                 content = conn.read()
+                if cache:
+                    cache.store(url, content,
+                                etag=conn.info().getheader('ETag'),
+                                last_modified=conn.info().getheader('Last-Modified'))
                 return content
             if code != 503:
                 logger.warning("Unable to open url %s : %s" % (
@@ -52,6 +200,11 @@ def get_remote_text(url):
             conn.close()
             time.sleep(60 + random.randrange(0,30,1))
     except urllib2.HTTPError, e:
+        if e.code == 304 and entry:
+            cache.count('revalidated')
+            cache.store(url, entry['content'], etag=entry['etag'],
+                        last_modified=entry['last_modified'])
+            return entry['content']
         logger.warning('%s Unable to open %s' % (e, url))
         return None
     except Exception:
@@ -130,10 +283,10 @@ def get_treeherder_revision_hash(treeherder_url, repo, revision):
     revurl = '%s/api/project/%s/revision-lookup/?revision=%s' % (
         treeherder_url, repo, revision)
     revision_lookup = get_remote_json(revurl)
-    if not revision_lookup:
-        return None
-
-    if revision not in revision_lookup:
+    if not revision_lookup or revision not in revision_lookup:
+        # The revision may not have been ingested yet.
+        if http_cache:
+            http_cache.invalidate(revurl)
         return None
 
     return revision_lookup[revision]['revision_hash']
@@ -94,11 +94,14 @@ class PhoneWorker(object):
     DEVICE_READY_RETRY_ATTEMPTS = 3
     DEVICE_BATTERY_MIN = 90
     DEVICE_BATTERY_MAX = 95
+    DEVICE_INIT_CONCURRENCY = 8
+    DEVICE_INIT_TIMEOUT = 300
     PHONE_RETRY_LIMIT = 2
     PHONE_RETRY_WAIT = 15
     PHONE_MAX_REBOOTS = 3
     PHONE_PING_INTERVAL = 15*60
     PHONE_COMMAND_QUEUE_TIMEOUT = 10
+    PHONE_JOB_SWEEP_INTERVAL = 5*60
 
     def __init__(self, dm, worker_num, tests, phone, options,
                  autophone_queue, logfile_prefix, loglevel, mailer,
@@ -164,9 +167,9 @@ class PhoneWorker(object):
         self.state = ProcessStates.RESTARTING
         self.queue.put_nowait(('shutdown', None))
 
-    def new_job(self):
-        self.loggerdeco.debug('PhoneWorker:new_job')
-        self.queue.put_nowait(('job', None))
+    def new_job(self, job_id):
+        self.loggerdeco.debug('PhoneWorker:new_job %s' % job_id)
+        self.queue.put_nowait(('job', job_id))
 
     def reboot(self):
         self.loggerdeco.debug('PhoneWorker:reboot')
@@ -264,6 +267,15 @@ class PhoneWorkerSubProcess(object):
         self.shared_lock = shared_lock
         self.p = None
         self.jobs = None
+        # The jobs database is only checked for a new job when the
+        # main process has notified the worker of a job, when the
+        # previous check found a job, or when phone_job_sweep_interval
+        # seconds have passed since the last check. jobs_pending is
+        # initially True so that jobs queued before the worker started
+        # are picked up.
+        self.jobs_pending = True
+        self.notified_job_ids = set()
+        self.last_job_check = None
         self.build = None
         self.last_ping = None
         self.phone_status = None
@@ -747,11 +759,13 @@ class PhoneWorkerSubProcess(object):
             self.state = ProcessStates.SHUTTINGDOWN
             return {'interrupt': False, 'reason': ''}
         if request[0] == 'job':
-            # This is just a notification that breaks us from waiting on the
-            # command queue; it's not essential, since jobs are stored in
-            # a db, but it allows the worker to react quickly to a request if
-            # it isn't doing anything else.
-            self.loggerdeco.debug('Received job command request...')
+            # The main process has added job request[1] for this
+            # device to the jobs database. The job is picked up by
+            # get_next_job once the worker is idle.
+            self.loggerdeco.debug('Received job command request %s...' %
+                                  request[1])
+            self.jobs_pending = True
+            self.notified_job_ids.add(request[1])
             return {'interrupt': False, 'reason': ''}
         if request[0] == 'reboot':
             self.loggerdeco.info('Rebooting at user\'s request...')
@@ -790,12 +804,47 @@ class PhoneWorkerSubProcess(object):
             except Queue.Empty:
                 return {'interrupt': False, 'reason': ''}
 
+    def get_next_job(self):
+        """Return the next job for this device or None.
+
+        The jobs database is only queried if a job is known to be
+        pending or if phone_job_sweep_interval seconds have passed
+        since it was last queried. The periodic sweep picks up any
+        job whose notification was lost, for example one queued
+        while the worker was restarting.
+        """
+        now = datetime.datetime.now()
+        if (not self.jobs_pending and self.last_job_check and
+            now - self.last_job_check <
+            datetime.timedelta(seconds=self.options.phone_job_sweep_interval)):
+            return None
+        sweep = not self.jobs_pending
+        self.last_job_check = now
+        job = self.jobs.get_next_job(lifo=self.options.lifo, worker=self)
+        if job:
+            if sweep:
+                self.loggerdeco.info('Job sweep found job %s.' % job['id'])
+            # Other jobs may be pending, so continue to check the
+            # database until it has no jobs for this device.
+            self.jobs_pending = True
+            self.notified_job_ids.discard(job['id'])
+        else:
+            if self.notified_job_ids:
+                self.loggerdeco.debug('Notified jobs %s are no longer pending.' %
+                                      sorted(self.notified_job_ids))
+            self.jobs_pending = False
+            self.notified_job_ids.clear()
+        return job
+
     def main_loop(self):
         self.loggerdeco.debug('PhoneWorkerSubProcess:main_loop')
         # Commands take higher priority than jobs, so we deal with all
         # immediately available commands, then start the next job, if there is
         # one.  If neither a job nor a command is currently available,
         # block on the command queue for PhoneWorker.PHONE_COMMAND_QUEUE_TIMEOUT seconds.
+        # Jobs are only fetched from the database after the main
+        # process notifies us of a new job or when the periodic job
+        # sweep is due. See get_next_job.
         request = None
         while True:
             try:
@@ -811,7 +860,7 @@ class PhoneWorkerSubProcess(object):
                 if self.is_disconnected():
                     self.recover_phone()
                 if not self.is_disconnected():
-                    job = self.jobs.get_next_job(lifo=self.options.lifo, worker=self)
+                    job = self.get_next_job()
                     if job:
                         if not self.is_disabled():
                             self.handle_job(job)